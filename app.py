@@ -1,8 +1,10 @@
 # First, try to import the required modules
 # If they fail, provide helpful error messages
 try:
-    from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+    from fastapi import FastAPI, File, UploadFile, Form, Header, Query, HTTPException, WebSocket, WebSocketDisconnect
     from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import StreamingResponse
+    from fastapi.concurrency import run_in_threadpool
     import uvicorn
 except ImportError as e:
     print(f"ERROR: Failed to import FastAPI or Uvicorn. {str(e)}")
@@ -11,8 +13,10 @@ except ImportError as e:
     import subprocess
     try:
         subprocess.check_call(["pip", "install", "fastapi", "uvicorn", "python-multipart"])
-        from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+        from fastapi import FastAPI, File, UploadFile, Form, Header, Query, HTTPException, WebSocket, WebSocketDisconnect
         from fastapi.middleware.cors import CORSMiddleware
+        from fastapi.responses import StreamingResponse
+        from fastapi.concurrency import run_in_threadpool
         import uvicorn
         print("SUCCESS: Installed missing packages.")
     except Exception as install_error:
@@ -22,17 +26,33 @@ except ImportError as e:
 
 try:
     import torch
-    import io
     from PIL import Image
     import numpy as np
     from torchvision import transforms
-    from model import PneumoniaModel, SimpleConvNet
+    from model import PneumoniaModel, SimpleConvNet, CompactConvNet
+    from similarity_index import SimilarityIndex
+    from phash_index import PHashIndex, phash
+    from precision import select_precision, run_model, load_reference_batch
+    from cam import ActivationMaps, overlay_png
+    from job_queue import JobScheduler, QueueFull, PRIORITIES
+    from model_manager import ModelManager, BINARY_CLASSES, checkpoint_version
+    from xray_io import load_xray, UnsupportedImage
+    from audit_log import AuditLog, AuditBackpressure
+    from drift_monitor import DriftMonitor, load_reference
+    from shadow import ShadowEvaluator
+    from ensemble import Ensemble
 except ImportError as e:
     print(f"ERROR: Failed to import PyTorch or related modules. {str(e)}")
     print("Please make sure to install them with: pip install torch torchvision pillow numpy")
 
 import os
 import json
+import time
+import asyncio
+import base64
+import struct
+import hashlib
+import threading
 from typing import Optional
 from pydantic import BaseModel
 import logging
@@ -61,6 +81,74 @@ app.add_middleware(
 model = None
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# fp32, bf16_autocast or bf16; checked against fp32 on PRECISION_REFERENCE_DIR at startup
+precision = 'fp32'
+
+# Similar-case index, fed with penultimate-layer embeddings captured during the normal forward
+similarity_index = None
+_embedding_capture = threading.local()
+
+def embedding_layer(net):
+    # The 128-d ReLU before PneumoniaModel's output layer, CompactConvNet's pooled features
+    # or fc1 (512-d) for SimpleConvNet
+    if isinstance(net, PneumoniaModel):
+        return net.backbone.fc[4], 128
+    if isinstance(net, CompactConvNet):
+        return net.pool, 512
+    return net.fc1, 512
+
+def _capture_embedding(module, inputs, output):
+    _embedding_capture.value = output.detach()
+
+def last_embeddings():
+    # Embeddings of the most recent forward on this thread, shape (batch, dim)
+    value = _embedding_capture.value
+    return value.reshape(value.size(0), -1).float().cpu().numpy()
+
+# Class activation maps captured during the prediction forward (None if the architecture has no pooled head)
+activation_maps = None
+HEATMAP_MODES = ("grid", "overlay")
+
+# Perceptual-hash index of past uploads. Near-duplicates within PHASH_FLAG_DISTANCE bits are
+# flagged; within PHASH_REUSE_DISTANCE bits the earlier result is returned without inference
+# (disabled by default with -1).
+phash_index = None
+PHASH_FLAG_DISTANCE = int(os.getenv('PHASH_FLAG_DISTANCE', 4))
+PHASH_REUSE_DISTANCE = int(os.getenv('PHASH_REUSE_DISTANCE', -1))
+
+# Asynchronous /jobs/ API: urgent jobs go first, routine and bulk share the rest by weight, and
+# within a class clinics/doctors are served fairly so one back-fill cannot starve the others
+job_scheduler = None
+
+# /ws/stream: bulk uploads over one WebSocket into the job queue. Each binary frame is a 2-byte big-endian
+# header length, a UTF-8 JSON header ({"id": ..., "referenceNumber", "model", "heatmap"}) and the image
+# bytes. At most WS_WINDOW frames per connection are read before their results have been sent back.
+WS_WINDOW = int(os.getenv('WS_WINDOW', 16))
+WS_HEADER = struct.Struct(">H")
+
+# Models served on request (X-Model header or `model` form field), loaded lazily from the
+# MODEL_REGISTRY file under MODEL_MEMORY_BUDGET_MB; the startup model is registered, pinned, as "default"
+model_manager = None
+DEFAULT_MODEL = "default"
+
+# Registry models combined into one NORMAL/PNEUMONIA prediction (ENSEMBLE_CONFIG), served as model "ensemble"
+ensemble = None
+ENSEMBLE_MODEL = "ensemble"
+
+# Every prediction (and failed prediction) is queued for the write-behind audit log at AUDIT_LOG_PATH
+audit_log = None
+
+# Input/prediction statistics of the default model over the last DRIFT_WINDOW predictions,
+# compared on /drift with the training-set profile at DRIFT_REFERENCE
+drift_monitor = None
+drift_reference = None
+
+# Candidate checkpoint (SHADOW_MODEL: registry name or path) run on a sample of default-model traffic
+# by a background worker while no prediction is in flight; agreement and latency are reported on /shadow
+shadow = None
+_inflight = 0
+_inflight_lock = threading.Lock()
+
 class PredictionResponse(BaseModel):
     diagnosis: str
     confidence: float
@@ -70,10 +158,18 @@ class PredictionResponse(BaseModel):
     recommendedAction: str
     processingTime: float
     probabilities: dict
+    duplicateOf: Optional[str] = None
+    hammingDistance: Optional[int] = None
+    reusedResult: Optional[bool] = None
+    heatmap: Optional[list] = None
+    heatmapOverlay: Optional[str] = None
+    model: Optional[str] = None
+    ensemble: Optional[dict] = None
 
 @app.on_event("startup")
 async def startup_event():
-    global model
+    global model, similarity_index, phash_index, precision, activation_maps, job_scheduler, model_manager, audit_log
+    global drift_monitor, drift_reference, shadow, ensemble
     
     # Get model path from environment variable
     model_path_env = os.getenv('MODEL_PATH', 'best_model.pth')
@@ -117,38 +213,187 @@ async def startup_event():
     
     try:
         logger.info(f"Loading model from {model_path} using {device}")
-        # First try to load with PneumoniaModel
-        try:
-            logger.info("Attempting to load with PneumoniaModel...")
-            model = PneumoniaModel(pretrained=False, freeze_backbone=False)
-            state_dict = torch.load(model_path, map_location=device)
-            model.load_state_dict(state_dict)
-            model.to(device)
+        state_dict = torch.load(model_path, map_location=device)
+        # Try each architecture until one accepts the checkpoint's keys and shapes
+        candidates = [
+            ("PneumoniaModel", lambda: PneumoniaModel(pretrained=False, freeze_backbone=False)),
+            ("CompactConvNet", CompactConvNet),
+            ("SimpleConvNet", SimpleConvNet),
+        ]
+        for name, build in candidates:
+            try:
+                logger.info(f"Attempting to load with {name}...")
+                candidate = build()
+                candidate.load_state_dict(state_dict)
+            except Exception as e:
+                logger.error(f"Error loading with {name}: {e}")
+                continue
+            model = candidate.to(device)
             model.eval()
-            logger.info("Successfully loaded model with PneumoniaModel")
-        except Exception as e:
-            logger.error(f"Error loading with PneumoniaModel: {e}")
-            # Try SimpleConvNet as fallback
-            logger.info("Attempting to load with SimpleConvNet...")
-            model = SimpleConvNet()
-            state_dict = torch.load(model_path, map_location=device)
-            model.load_state_dict(state_dict)
-            model.to(device)
-            model.eval()
-            logger.info("Successfully loaded model with SimpleConvNet")
+            logger.info(f"Successfully loaded model with {name}")
+            break
+        else:
+            raise RuntimeError("Checkpoint does not match any known architecture")
     except Exception as e:
         logger.error(f"Error loading model: {e}")
         raise RuntimeError(f"Could not load the model: {e}")
+    
+    requested_precision = os.getenv('INFERENCE_PRECISION', 'fp32')
+    allow_emulated = os.getenv('PRECISION_ALLOW_EMULATED') == '1'
+    reference = None
+    if requested_precision != 'fp32':
+        reference_dir = os.getenv('PRECISION_REFERENCE_DIR')
+        reference = load_reference_batch(reference_dir, image_transform) if reference_dir else None
+        precision = select_precision(model, requested_precision, reference, allow_emulated=allow_emulated)
+    logger.info(f"Inference precision: {precision}")
+    
+    try:
+        activation_maps = ActivationMaps(model)
+    except ValueError as e:
+        logger.warning(f"Heatmaps disabled: {e}")
+    
+    def prepare_model(entry):
+        # Registry models get the same precision check and heatmap hooks as the default model
+        entry.model.to(device)
+        entry.extras["precision"] = 'fp32'
+        if requested_precision != 'fp32':
+            entry.extras["precision"] = select_precision(entry.model, requested_precision, reference,
+                                                         allow_emulated=allow_emulated)
+        try:
+            entry.extras["activation_maps"] = ActivationMaps(entry.model)
+        except ValueError as e:
+            logger.warning(f"Heatmaps disabled for {entry.name}: {e}")
+        logger.info(f"Loaded model {entry.name} from {entry.path}")
+    
+    model_manager = ModelManager(int(float(os.getenv('MODEL_MEMORY_BUDGET_MB', 4096)) * 2 ** 20),
+                                 prepare=prepare_model,
+                                 hot_requests=int(os.getenv('MODEL_HOT_REQUESTS', 20)),
+                                 hot_window=float(os.getenv('MODEL_HOT_WINDOW', 300)))
+    model_manager.register_loaded(DEFAULT_MODEL, model, list(BINARY_CLASSES), version=checkpoint_version(model_path),
+                                  precision=precision)
+    registry_path = os.getenv('MODEL_REGISTRY')
+    if registry_path:
+        try:
+            model_manager.load_registry(registry_path)
+            logger.info(f"Registered models from {registry_path}: {', '.join(model_manager.entries)}")
+        except Exception as e:
+            logger.error(f"Model registry {registry_path} not loaded: {e}")
+    
+    ensemble_path = os.getenv('ENSEMBLE_CONFIG')
+    if ensemble_path:
+        try:
+            ensemble = Ensemble.from_config(model_manager, ensemble_path, device=device)
+            logger.info("Ensemble of " + ", ".join(f"{m.model} (weight {m.weight}, {m.threads} threads)"
+                                                   for m in ensemble.members))
+        except Exception as e:
+            logger.error(f"Ensemble {ensemble_path} disabled: {e}")
+            ensemble = None
+    
+    # Similar-case retrieval is optional; the API keeps working without it
+    layer, dim = embedding_layer(model)
+    layer.register_forward_hook(_capture_embedding)
+    try:
+        index_dir = os.getenv('SIMILARITY_INDEX_DIR', 'similarity_index')
+        similarity_index = SimilarityIndex(index_dir, dim=dim)
+        logger.info(f"Loaded similarity index from {index_dir}: {similarity_index.stats()}")
+    except Exception as e:
+        logger.error(f"Similarity index disabled: {e}")
+        similarity_index = None
+    
+    try:
+        phash_path = os.getenv('PHASH_INDEX_PATH', 'phash_index.jsonl')
+        phash_index = PHashIndex(phash_path)
+        logger.info(f"Loaded perceptual hash index from {phash_path} with {len(phash_index)} entries")
+    except Exception as e:
+        logger.error(f"Near-duplicate detection disabled: {e}")
+        phash_index = None
+    
+    drift_monitor = DriftMonitor(BINARY_CLASSES, window=int(os.getenv('DRIFT_WINDOW', 2000)),
+                                 buckets=int(os.getenv('DRIFT_BUCKETS', 10)))
+    reference_path = os.getenv('DRIFT_REFERENCE', 'drift_reference.json')
+    if os.path.exists(reference_path):
+        try:
+            drift_reference = load_reference(reference_path)
+            logger.info(f"Loaded drift reference profile of {drift_reference['count']} images from {reference_path}")
+        except Exception as e:
+            logger.error(f"Drift reference {reference_path} not loaded: {e}")
+    
+    shadow_model = os.getenv('SHADOW_MODEL')
+    if shadow_model:
+        try:
+            if shadow_model not in model_manager:
+                model_manager.register("shadow", shadow_model, arch=os.getenv('SHADOW_ARCH', 'auto'), pinned=True)
+                shadow_model = "shadow"
+            shadow = ShadowEvaluator(model_manager, shadow_model, BINARY_CLASSES,
+                                     primary_version=model_manager.entries[DEFAULT_MODEL].version,
+                                     load=primary_load,
+                                     sample_rate=float(os.getenv('SHADOW_SAMPLE_RATE', 0.1)),
+                                     max_queue=int(os.getenv('SHADOW_MAX_QUEUE', 16)),
+                                     max_load=int(os.getenv('SHADOW_MAX_LOAD', 2)),
+                                     max_age=float(os.getenv('SHADOW_MAX_AGE', 30)),
+                                     report_path=os.getenv('SHADOW_REPORT_PATH', 'shadow_report.json'),
+                                     report_interval=float(os.getenv('SHADOW_REPORT_SECONDS', 30)),
+                                     threads=int(os.getenv('SHADOW_THREADS', 1)))
+            shadow.start()
+            logger.info(f"Shadowing {shadow.sample_rate:.0%} of default-model traffic with {shadow_model}")
+        except Exception as e:
+            logger.error(f"Shadow evaluation disabled: {e}")
+            shadow = None
+    
+    audit_path = os.getenv('AUDIT_LOG_PATH', 'audit_log')
+    if audit_path:
+        try:
+            audit_log = AuditLog(audit_path,
+                                 batch_size=int(os.getenv('AUDIT_BATCH_SIZE', 256)),
+                                 flush_interval=float(os.getenv('AUDIT_FLUSH_SECONDS', 1.0)),
+                                 fsync=os.getenv('AUDIT_FSYNC', 'interval'),
+                                 fsync_interval=float(os.getenv('AUDIT_FSYNC_SECONDS', 5.0)),
+                                 max_queue=int(os.getenv('AUDIT_MAX_QUEUE', 10000)),
+                                 block_timeout=float(os.getenv('AUDIT_BLOCK_SECONDS', 5.0)))
+            audit_log.start()
+            logger.info(f"Auditing predictions to {audit_path}")
+        except Exception as e:
+            logger.error(f"Audit log disabled: {e}")
+            audit_log = None
+    
+    job_scheduler = JobScheduler(
+        lambda payload: analyze_image(**payload),
+        num_workers=int(os.getenv('JOB_WORKERS', 1)),
+        max_queued=int(os.getenv('JOB_MAX_QUEUED', 10000)),
+        retention=int(os.getenv('JOB_RETENTION_SECONDS', 3600)),
+        class_weights=json.loads(os.getenv('JOB_CLASS_WEIGHTS', '{}')),
+        tenant_weights=json.loads(os.getenv('JOB_TENANT_WEIGHTS', '{}'))
+    )
+    job_scheduler.start()
+    logger.info(f"Started {len(job_scheduler.workers)} job worker(s)")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if job_scheduler is not None:
+        job_scheduler.stop()
+    if shadow is not None:
+        shadow.close()
+    if ensemble is not None:
+        ensemble.close()
+    # After the workers, so the jobs they finished are audited too
+    if audit_log is not None:
+        audit_log.close()
+
+image_transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+])
+
+# Upload types accepted besides image/*; DICOM often arrives as octet-stream
+DICOM_CONTENT_TYPES = ("application/dicom", "application/octet-stream")
+
+def decode_image(image_bytes):
+    # DICOM and 16-bit PNG/TIFF are windowed and reduced while decoding; 8-bit JPEG/PNG decode exactly as before
+    return load_xray(image_bytes)
 
 def preprocess_image(image_bytes):
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    ])
-    
-    image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-    return transform(image).unsqueeze(0)  # Add batch dimension
+    return image_transform(decode_image(image_bytes)).unsqueeze(0)  # Add batch dimension
 
 @app.get("/")
 def read_root():
@@ -170,6 +415,7 @@ def read_root():
         "python_version": python_version,
         "model_status": model_status,
         "device": str(device),
+        "precision": precision,
         "current_directory": os.getcwd(),
         "directory_contents": dir_contents,
         "environment_variables": {
@@ -184,90 +430,591 @@ def health_check():
         raise HTTPException(status_code=503, detail="Model not loaded")
     return {"status": "healthy", "model_loaded": True}
 
+def check_prediction_request(file, heatmap, model_name=None):
+    # Check if file is an image
+    if not (file.content_type.startswith("image/") or file.content_type in DICOM_CONTENT_TYPES):
+        raise HTTPException(status_code=400, detail="File must be an image or DICOM")
+    check_prediction_options(heatmap, model_name)
+
+def check_prediction_options(heatmap, model_name=None):
+    if model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
+    if model_name == ENSEMBLE_MODEL and ensemble is not None:
+        if heatmap is not None:
+            raise HTTPException(status_code=400, detail="Heatmaps are not available for the ensemble")
+    elif model_name is not None and model_name not in model_manager:
+        raise HTTPException(status_code=404, detail=f"Unknown model {model_name}; see /models")
+    
+    if heatmap is not None and heatmap not in HEATMAP_MODES:
+        raise HTTPException(status_code=400, detail=f"heatmap must be one of {', '.join(HEATMAP_MODES)}")
+    if heatmap is not None and activation_maps is None and model_name in (None, DEFAULT_MODEL):
+        raise HTTPException(status_code=400, detail="Heatmaps are not available for the loaded model")
+
+def primary_load():
+    """Predictions in progress plus jobs waiting; the shadow model only runs when this is 0"""
+    return _inflight + (job_scheduler.queued() if job_scheduler is not None else 0)
+
+def analyze_image(image_bytes, reference_number=None, heatmap=None, start_time=None, model_name=None,
+                  audit_context=None):
+    """Diagnose one uploaded image with the default or a registry model; shared by /predict/ and the job workers"""
+    global _inflight
+    with _inflight_lock:
+        _inflight += 1
+    try:
+        return _analyze_image(image_bytes, reference_number, heatmap, start_time, model_name, audit_context)
+    finally:
+        with _inflight_lock:
+            _inflight -= 1
+
+def _analyze_image(image_bytes, reference_number, heatmap, start_time, model_name, audit_context):
+    if start_time is None:
+        start_time = time.time()
+    
+    try:
+        if model_name == ENSEMBLE_MODEL and ensemble is not None:
+            result = analyze_with_ensemble(image_bytes, start_time)
+            name = ENSEMBLE_MODEL
+        else:
+            # Holding the model keeps it from being evicted mid-request
+            with model_manager.acquire(model_name or DEFAULT_MODEL) as entry:
+                if entry.name == DEFAULT_MODEL:
+                    result = analyze_with_default(image_bytes, reference_number, heatmap, start_time)
+                else:
+                    result = analyze_with_model(entry, image_bytes, heatmap, start_time)
+            name = entry.name
+    except Exception as e:
+        try:
+            audit_prediction(image_bytes, reference_number, model_name, start_time, audit_context, error=e)
+        except AuditBackpressure as audit_error:
+            logger.error(f"Failed prediction not audited: {audit_error}")
+        raise
+    result["model"] = name
+    # Raises AuditBackpressure if the log has fallen behind: no result leaves without its audit entry
+    audit_prediction(image_bytes, reference_number, model_name, start_time, audit_context, result=result)
+    return result
+
+def audit_prediction(image_bytes, reference_number, model_name, start_time, context, result=None, error=None):
+    if audit_log is None:
+        return
+    name = model_name or DEFAULT_MODEL
+    entry = model_manager.entries.get(name)
+    version = entry.version if entry is not None else None
+    if name == ENSEMBLE_MODEL and ensemble is not None:
+        version = ensemble.version()
+    record = {
+        "referenceNumber": reference_number,
+        "inputSha256": hashlib.sha256(image_bytes).hexdigest(),
+        "inputBytes": len(image_bytes),
+        "model": name,
+        "modelVersion": version,
+        "precision": precision if name == DEFAULT_MODEL else (entry.extras.get("precision") if entry else None),
+        "status": "ok" if error is None else "error",
+        "totalTime": round(time.time() - start_time, 4),
+    }
+    if result is not None:
+        record.update(diagnosis=result["diagnosis"], confidence=result["confidence"],
+                      probabilities=result["probabilities"], processingTime=result["processingTime"],
+                      reusedResult=result.get("reusedResult", False), duplicateOf=result.get("duplicateOf"))
+    if error is not None:
+        record["error"] = str(getattr(error, "detail", error))
+    record.update(context or {})
+    audit_log.record(**record)
+
+def binary_result(probs, predicted_class, start_time):
+    # Process results
+    diagnosis = "Pneumonia" if predicted_class == 1 else "Normal"
+    confidence = float(probs[predicted_class]) * 100
+    
+    # Create result dictionary
+    result = {
+        "diagnosis": diagnosis,
+        "confidence": round(confidence, 2),
+        "processingTime": round(time.time() - start_time, 2),
+        "probabilities": {
+            "normal": round(float(probs[0]) * 100, 2),
+            "pneumonia": round(float(probs[1]) * 100, 2)
+        }
+    }
+    
+    # Add pneumonia specific info if positive
+    if diagnosis == "Pneumonia":
+        # Determine pneumonia type based on confidence
+        pneumonia_type = "Bacterial" if confidence > 75 else "Viral"
+        # Determine severity based on confidence
+        if confidence > 90:
+            severity = "Severe"
+            severity_desc = "Severe pneumonia with significant lung involvement."
+            action = "Immediate medical consultation and treatment recommended."
+        elif confidence > 80:
+            severity = "Moderate"
+            severity_desc = "Moderate pneumonia with partial lung involvement."
+            action = "Medical consultation recommended to determine appropriate treatment."
+        else:
+            severity = "Mild"
+            severity_desc = "Mild pneumonia with limited lung involvement."
+            action = "Monitor symptoms and consult with a healthcare provider."
+            
+        result["pneumoniaType"] = pneumonia_type
+        result["severity"] = severity
+        result["severityDescription"] = severity_desc
+        result["recommendedAction"] = action
+    else:
+        result["recommendedAction"] = "No pneumonia detected. Regular health maintenance recommended."
+    
+    return result
+
+def multiclass_result(probs, class_names, start_time):
+    # For the 6-class EfficientNet and other non-binary registry models
+    predicted_class = int(probs.argmax())
+    name = class_names[predicted_class]
+    result = {
+        "diagnosis": name.replace("_", " ").title(),
+        "confidence": round(float(probs[predicted_class]) * 100, 2),
+        "processingTime": round(time.time() - start_time, 2),
+        "probabilities": {c.lower(): round(float(p) * 100, 2) for c, p in zip(class_names, probs)}
+    }
+    if name.endswith("_PNEUMONIA"):
+        result["pneumoniaType"] = name.split("_")[0].title()
+    if name == "NORMAL":
+        result["recommendedAction"] = "No pneumonia detected. Regular health maintenance recommended."
+    elif name == "NON_XRAY":
+        result["recommendedAction"] = "The image does not appear to be a chest X-ray. Please upload a chest X-ray."
+    else:
+        result["recommendedAction"] = "Medical consultation recommended to confirm the finding."
+    return result
+
+def add_heatmap(result, image, heat, heatmap):
+    if heatmap == "grid":
+        result["heatmap"] = np.round(heat, 3).tolist()
+    elif heatmap == "overlay":
+        # Resize((224, 224)) keeps the whole film, so the map lines up with the full image
+        result["heatmapOverlay"] = base64.b64encode(overlay_png(image, heat)).decode("ascii")
+
+def analyze_with_model(entry, image_bytes, heatmap, start_time):
+    """Registry models: plain inference, without near-duplicate reuse or similar-case indexing,
+    which are tied to the default model's results and embeddings"""
+    maps = entry.extras.get("activation_maps")
+    if heatmap is not None and maps is None:
+        raise HTTPException(status_code=400, detail=f"Heatmaps are not available for model {entry.name}")
+    
+    image = decode_image(image_bytes)
+    image_tensor = image_transform(image).unsqueeze(0).to(device)
+    with torch.no_grad():
+        outputs = run_model(entry.model, image_tensor, entry.extras.get("precision", 'fp32'))
+        probs = torch.nn.functional.softmax(outputs, dim=1)[0].cpu().numpy()
+    predicted_class = int(probs.argmax())
+    
+    if list(entry.classes) == BINARY_CLASSES:
+        result = binary_result(probs, predicted_class, start_time)
+    else:
+        result = multiclass_result(probs, entry.classes, start_time)
+    if heatmap is not None:
+        add_heatmap(result, image, maps.heatmaps([predicted_class])[0], heatmap)
+    return result
+
+def analyze_with_ensemble(image_bytes, start_time):
+    """One decode shared by all members, whose forwards run concurrently"""
+    decode_start = time.perf_counter()
+    image = decode_image(image_bytes)
+    decode_ms = (time.perf_counter() - decode_start) * 1000
+    probs, details = ensemble.predict(image)
+    result = binary_result(probs, int(probs.argmax()), start_time)
+    details["decodeMs"] = round(decode_ms, 2)
+    result["ensemble"] = details
+    return result
+
+def analyze_with_default(image_bytes, reference_number, heatmap, start_time):
+    image = decode_image(image_bytes)
+    
+    # Look for an earlier upload of the same film
+    image_hash = None
+    duplicate = None
+    if phash_index is not None:
+        image_hash = phash(image)
+        duplicate = phash_index.nearest(image_hash, max(PHASH_FLAG_DISTANCE, PHASH_REUSE_DISTANCE))
+    # A reused result has no forward pass to take a heatmap from
+    if (duplicate is not None and duplicate[0] <= PHASH_REUSE_DISTANCE and duplicate[1].get("result")
+            and heatmap is None):
+        distance, entry = duplicate
+        result = dict(entry["result"])
+        result.update(duplicateOf=entry.get("reference_number"), hammingDistance=distance, reusedResult=True,
+                      processingTime=round(time.time() - start_time, 2))
+        logger.info(f"Reusing result of {entry.get('reference_number')} (distance {distance})")
+        if similarity_index is not None and reference_number and entry.get("reference_number"):
+            prior_embedding = similarity_index.vector_for(entry["reference_number"])
+            if prior_embedding is not None:
+                similarity_index.add(reference_number, prior_embedding, diagnosis=result["diagnosis"],
+                                     confidence=result["confidence"])
+        return result
+    
+    # Preprocess the image
+    image_tensor = image_transform(image).unsqueeze(0)
+    image_tensor = image_tensor.to(device)
+    
+    # Make prediction
+    forward_start = time.perf_counter()
+    with torch.no_grad():
+        outputs = run_model(model, image_tensor, precision)
+        probabilities = torch.nn.functional.softmax(outputs, dim=1)
+        predicted_class = torch.max(outputs, 1)[1].item()
+    
+    # Convert to numpy for easier handling
+    probs = probabilities[0].cpu().numpy()
+    forward_ms = (time.perf_counter() - forward_start) * 1000
+    if shadow is not None:
+        # Only queues the tensor; the shadow forward happens once no prediction is in flight
+        shadow.offer(image_tensor, probs, forward_ms, reference_number)
+    try:
+        drift_monitor.update(image_tensor.cpu(), [image.info.get("original_size", image.size)], probs[None])
+    except Exception as e:
+        logger.warning(f"Drift monitor update failed: {e}")
+    embedding = last_embeddings()[0]
+    if heatmap is not None:
+        heat = activation_maps.heatmaps([predicted_class])[0]
+    
+    result = binary_result(probs, predicted_class, start_time)
+    diagnosis = result["diagnosis"]
+    
+    if similarity_index is not None and reference_number:
+        try:
+            similarity_index.add(reference_number, embedding, diagnosis=diagnosis, confidence=result["confidence"])
+        except Exception as e:
+            logger.error(f"Failed to index scan {reference_number}: {e}")
+    
+    if phash_index is not None:
+        phash_index.add(image_hash, reference_number=reference_number, result=dict(result))
+        if duplicate is not None and duplicate[0] <= PHASH_FLAG_DISTANCE:
+            result["duplicateOf"] = duplicate[1].get("reference_number")
+            result["hammingDistance"] = duplicate[0]
+    
+    # Added after indexing so stored results stay small
+    if heatmap is not None:
+        add_heatmap(result, image, heat, heatmap)
+    
+    return result
+
 @app.post("/predict/", response_model=PredictionResponse)
 async def predict(
     file: UploadFile = File(...),
     patient_name: Optional[str] = Form(None),
     patient_age: Optional[str] = Form(None),
     patient_gender: Optional[str] = Form(None),
-    reference_number: Optional[str] = Form(None)
+    reference_number: Optional[str] = Form(None),
+    heatmap: Optional[str] = Form(None),
+    model_name: Optional[str] = Form(None, alias="model"),
+    x_model: Optional[str] = Header(None)
 ):
     import time
     start_time = time.time()
     
-    if model is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
-    
-    # Check if file is an image
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="File must be an image")
+    model_name = model_name or x_model
+    check_prediction_request(file, heatmap, model_name)
     
     # Read image bytes
     image_bytes = await file.read()
     
     try:
-        # Preprocess the image
-        image_tensor = preprocess_image(image_bytes)
-        image_tensor = image_tensor.to(device)
-        
-        # Make prediction
-        with torch.no_grad():
-            outputs = model(image_tensor)
-            probabilities = torch.nn.functional.softmax(outputs, dim=1)
-            predicted_class = torch.max(outputs, 1)[1].item()
-        
-        # Convert to numpy for easier handling
-        probs = probabilities[0].cpu().numpy()
-        
-        # Process results
-        diagnosis = "Pneumonia" if predicted_class == 1 else "Normal"
-        confidence = float(probs[predicted_class]) * 100
-        
-        # Create result dictionary
-        result = {
-            "diagnosis": diagnosis,
-            "confidence": round(confidence, 2),
-            "processingTime": round(time.time() - start_time, 2),
-            "probabilities": {
-                "normal": round(float(probs[0]) * 100, 2),
-                "pneumonia": round(float(probs[1]) * 100, 2)
-            }
-        }
-        
-        # Add pneumonia specific info if positive
-        if diagnosis == "Pneumonia":
-            # Determine pneumonia type based on confidence
-            pneumonia_type = "Bacterial" if confidence > 75 else "Viral"
-            # Determine severity based on confidence
-            if confidence > 90:
-                severity = "Severe"
-                severity_desc = "Severe pneumonia with significant lung involvement."
-                action = "Immediate medical consultation and treatment recommended."
-            elif confidence > 80:
-                severity = "Moderate"
-                severity_desc = "Moderate pneumonia with partial lung involvement."
-                action = "Medical consultation recommended to determine appropriate treatment."
-            else:
-                severity = "Mild"
-                severity_desc = "Mild pneumonia with limited lung involvement."
-                action = "Monitor symptoms and consult with a healthcare provider."
-                
-            result["pneumoniaType"] = pneumonia_type
-            result["severity"] = severity
-            result["severityDescription"] = severity_desc
-            result["recommendedAction"] = action
-        else:
-            result["recommendedAction"] = "No pneumonia detected. Regular health maintenance recommended."
-        
-        return result
+        # Inference and the audit record (which blocks while the log is behind) run off the event loop,
+        # so they never stall other connections
+        return await run_in_threadpool(analyze_image, image_bytes, reference_number, heatmap, start_time,
+                                       model_name, audit_context={"endpoint": "predict"})
         
+    except HTTPException:
+        raise
+    except AuditBackpressure as e:
+        logger.error(f"Audit log behind: {e}")
+        raise HTTPException(status_code=503, detail="Audit log is behind; retry shortly")
+    except (UnsupportedImage, Image.UnidentifiedImageError) as e:
+        raise HTTPException(status_code=415, detail=f"Unsupported image: {e}")
+    except MemoryError as e:
+        logger.error(f"Cannot load model {model_name}: {e}")
+        raise HTTPException(status_code=503, detail=f"Model {model_name} cannot be loaded right now: {e}")
     except Exception as e:
         logger.error(f"Error during prediction: {e}")
         raise HTTPException(status_code=500, detail=f"Error during prediction: {str(e)}")
 
+@app.post("/jobs/", status_code=202)
+async def submit_job(
+    file: UploadFile = File(...),
+    priority: str = Form("routine"),
+    clinic_id: Optional[str] = Form(None),
+    doctor_id: Optional[str] = Form(None),
+    patient_name: Optional[str] = Form(None),
+    patient_age: Optional[str] = Form(None),
+    patient_gender: Optional[str] = Form(None),
+    reference_number: Optional[str] = Form(None),
+    heatmap: Optional[str] = Form(None),
+    model_name: Optional[str] = Form(None, alias="model"),
+    x_model: Optional[str] = Header(None)
+):
+    """Queue a prediction; poll /jobs/{id} or stream /jobs/{id}/events for the result"""
+    if job_scheduler is None:
+        raise HTTPException(status_code=503, detail="Job queue not running")
+    model_name = model_name or x_model
+    check_prediction_request(file, heatmap, model_name)
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(PRIORITIES)}")
+    
+    # Fairness is keyed by clinic when given, otherwise by doctor
+    tenant = f"clinic:{clinic_id}" if clinic_id else (f"doctor:{doctor_id}" if doctor_id else "anonymous")
+    payload = {"image_bytes": await file.read(), "reference_number": reference_number, "heatmap": heatmap,
+               "model_name": model_name,
+               "audit_context": {"endpoint": "jobs", "priority": priority, "tenant": tenant}}
+    try:
+        job = job_scheduler.submit(payload, priority, tenant)
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail=f"Job queue full: {e}")
+    info = job.to_dict()
+    info["queuePosition"] = job_scheduler.position(job)
+    return info
+
+def parse_stream_frame(data):
+    """Split a /ws/stream binary frame into its JSON header and the image bytes"""
+    if len(data) < WS_HEADER.size:
+        raise ValueError("Frame is shorter than its header length")
+    (size,) = WS_HEADER.unpack_from(data)
+    if len(data) < WS_HEADER.size + size:
+        raise ValueError("Frame is shorter than its header")
+    header = json.loads(data[WS_HEADER.size:WS_HEADER.size + size].decode("utf-8"))
+    if not isinstance(header, dict) or "id" not in header:
+        raise ValueError('Header must be a JSON object with an "id"')
+    image_bytes = data[WS_HEADER.size + size:]
+    if not image_bytes:
+        raise ValueError("Frame has no image data")
+    return header, image_bytes
+
+@app.websocket("/ws/stream")
+async def stream_predictions(
+    websocket: WebSocket,
+    priority: str = Query("bulk"),
+    clinic_id: Optional[str] = Query(None),
+    doctor_id: Optional[str] = Query(None),
+    window: Optional[int] = Query(None),
+    model_name: Optional[str] = Query(None, alias="model")
+):
+    """Stream images in and results out on one connection.
+    
+    Server messages (JSON text): ready {window}, accepted {id, jobId}, result {id, jobId, status,
+    result | error, ...}, error {id, error} for frames that were not queued, and done {submitted} after
+    the client sends {"type": "end"} and every result has gone out. Results come back in completion order.
+    """
+    await websocket.accept()
+    if job_scheduler is None:
+        await websocket.close(code=1013, reason="Job queue not running")
+        return
+    if priority not in PRIORITIES:
+        await websocket.close(code=1008, reason=f"priority must be one of {', '.join(PRIORITIES)}")
+        return
+    tenant = f"clinic:{clinic_id}" if clinic_id else (f"doctor:{doctor_id}" if doctor_id else "anonymous")
+    window = max(1, min(window or WS_WINDOW, WS_WINDOW))
+    # A slot is taken before reading a frame and given back when its result (or error) is sent, so a fast
+    # uploader is held back by TCP flow control instead of piling frames up in memory
+    slots = asyncio.BoundedSemaphore(window)
+    outbox = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    outstanding = 0
+    submitted = 0
+    ending = False
+    
+    def on_done(job, client_id):
+        message = dict(job.to_dict(), type="result", id=client_id)
+        loop.call_soon_threadsafe(outbox.put_nowait, message)
+    
+    async def send_messages():
+        nonlocal outstanding
+        while not (ending and outstanding == 0):
+            message = await outbox.get()
+            if message is None:
+                continue
+            await websocket.send_json(message)
+            if message["type"] in ("result", "error"):
+                # Every frame read holds one slot until exactly one result or error has gone out
+                outstanding -= 1
+                slots.release()
+        await websocket.send_json({"type": "done", "submitted": submitted})
+    
+    async def take_slot():
+        """Wait for a free slot; False if the sender stopped (connection broken) first"""
+        acquire = asyncio.ensure_future(slots.acquire())
+        await asyncio.wait({acquire, sender}, return_when=asyncio.FIRST_COMPLETED)
+        if acquire.done():
+            return not sender.done()
+        acquire.cancel()
+        return False
+    
+    await websocket.send_json({"type": "ready", "window": window, "priority": priority, "tenant": tenant})
+    sender = asyncio.create_task(send_messages())
+    try:
+        while True:
+            if not await take_slot():
+                break
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            outstanding += 1
+            if message.get("text") is not None:
+                try:
+                    control = json.loads(message["text"])
+                except ValueError:
+                    control = None
+                if isinstance(control, dict) and control.get("type") == "end":
+                    # The end frame gets no reply of its own, so its slot goes straight back
+                    outstanding -= 1
+                    slots.release()
+                    ending = True
+                    outbox.put_nowait(None)
+                    await sender
+                    await websocket.close()
+                    return
+                outbox.put_nowait({"type": "error", "id": None, "error": 'Text frames must be {"type": "end"}'})
+                continue
+            
+            client_id = None
+            try:
+                header, image_bytes = parse_stream_frame(message["bytes"])
+                client_id = header["id"]
+                frame_model = header.get("model", model_name)
+                heatmap = header.get("heatmap")
+                check_prediction_options(heatmap, frame_model)
+                payload = {"image_bytes": image_bytes, "reference_number": header.get("referenceNumber"),
+                           "heatmap": heatmap, "model_name": frame_model,
+                           "audit_context": {"endpoint": "ws", "priority": priority, "tenant": tenant,
+                                             "clientId": client_id}}
+                job = job_scheduler.submit(payload, priority, tenant)
+            except (ValueError, HTTPException, QueueFull) as e:
+                outbox.put_nowait({"type": "error", "id": client_id, "error": str(getattr(e, "detail", e))})
+                continue
+            submitted += 1
+            outbox.put_nowait({"type": "accepted", "id": client_id, "jobId": job.id})
+            job.add_done_callback(lambda job, client_id=client_id: on_done(job, client_id))
+    except WebSocketDisconnect:
+        pass
+    # Jobs already queued still run and stay available on /jobs/{jobId}
+    sender.cancel()
+
+@app.get("/models")
+def list_models():
+    """Registered models with resident size, load/eviction counts and usage"""
+    if model_manager is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    stats = model_manager.stats()
+    if ensemble is not None:
+        stats["ensemble"] = {m.model: {"weight": m.weight, "threads": m.threads, "transform": m.transform}
+                             for m in ensemble.members}
+    return stats
+
+@app.get("/drift")
+def drift():
+    """Current window of input and prediction statistics scored against the reference profile (PSI / KS)"""
+    if drift_monitor is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    return drift_monitor.compare(drift_reference)
+
+@app.get("/shadow")
+def shadow_report():
+    """Agreement, per-class disagreement and latency of the shadow model against the default model"""
+    if shadow is None:
+        raise HTTPException(status_code=503, detail="Shadow evaluation disabled")
+    return shadow.report()
+
+@app.get("/audit/stats")
+def audit_stats():
+    if audit_log is None:
+        raise HTTPException(status_code=503, detail="Audit log disabled")
+    return audit_log.stats()
+
+@app.get("/jobs/metrics")
+def job_metrics():
+    if job_scheduler is None:
+        raise HTTPException(status_code=503, detail="Job queue not running")
+    return job_scheduler.metrics()
+
+def _get_job(job_id):
+    job = job_scheduler.get(job_id) if job_scheduler is not None else None
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    return _get_job(job_id).to_dict()
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events: a status event on every change, then one result event"""
+    job = _get_job(job_id)
+    
+    async def stream():
+        last_status = None
+        idle = 0.0
+        while True:
+            status = job.status
+            if status != last_status:
+                yield f"event: status\ndata: {json.dumps({'jobId': job.id, 'status': status})}\n\n"
+                last_status = status
+                idle = 0.0
+            if job.done.is_set():
+                yield f"event: result\ndata: {json.dumps(job.to_dict())}\n\n"
+                return
+            if idle >= 15:
+                # Comment line keeps proxies from closing a quiet connection
+                yield ": keep-alive\n\n"
+                idle = 0.0
+            await asyncio.sleep(0.2)
+            idle += 0.2
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def image_embedding(image_bytes):
+    # Decode, forward and read the capture on one thread: the embedding capture is thread-local
+    image_tensor = preprocess_image(image_bytes).to(device)
+    with torch.no_grad():
+        run_model(model, image_tensor, precision)
+    return last_embeddings()[0]
+
+@app.post("/similar/")
+async def similar(
+    file: Optional[UploadFile] = File(None),
+    reference_number: Optional[str] = Form(None),
+    k: int = Form(5)
+):
+    """Most similar previously diagnosed scans, queried by image or by an indexed reference number"""
+    import time
+    start_time = time.time()
+    
+    if similarity_index is None:
+        raise HTTPException(status_code=503, detail="Similarity index not available")
+    
+    if file is not None:
+        if model is None:
+            raise HTTPException(status_code=503, detail="Model not loaded")
+        try:
+            query = await run_in_threadpool(image_embedding, await file.read())
+        except Exception as e:
+            logger.error(f"Error computing embedding: {e}")
+            raise HTTPException(status_code=500, detail=f"Error computing embedding: {str(e)}")
+    elif reference_number:
+        query = similarity_index.vector_for(reference_number)
+        if query is None:
+            raise HTTPException(status_code=404, detail=f"Scan {reference_number} is not indexed")
+    else:
+        raise HTTPException(status_code=400, detail="Provide an image file or a reference_number")
+    
+    search_start = time.time()
+    results = await run_in_threadpool(similarity_index.search, query, k=max(1, min(k, 100)), exclude=reference_number)
+    return {
+        "results": results,
+        "searchTime": round((time.time() - search_start) * 1000, 2),
+        "processingTime": round(time.time() - start_time, 2),
+        "indexedScans": len(similarity_index)
+    }
+
 if __name__ == "__main__":
     # Get port from environment variable or use default 8000
     port = int(os.getenv("PORT", 8000))
+    # Uncompressed DICOM frames on /ws/stream run to tens of MB
+    ws_max_size = int(float(os.getenv("WS_MAX_FRAME_MB", 64)) * 2 ** 20)
     
     # Print diagnostic information
     print(f"Starting server on port {port}")
@@ -277,14 +1024,15 @@ if __name__ == "__main__":
     print(f"Working directory: {os.getcwd()}")
     
     try:
-        uvicorn.run("app:app", host="0.0.0.0", port=port, log_level="info")
+        uvicorn.run("app:app", host="0.0.0.0", port=port, log_level="info", ws_max_size=ws_max_size)
     except Exception as e:
         print(f"Error starting server: {e}")
         # Try alternative method
         print("Trying alternative method...")
         import subprocess
         try:
-            subprocess.check_call([sys.executable, "-m", "uvicorn", "app:app", "--host", "0.0.0.0", "--port", str(port)])
+            subprocess.check_call([sys.executable, "-m", "uvicorn", "app:app", "--host", "0.0.0.0", "--port", str(port),
+                                   "--ws-max-size", str(ws_max_size)])
         except Exception as alt_e:
             print(f"Alternative method failed: {alt_e}")
             print("Exiting with error.")
@@ -0,0 +1,477 @@
+"""
+Write-behind audit log of predictions.
+
+Request handlers call AuditLog.record(), which only puts the entry on a
+bounded in-memory queue. A writer thread drains the queue in batches and
+appends them to disk, either as JSONL, one file per UTC day:
+
+    audit_log/2026-10-19.jsonl
+
+or, when the path ends in .db/.sqlite, as rows of an SQLite table indexed by
+time and reference number. A batch is written when batch_size entries are
+waiting or flush_interval seconds after its first entry. The fsync policy
+decides when written data is forced to disk:
+
+    always    after every batch (sqlite: synchronous=FULL)
+    interval  at most every fsync_interval seconds (sqlite: synchronous=NORMAL)
+    never     left to the OS (sqlite: synchronous=OFF)
+
+If the disk falls behind, the queue fills and record() blocks for up to
+block_timeout seconds before raising AuditBackpressure, so callers slow
+down instead of losing entries. A failed write is retried with backoff
+until it succeeds, or, once close() has been called, until its timeout runs
+out; whatever is still unwritten then is dropped and counted.
+
+A JSONL day file whose last line was torn by a crash is cut back to its last
+complete line before new entries are appended to it.
+
+Reading is done by date range and/or reference number:
+
+    python audit_log.py --log audit_log --date 2026-10-19
+    python audit_log.py --log audit_log --reference CXR-1042
+    python audit_log.py --log audit.db --since 2026-10-01 --until 2026-10-07T12:00 --count
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import sqlite3
+import argparse
+import threading
+from datetime import datetime, timezone, timedelta
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+_STOP = object()
+
+
+class AuditBackpressure(Exception):
+    pass
+
+
+class PartialWrite(Exception):
+    """A sink wrote the first `written` entries of a batch before failing; only the rest is retried."""
+    def __init__(self, written, cause):
+        super().__init__(f'{written} entries written before: {cause}')
+        self.written = written
+
+
+def _utc(ts):
+    return datetime.fromtimestamp(ts, timezone.utc)
+
+
+def _repair_tail(path):
+    """Cut a torn last line (a crash mid-write) so the next entry starts on a line of its own."""
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    if size == 0:
+        return
+    with open(path, 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) == b'\n':
+            return
+        keep = 0
+        end = size
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                keep = start + newline + 1
+                break
+            end = start
+        f.truncate(keep)
+    print(f'Audit log {path}: dropped a torn last line of {size - keep} bytes', file=sys.stderr)
+
+
+class _JsonlSink:
+    def __init__(self, directory, fsync, fsync_interval):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.file = None
+        self.day = None
+        self.dirty = False
+        self.last_sync = time.time()
+
+    def _open(self, day):
+        if day != self.day:
+            if self.file is not None:
+                self.sync()
+                self.file.close()
+            path = os.path.join(self.directory, f'{day}.jsonl')
+            _repair_tail(path)
+            self.file = open(path, 'a', encoding='utf-8')
+            self.day = day
+
+    def write(self, entries):
+        # A batch can straddle midnight, so group by day while keeping order. Each day's group either
+        # reaches its file whole or is truncated away, and PartialWrite says how many groups made it
+        start = 0
+        while start < len(entries):
+            day = entries[start]['timestamp'][:10]
+            stop = start
+            while stop < len(entries) and entries[stop]['timestamp'][:10] == day:
+                stop += 1
+            offset = None
+            try:
+                self._open(day)
+                offset = self.file.tell()
+                self.file.write(''.join(json.dumps(e, separators=(',', ':')) + '\n' for e in entries[start:stop]))
+                self.file.flush()
+            except Exception as e:
+                self._discard(offset)
+                raise PartialWrite(start, e) from e
+            self.dirty = True
+            start = stop
+        if self.fsync == 'always':
+            self.sync()
+
+    def _discard(self, offset):
+        """Drop whatever part of a failed write reached the current day file; it is reopened on retry."""
+        if self.file is None:
+            return
+        path = self.file.name
+        try:
+            self.file.close()
+        except Exception:
+            pass
+        self.file = None
+        self.day = None
+        if offset is not None:
+            try:
+                os.truncate(path, offset)
+            except OSError as e:
+                print(f'Audit log could not truncate {path} after a failed write: {e}', file=sys.stderr)
+
+    def sync_due(self):
+        return self.dirty and self.fsync == 'interval' and time.time() - self.last_sync >= self.fsync_interval
+
+    def sync(self):
+        if self.file is not None and self.dirty:
+            os.fsync(self.file.fileno())
+        self.dirty = False
+        self.last_sync = time.time()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+
+class _SqliteSink:
+    # SQLite does its own syncing; the policy maps onto PRAGMA synchronous
+    SYNCHRONOUS = {'always': 'FULL', 'interval': 'NORMAL', 'never': 'OFF'}
+
+    def __init__(self, path, fsync):
+        self.path = path
+        self.fsync = fsync
+        self.db = None
+        self.dirty = False
+        # Fail early (in the caller's thread) if the database cannot be created
+        _connect(path).close()
+
+    def write(self, entries):
+        if self.db is None:
+            # Connections belong to the thread that made them: the writer thread
+            self.db = _connect(self.path)
+            self.db.execute(f'PRAGMA synchronous={self.SYNCHRONOUS[self.fsync]}')
+        with self.db:
+            self.db.executemany('INSERT INTO audit (ts, reference_number, record) VALUES (?, ?, ?)',
+                                [(e['ts'], e.get('referenceNumber'), json.dumps(e, separators=(',', ':')))
+                                 for e in entries])
+
+    def sync_due(self):
+        return False
+
+    def sync(self):
+        pass
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def _connect(path):
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS audit (id INTEGER PRIMARY KEY, ts REAL NOT NULL, '
+               'reference_number TEXT, record TEXT NOT NULL)')
+    db.execute('CREATE INDEX IF NOT EXISTS audit_ts ON audit (ts)')
+    db.execute('CREATE INDEX IF NOT EXISTS audit_reference ON audit (reference_number)')
+    db.commit()
+    return db
+
+
+class AuditLog:
+    def __init__(self, path, batch_size=256, flush_interval=1.0, fsync='interval', fsync_interval=5.0,
+                 max_queue=10000, block_timeout=5.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {', '.join(FSYNC_POLICIES)}")
+        self.path = path
+        if path.endswith(SQLITE_SUFFIXES):
+            self.sink = _SqliteSink(path, fsync)
+        else:
+            self.sink = _JsonlSink(path, fsync, fsync_interval)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+        self.stopping = threading.Event()
+        self.stop_deadline = None
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.written = 0
+        self.batches = 0
+        self.blocked = 0
+        self.rejected = 0
+        self.write_errors = 0
+        self.dropped = 0
+        self.last_batch_seconds = None
+
+    def start(self):
+        self.thread.start()
+
+    def record(self, **fields):
+        """Queue one entry; blocks up to block_timeout while the queue is full."""
+        now = time.time()
+        entry = {'timestamp': _utc(now).isoformat(timespec='milliseconds').replace('+00:00', 'Z'), 'ts': now}
+        entry.update(fields)
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            with self.lock:
+                self.blocked += 1
+            try:
+                self.queue.put(entry, timeout=self.block_timeout)
+            except queue.Full:
+                with self.lock:
+                    self.rejected += 1
+                raise AuditBackpressure(f'Audit queue full ({self.queue.maxsize} entries) for {self.block_timeout}s')
+        with self.lock:
+            self.recorded += 1
+
+    def _write(self, batch):
+        delay = 0.1
+        done = 0
+        start = time.time()
+        while True:
+            try:
+                self.sink.write(batch[done:])
+                break
+            except Exception as e:
+                if isinstance(e, PartialWrite):
+                    # Retrying what already reached the disk would duplicate it
+                    done += e.written
+                with self.lock:
+                    self.write_errors += 1
+                if self.stopping.is_set() and time.time() >= self.stop_deadline:
+                    # Shutting down and the disk is still failing: give up on this batch and everything
+                    # queued behind it rather than hang close()
+                    dropped = len(batch) - done
+                    while True:
+                        try:
+                            item = self.queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is not _STOP:
+                            dropped += 1
+                    with self.lock:
+                        self.written += done
+                        self.dropped += dropped
+                    print(f'Audit log shutting down with writes still failing; dropped {dropped} entries: {e}',
+                          file=sys.stderr)
+                    return
+                # Keep the batch: the queue fills up behind it and callers feel the backpressure
+                print(f'Audit log write failed, retrying in {delay:.1f}s: {e}', file=sys.stderr)
+                if self.stopping.is_set():
+                    time.sleep(max(0.0, min(delay, self.stop_deadline - time.time())))
+                else:
+                    time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+        with self.lock:
+            self.written += len(batch)
+            self.batches += 1
+            self.last_batch_seconds = round(time.time() - start, 4)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        stopping = False
+        while not stopping:
+            timeout = None
+            if batch:
+                timeout = max(0.0, deadline - time.time())
+            elif self.sink.dirty and self.sink.fsync == 'interval':
+                timeout = max(0.0, self.sink.last_sync + self.fsync_interval - time.time())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            while item is not None:
+                if item is _STOP:
+                    stopping = True
+                    break
+                if not batch:
+                    deadline = time.time() + self.flush_interval
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = None
+            if batch and (stopping or len(batch) >= self.batch_size or time.time() >= deadline):
+                self._write(batch)
+                batch = []
+            if self.sink.sync_due():
+                self.sink.sync()
+            if self.stopping.is_set() and not batch and self.queue.empty():
+                # _STOP never got into a full queue, or was dropped with the rest of it
+                stopping = True
+        try:
+            self.sink.close()
+        except Exception as e:
+            print(f'Audit log could not be closed cleanly: {e}', file=sys.stderr)
+
+    def close(self, timeout=10.0):
+        """Write everything queued so far, sync and stop the writer.
+
+        Failing writes are retried for at most `timeout` seconds; what is left
+        after that is dropped (see stats()['dropped']).
+        """
+        if not self.thread.is_alive():
+            self.sink.close()
+            return
+        self.stop_deadline = time.time() + timeout
+        self.stopping.set()
+        try:
+            self.queue.put_nowait(_STOP)
+        except queue.Full:
+            # The writer is busy; it stops by itself once the queue is empty
+            pass
+        # A little past the retry deadline, for dropping whatever is still queued
+        self.thread.join(timeout + 2.0)
+        if self.thread.is_alive():
+            print(f'Audit log writer still busy after {timeout + 2.0:.0f}s; '
+                  f'{self.queue.qsize()} queued entries may be lost', file=sys.stderr)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'path': self.path,
+                'queued': self.queue.qsize(),
+                'maxQueue': self.queue.maxsize,
+                'recorded': self.recorded,
+                'written': self.written,
+                'batches': self.batches,
+                'blocked': self.blocked,
+                'rejected': self.rejected,
+                'writeErrors': self.write_errors,
+                'dropped': self.dropped,
+                'lastBatchSeconds': self.last_batch_seconds,
+            }
+
+
+def _parse_time(value, end=False):
+    """Epoch seconds for 'YYYY-MM-DD' (the whole day when end=True) or an ISO datetime (UTC unless given)."""
+    if value is None:
+        return None
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    if end and len(value) == 10:
+        moment += timedelta(days=1)
+    return moment.timestamp()
+
+
+def query(path, since=None, until=None, reference_number=None, limit=None):
+    """Entries with since <= ts < until and the given reference number, oldest first."""
+    start, stop = _parse_time(since), _parse_time(until, end=True)
+    count = 0
+    for entry in (_query_sqlite if path.endswith(SQLITE_SUFFIXES) else _query_jsonl)(path, start, stop, reference_number):
+        yield entry
+        count += 1
+        if limit is not None and count >= limit:
+            return
+
+
+def _query_sqlite(path, start, stop, reference_number):
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    clauses, params = [], []
+    if start is not None:
+        clauses.append('ts >= ?')
+        params.append(start)
+    if stop is not None:
+        clauses.append('ts < ?')
+        params.append(stop)
+    if reference_number is not None:
+        clauses.append('reference_number = ?')
+        params.append(reference_number)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+    try:
+        for (record,) in db.execute(f'SELECT record FROM audit{where} ORDER BY ts, id', params):
+            yield json.loads(record)
+    finally:
+        db.close()
+
+
+def _query_jsonl(directory, start, stop, reference_number):
+    # Day files outside the range are never opened
+    first = _utc(start).strftime('%Y-%m-%d') if start is not None else None
+    last = _utc(stop - 1e-6).strftime('%Y-%m-%d') if stop is not None else None
+    days = sorted(f[:-6] for f in os.listdir(directory) if f.endswith('.jsonl'))
+    # Cheap substring test before parsing; the parsed value is still compared exactly
+    needle = None if reference_number is None else json.dumps(reference_number).encode()
+    for day in days:
+        if (first is not None and day < first) or (last is not None and day > last):
+            continue
+        with open(os.path.join(directory, f'{day}.jsonl'), 'rb') as f:
+            for line in f:
+                if needle is not None and needle not in line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash
+                    continue
+                if start is not None and entry['ts'] < start:
+                    continue
+                if stop is not None and entry['ts'] >= stop:
+                    continue
+                if reference_number is not None and entry.get('referenceNumber') != reference_number:
+                    continue
+                yield entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the prediction audit log')
+    parser.add_argument('--log', type=str, default='audit_log', help='JSONL directory or SQLite file')
+    parser.add_argument('--date', type=str, default=None, help='One UTC day (YYYY-MM-DD)')
+    parser.add_argument('--since', type=str, default=None, help='Start date or ISO datetime (inclusive)')
+    parser.add_argument('--until', type=str, default=None, help='End date (inclusive) or ISO datetime (exclusive)')
+    parser.add_argument('--reference', type=str, default=None, help='Reference number')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--count', action='store_true', help='Only print the number of matching entries')
+    args = parser.parse_args()
+
+    since, until = (args.date, args.date) if args.date else (args.since, args.until)
+    entries = query(args.log, since, until, args.reference, args.limit)
+    if args.count:
+        print(sum(1 for _ in entries))
+        return
+    for entry in entries:
+        print(json.dumps(entry))
+
+
+if __name__ == '__main__':
+    main()
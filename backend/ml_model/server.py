@@ -2,149 +2,426 @@
 EfficientNet Pneumonia Detection Server
 
 This script serves the pneumonia detection model from the ../pneumonia-ml-efficientnet folder
-as a Flask API for the Next.js frontend to use.
+as an API for the Next.js frontend to use.
+
+It supervises N replicas of the model server, each on its own local port and
+pinned to its own CPU cores, and puts a small reverse proxy in front of them on
+--port. A replica only receives traffic after its /health endpoint answers;
+crashed or hung replicas are restarted with exponential backoff. Requests go to
+the healthy replica with the fewest outstanding requests. Replica output is
+streamed line by line with a [replica N] prefix.
+
+    python server.py --replicas 4 --port 5000
+    curl http://localhost:5000/_supervisor/status
 """
 
 import os
 import sys
-import shutil
-import subprocess
+import json
 import time
 import signal
 import argparse
+import threading
+import subprocess
+import http.client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 # Add parent directory to sys.path to allow importing from parent directories
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def start_efficientnet_server(model_path=None, port=5000, host='0.0.0.0'):
+# Hop-by-hop headers are meaningful for a single connection only and are not forwarded
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+              'transfer-encoding', 'upgrade'}
+
+
+def resolve_app(model_path=None, app_path=None):
     """
-    Start the EfficientNet model server using the app.py from pneumonia-ml-efficientnet
-    
+    Locate the model server script and model file
+
     Args:
-        model_path (str, optional): Path to specific model file. If None, uses default.
-        port (int, optional): Port to run the server on. Defaults to 5000.
-        host (str, optional): Host to bind to. Defaults to '0.0.0.0'.
+        model_path (str, optional): Path to specific model file. If None, uses output/best_model.pth.
+        app_path (str, optional): Server script to run. If None, uses pneumonia-ml-efficientnet/app.py.
+
+    Returns:
+        (app_path, model_path), or None if either is missing
     """
-    print("Starting EfficientNet Pneumonia Detection Server...")
-    
-    # Get the path to the pneumonia-ml-efficientnet directory
     project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    model_dir = os.path.join(project_root, 'pneumonia-ml-efficientnet')
-    
-    if not os.path.exists(model_dir):
-        print(f"Error: Model directory not found at {model_dir}")
-        return False
-        
-    # Check if app.py exists
-    app_path = os.path.join(model_dir, 'app.py')
+    if not app_path:
+        app_path = os.path.join(project_root, 'pneumonia-ml-efficientnet', 'app.py')
     if not os.path.exists(app_path):
         print(f"Error: app.py not found at {app_path}")
-        return False
-    
-    # Construct environment variables
-    env = os.environ.copy()
-    
-    # If model_path is not provided, explicitly use the best_model.pth from output directory
+        return None
+
     if not model_path:
-        output_dir = os.path.join(project_root, 'output')
-        model_path = os.path.join(output_dir, 'best_model.pth')
+        model_path = os.path.join(project_root, 'output', 'best_model.pth')
         print(f"Using model from output directory: {model_path}")
-        
-    # Check if the model file exists
     if not os.path.exists(model_path):
         print(f"Error: Model file not found at {model_path}")
-        return False
-        
-    # Set the MODEL_PATH environment variable
-    env['MODEL_PATH'] = model_path
-    print(f"Setting MODEL_PATH to: {model_path}")
-    
-    # Start the Flask app in a subprocess
-    try:
-        # Build the command to run
-        command = [
-            sys.executable, 
-            app_path,
-            '--host', host,
-            '--port', str(port)
-        ]
-        
-        # Start the process
-        print(f"Running command: {' '.join(command)}")
-        process = subprocess.Popen(
+        return None
+    return os.path.abspath(app_path), os.path.abspath(model_path)
+
+
+def split_cores(num_replicas):
+    """Partition the CPUs this process may use into num_replicas disjoint sets (None if affinity is unsupported)"""
+    if not hasattr(os, 'sched_getaffinity'):
+        return [None] * num_replicas
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < num_replicas:
+        # Fewer cores than replicas: share them round-robin
+        return [[cores[i % len(cores)]] for i in range(num_replicas)]
+    per_replica = len(cores) // num_replicas
+    return [cores[i * per_replica:(i + 1) * per_replica] for i in range(num_replicas)]
+
+
+class Replica:
+    """One supervised model server process"""
+
+    def __init__(self, index, app_path, model_path, port, cores=None, startup_timeout=120,
+                 base_backoff=1.0, max_backoff=60.0, stable_after=60.0):
+        self.index = index
+        self.app_path = app_path
+        self.model_path = model_path
+        self.port = port
+        self.cores = cores
+        self.startup_timeout = startup_timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+
+        self.process = None
+        self.healthy = False
+        self.started_at = None
+        self.healthy_since = None
+        self.failures = 0
+        self.restarts = 0
+        self.next_start = 0.0
+        self.health_failures = 0
+        self.outstanding = 0
+        self.served = 0
+        self.lock = threading.Lock()
+        self.pool = []
+
+    def start(self):
+        env = os.environ.copy()
+        env['MODEL_PATH'] = self.model_path
+        env['PORT'] = str(self.port)
+        env['PYTHONUNBUFFERED'] = '1'
+        if self.cores:
+            # Size the intra-op thread pools to the pinned cores
+            env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(len(self.cores))
+        command = [sys.executable, self.app_path, '--host', '127.0.0.1', '--port', str(self.port)]
+        print(f"[supervisor] starting replica {self.index} on port {self.port}"
+              + (f" (cores {self.cores})" if self.cores else ""))
+        cores = self.cores
+        self.process = subprocess.Popen(
             command,
             env=env,
-            cwd=model_dir,
+            cwd=os.path.dirname(self.app_path),
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
             text=True,
-            bufsize=1
+            bufsize=1,
+            preexec_fn=(lambda: os.sched_setaffinity(0, cores)) if cores else None
         )
-        
-        # Wait a bit for startup
-        time.sleep(2)
-        
-        if process.poll() is not None:
-            # Process has already terminated
-            stdout, stderr = process.communicate()
-            print("Server failed to start:")
-            print(f"STDOUT: {stdout}")
-            print(f"STDERR: {stderr}")
+        self.started_at = time.time()
+        self.healthy = False
+        self.healthy_since = None
+        self.health_failures = 0
+        # Drain output continuously so a full pipe can never block the child
+        threading.Thread(target=self._stream_logs, args=(self.process,), daemon=True).start()
+
+    def _stream_logs(self, process):
+        for line in process.stdout:
+            sys.stdout.write(f"[replica {self.index}] {line}")
+            sys.stdout.flush()
+
+    def stop(self, timeout=10):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def check_health(self, timeout=2.0):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+            conn.request('GET', '/health')
+            ok = conn.getresponse().status == 200
+            conn.close()
+            return ok
+        except (OSError, http.client.HTTPException):
             return False
-        
-        print(f"EfficientNet server started on http://{host}:{port}")
-        return process
-        
-    except Exception as e:
-        print(f"Error starting server: {str(e)}")
-        return False
-
-def stop_server(process):
-    """Stop the Flask server process"""
-    if process:
-        print("Stopping server...")
-        process.send_signal(signal.SIGTERM)
-        process.wait()
-        print("Server stopped")
+
+    def schedule_restart(self, reason):
+        self.healthy = False
+        self.stop()
+        self.failures += 1
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+        self.next_start = time.time() + delay
+        print(f"[supervisor] replica {self.index} {reason}; restarting in {delay:.0f}s")
+
+    def supervise(self, unhealthy_after=3):
+        """One supervision step: start, gate readiness, detect crashes and hangs"""
+        now = time.time()
+        if self.next_start:
+            # Waiting out a restart backoff
+            if now >= self.next_start:
+                self.next_start = 0.0
+                self.restarts += 1
+                self.start()
+            return
+        if self.process is None:
+            self.start()
+            return
+        if self.process.poll() is not None:
+            self.schedule_restart(f"exited with code {self.process.returncode}")
+            return
+
+        ok = self.check_health()
+        if not self.healthy:
+            if ok:
+                self.healthy = True
+                self.healthy_since = now
+                print(f"[supervisor] replica {self.index} ready after {now - self.started_at:.1f}s")
+            elif now - self.started_at > self.startup_timeout:
+                self.schedule_restart(f"not ready after {self.startup_timeout}s")
+            return
+
+        if ok:
+            self.health_failures = 0
+            if self.failures and now - self.healthy_since > self.stable_after:
+                self.failures = 0
+            return
+        self.health_failures += 1
+        if self.health_failures >= unhealthy_after:
+            self.schedule_restart(f"failed {self.health_failures} health checks")
+
+    # Upstream keep-alive connections, reused across proxied requests
+    def acquire_connection(self, timeout):
+        with self.lock:
+            if self.pool:
+                return self.pool.pop(), True
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout), False
+
+    def release_connection(self, conn):
+        with self.lock:
+            if len(self.pool) < 32:
+                self.pool.append(conn)
+                return
+        conn.close()
+
+    def status(self):
+        return {
+            'index': self.index,
+            'port': self.port,
+            'pid': self.process.pid if self.process else None,
+            'cores': self.cores,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'served': self.served,
+            'restarts': self.restarts,
+        }
+
+
+class Supervisor:
+    def __init__(self, replicas, health_interval=2.0):
+        self.replicas = replicas
+        self.health_interval = health_interval
+        self.stopping = threading.Event()
+        self.pick_lock = threading.Lock()
+        self.rotation = 0
+
+    def run(self):
+        while not self.stopping.is_set():
+            for replica in self.replicas:
+                replica.supervise()
+            self.stopping.wait(self.health_interval if all(r.healthy for r in self.replicas) else 0.5)
+
+    def stop(self):
+        self.stopping.set()
+        for replica in self.replicas:
+            replica.stop()
+
+    def acquire(self, exclude=()):
+        """Healthy replica with the fewest outstanding requests (rotating among ties), or None"""
+        with self.pick_lock:
+            candidates = [r for r in self.replicas if r.healthy and r not in exclude]
+            if not candidates:
+                return None
+            self.rotation += 1
+            n = len(candidates)
+            replica = min((candidates[(self.rotation + i) % n] for i in range(n)), key=lambda r: r.outstanding)
+            replica.outstanding += 1
+            return replica
+
+    def release(self, replica):
+        with self.pick_lock:
+            replica.outstanding -= 1
+            replica.served += 1
+
+
+def make_proxy_handler(supervisor, upstream_timeout=300):
+    class ProxyHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _read_body(self):
+            if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        break
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+                return b''.join(chunks)
+            length = int(self.headers.get('Content-Length', 0))
+            return self.rfile.read(length) if length else b''
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _forward(self, replica, body):
+            """Send the request to replica; returns the response, retrying once on a stale pooled connection"""
+            headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_BY_HOP}
+            headers['Content-Length'] = str(len(body))
+            headers['X-Forwarded-For'] = self.client_address[0]
+            while True:
+                conn, reused = replica.acquire_connection(upstream_timeout)
+                try:
+                    conn.request(self.command, self.path, body=body, headers=headers)
+                    return conn, conn.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    if not reused:
+                        raise
+                except Exception:
+                    conn.close()
+                    raise
+
+        def _proxy(self):
+            if self.path == '/_supervisor/status':
+                return self._send_json(200, {'replicas': [r.status() for r in supervisor.replicas]})
+            body = self._read_body()
+            tried = []
+            while True:
+                replica = supervisor.acquire(exclude=tried)
+                if replica is None:
+                    return self._send_json(503, {'detail': 'No healthy model replica available'})
+                try:
+                    conn, response = self._forward(replica, body)
+                except ConnectionRefusedError:
+                    # The replica went away between health checks; let the supervisor notice and try another
+                    supervisor.release(replica)
+                    replica.healthy = False
+                    tried.append(replica)
+                    continue
+                except (OSError, http.client.HTTPException) as e:
+                    supervisor.release(replica)
+                    return self._send_json(502, {'detail': f'Upstream error: {e}'})
+                break
+            relayed = False
+            try:
+                self._relay(conn, response)
+                relayed = True
+            except (OSError, http.client.HTTPException) as e:
+                # The client went away (or upstream broke) mid-body; the status line is already sent
+                print(f"[proxy] {self.command} {self.path} via replica {replica.index} aborted: {e}")
+                self.close_connection = True
+            finally:
+                # Only a fully read response leaves the connection ready for the next request
+                if relayed and response.isclosed() and not response.will_close:
+                    replica.release_connection(conn)
+                else:
+                    conn.close()
+                supervisor.release(replica)
+
+        def _relay(self, conn, response):
+            self.send_response_only(response.status, response.reason)
+            length = response.getheader('Content-Length')
+            for key, value in response.getheaders():
+                if key.lower() not in HOP_BY_HOP:
+                    self.send_header(key, value)
+            if length is None:
+                # Streamed upstream response (e.g. server-sent events): re-chunk it as it arrives
+                self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            if length is not None:
+                remaining = int(length)
+                while remaining > 0:
+                    data = response.read(min(65536, remaining))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+                return
+            while True:
+                data = response.read1(65536)
+                if not data:
+                    break
+                self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+
+        do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = do_OPTIONS = do_HEAD = _proxy
+
+    return ProxyHandler
+
 
 def main():
     parser = argparse.ArgumentParser(description="Start the EfficientNet Pneumonia Detection Server")
     parser.add_argument('--model-path', type=str, help='Path to the model file')
-    parser.add_argument('--port', type=int, default=5000, help='Port to run the server on')
+    parser.add_argument('--app', type=str, help='Model server script (default: pneumonia-ml-efficientnet/app.py)')
+    parser.add_argument('--port', type=int, default=5000, help='Port the load-balancing proxy listens on')
     parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to bind to')
+    parser.add_argument('--replicas', type=int, default=1, help='Number of model server processes')
+    parser.add_argument('--base-port', type=int, default=None, help='First replica port (default: --port + 1)')
+    parser.add_argument('--no-affinity', action='store_true', help='Do not pin replicas to CPU cores')
+    parser.add_argument('--startup-timeout', type=float, default=120, help='Seconds a replica may take to pass /health')
+    parser.add_argument('--max-backoff', type=float, default=60, help='Upper bound on the restart delay in seconds')
     args = parser.parse_args()
-    
-    # Start server and keep it running
-    server_process = start_efficientnet_server(args.model_path, args.port, args.host)
-    
-    if not server_process:
+
+    resolved = resolve_app(args.model_path, args.app)
+    if not resolved:
         print("Failed to start server")
         sys.exit(1)
-    
+    app_path, model_path = resolved
+    print(f"Setting MODEL_PATH to: {model_path}")
+
+    base_port = args.base_port or args.port + 1
+    cores = [None] * args.replicas if args.no_affinity else split_cores(args.replicas)
+    replicas = [Replica(i, app_path, model_path, base_port + i, cores[i], startup_timeout=args.startup_timeout,
+                        max_backoff=args.max_backoff) for i in range(args.replicas)]
+    supervisor = Supervisor(replicas)
+    proxy = ThreadingHTTPServer((args.host, args.port), make_proxy_handler(supervisor))
+    proxy.daemon_threads = True
+
+    def shutdown(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, shutdown)
+    threading.Thread(target=supervisor.run, name='supervisor', daemon=True).start()
     try:
-        # Keep the script running and monitor the server
-        print("Server is running. Press Ctrl+C to stop.")
-        while True:
-            # Check if server is still running
-            if server_process.poll() is not None:
-                stdout, stderr = server_process.communicate()
-                print("Server stopped unexpectedly:")
-                print(f"STDOUT: {stdout}")
-                print(f"STDERR: {stderr}")
-                
-                # Try to restart the server
-                print("Restarting server...")
-                server_process = start_efficientnet_server(args.model_path, args.port, args.host)
-                if not server_process:
-                    print("Failed to restart server")
-                    sys.exit(1)
-            
-            time.sleep(5)
-    
+        print(f"EfficientNet server proxy listening on http://{args.host}:{args.port} "
+              f"with {args.replicas} replica(s). Press Ctrl+C to stop.")
+        proxy.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down...")
     finally:
-        stop_server(server_process)
+        proxy.server_close()
+        supervisor.stop()
+        print("Server stopped")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
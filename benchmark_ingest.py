@@ -0,0 +1,230 @@
+"""
+Benchmark X-ray ingestion on large synthetic DICOM and 16-bit PNG/TIFF files.
+
+    python benchmark_ingest.py
+    python benchmark_ingest.py --size 4096 --out_dir /tmp/xray_bench --report ingest.json
+
+Each synthetic film is a 12-bit chest-like image written locally as native
+DICOM (explicit and implicit VR), baseline JPEG DICOM, 16-bit PNG and
+uncompressed 16-bit TIFF. Two decoders are compared for each file:
+
+    full      decode every pixel to float, window at full resolution, then
+              resize (what a straightforward pydicom/PIL path does)
+    load_xray the reduced-resolution path in xray_io
+
+The report has the median time, the peak resident memory added by the decode
+(VmHWM after resetting it through /proc/self/clear_refs, Linux only) and the
+largest difference between the two 224x224 model input tensors.
+"""
+
+import os
+import io
+import json
+import time
+import struct
+import argparse
+import multiprocessing
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from xray_io import load_xray, read_dicom, window, EXPLICIT_VR_LITTLE, IMPLICIT_VR_LITTLE, JPEG_BASELINE
+
+image_transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+])
+
+CR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.1'
+WINDOW = (2048.0, 3000.0)
+
+
+def synthetic_xray(size, seed=0):
+    """12-bit film: bright mediastinum and ribs, darker lung fields, detector noise."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    image = 2600 - 1200 * (np.exp(-((x - 0.3) ** 2 / 0.02 + (y - 0.5) ** 2 / 0.08))
+                           + np.exp(-((x - 0.7) ** 2 / 0.02 + (y - 0.5) ** 2 / 0.08)))
+    image += 300 * (np.sin(y * 60) > 0.7) * (np.abs(x - 0.5) > 0.08)
+    image += rng.normal(0, 40, (size, size)).astype(np.float32)
+    return np.clip(image, 0, 4095).astype(np.uint16)
+
+
+def _element(tag, vr, value, explicit):
+    if len(value) % 2:
+        value += b'\x00' if vr in (b'UI', b'OB') else b' '
+    head = struct.pack('<HH', *tag)
+    if not explicit:
+        return head + struct.pack('<I', len(value)) + value
+    if vr in (b'OB', b'OW', b'SQ', b'UN'):
+        return head + vr + b'\x00\x00' + struct.pack('<I', len(value)) + value
+    return head + vr + struct.pack('<H', len(value)) + value
+
+
+def write_dicom(path, pixels, syntax=EXPLICIT_VR_LITTLE, jpeg_quality=None):
+    """Minimal single-frame DICOM Part 10 file; jpeg_quality stores 8-bit baseline JPEG instead."""
+    explicit = syntax != IMPLICIT_VR_LITTLE
+    meta = b''.join([
+        _element((0x0002, 0x0001), b'OB', b'\x00\x01', True),
+        _element((0x0002, 0x0002), b'UI', CR_IMAGE_STORAGE.encode(), True),
+        _element((0x0002, 0x0003), b'UI', b'1.2.3.4.5.6.7', True),
+        _element((0x0002, 0x0010), b'UI', syntax.encode(), True),
+    ])
+    meta = _element((0x0002, 0x0000), b'UL', struct.pack('<I', len(meta)), True) + meta
+    if jpeg_quality is not None:
+        pixels8 = (window(pixels.astype(np.float32), *WINDOW) * 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels8).save(buffer, format='JPEG', quality=jpeg_quality)
+        stream = buffer.getvalue()
+        stream += b'\x00' * (len(stream) % 2)
+        bits, window_tags = 8, []
+        # Encapsulated: empty basic offset table, one fragment, sequence delimiter
+        pixel_data = (struct.pack('<HH', 0x7FE0, 0x0010) + b'OB\x00\x00' + struct.pack('<I', 0xFFFFFFFF)
+                      + struct.pack('<HHI', 0xFFFE, 0xE000, 0)
+                      + struct.pack('<HHI', 0xFFFE, 0xE000, len(stream)) + stream
+                      + struct.pack('<HHI', 0xFFFE, 0xE0DD, 0))
+    else:
+        bits = 16
+        window_tags = [
+            _element((0x0028, 0x1050), b'DS', f'{WINDOW[0]:g}'.encode(), explicit),
+            _element((0x0028, 0x1051), b'DS', f'{WINDOW[1]:g}'.encode(), explicit),
+            _element((0x0028, 0x1052), b'DS', b'0', explicit),
+            _element((0x0028, 0x1053), b'DS', b'1', explicit),
+        ]
+        pixel_data = _element((0x7FE0, 0x0010), b'OW', pixels.astype('<u2').tobytes(), explicit)
+    dataset = b''.join([
+        _element((0x0008, 0x0016), b'UI', CR_IMAGE_STORAGE.encode(), explicit),
+        _element((0x0028, 0x0002), b'US', struct.pack('<H', 1), explicit),
+        _element((0x0028, 0x0004), b'CS', b'MONOCHROME2', explicit),
+        _element((0x0028, 0x0010), b'US', struct.pack('<H', pixels.shape[0]), explicit),
+        _element((0x0028, 0x0011), b'US', struct.pack('<H', pixels.shape[1]), explicit),
+        _element((0x0028, 0x0100), b'US', struct.pack('<H', bits), explicit),
+        _element((0x0028, 0x0101), b'US', struct.pack('<H', 12 if bits == 16 else 8), explicit),
+        _element((0x0028, 0x0102), b'US', struct.pack('<H', 11 if bits == 16 else 7), explicit),
+        _element((0x0028, 0x0103), b'US', struct.pack('<H', 0), explicit),
+    ] + window_tags) + pixel_data
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * 128 + b'DICM' + meta + dataset)
+
+
+def full_decode(path):
+    """Reference: every pixel to float32, windowed at full resolution, then converted to RGB."""
+    if path.endswith('.dcm'):
+        with open(path, 'rb') as f:
+            buf = memoryview(f.read())
+        elements, syntax, buf = read_dicom(buf)
+        if syntax in JPEG_BASELINE:
+            return Image.open(path.replace('.dcm', '.jpg')).convert('RGB')
+        rows = struct.unpack('<H', elements[(0x0028, 0x0010)][1])[0]
+        offset = elements[(0x7FE0, 0x0010)][1][0]
+        pixels = np.frombuffer(buf, dtype='<u2', offset=offset, count=rows * rows).reshape(rows, rows)
+        display = window(pixels.astype(np.float32), *WINDOW)
+    else:
+        pixels = np.asarray(Image.open(path)).astype(np.float32)
+        lo, hi = np.percentile(pixels, [0.5, 99.5])
+        display = np.clip((pixels - lo) / (hi - lo), 0, 1)
+    return Image.fromarray((display * 255 + 0.5).astype(np.uint8)).convert('RGB')
+
+
+def _decode(decoder, path, min_size):
+    return full_decode(path) if decoder == 'full' else load_xray(path, min_size)
+
+
+def _peak_child(decoder, path, min_size, queue):
+    def read(field):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        queue.put(None)
+        return
+    before = read('VmRSS')
+    _decode(decoder, path, min_size)
+    queue.put(round(read('VmHWM') - before, 1))
+
+
+def peak_rss_mb(decoder, path, min_size):
+    """Peak resident memory added by one decode, via VmHWM (Linux); None elsewhere. Runs in a fresh
+    process so memory freed by earlier decodes, but still held by the allocator, cannot hide it."""
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    child = ctx.Process(target=_peak_child, args=(decoder, path, min_size, queue))
+    child.start()
+    result = queue.get()
+    child.join()
+    return result
+
+
+def bench(fn, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, round(float(np.median(times)) * 1000, 1)
+
+
+def make_files(out_dir, size):
+    os.makedirs(out_dir, exist_ok=True)
+    pixels = synthetic_xray(size)
+    files = {
+        'dicom_explicit': os.path.join(out_dir, 'explicit.dcm'),
+        'dicom_implicit': os.path.join(out_dir, 'implicit.dcm'),
+        'dicom_jpeg': os.path.join(out_dir, 'jpeg.dcm'),
+        'png16': os.path.join(out_dir, 'film16.png'),
+        'tiff16': os.path.join(out_dir, 'film16.tif'),
+    }
+    write_dicom(files['dicom_explicit'], pixels)
+    write_dicom(files['dicom_implicit'], pixels, syntax=IMPLICIT_VR_LITTLE)
+    write_dicom(files['dicom_jpeg'], pixels, syntax=JPEG_BASELINE[0], jpeg_quality=95)
+    # Same JPEG stream as a plain file, for the full-resolution reference of the JPEG DICOM
+    pixels8 = (window(pixels.astype(np.float32), *WINDOW) * 255).astype(np.uint8)
+    Image.fromarray(pixels8).save(files['dicom_jpeg'].replace('.dcm', '.jpg'), format='JPEG', quality=95)
+    Image.fromarray(pixels).save(files['png16'])
+    Image.fromarray(pixels).save(files['tiff16'])
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark DICOM / 16-bit X-ray ingestion')
+    parser.add_argument('--size', type=int, default=3072, help='Synthetic film width and height in pixels')
+    parser.add_argument('--out_dir', type=str, default='ingest_bench')
+    parser.add_argument('--min_size', type=int, default=448, help='Short side load_xray reduces to')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--report', type=str, default=None, help='Optional JSON report path')
+    args = parser.parse_args()
+
+    files = make_files(args.out_dir, args.size)
+    rows = []
+    print(f"{'file':<16}{'MB':>7}{'full ms':>10}{'full +MB':>10}{'xray ms':>10}{'xray +MB':>10}{'max diff':>10}")
+    for name, path in files.items():
+        reference, full_ms = bench(lambda: _decode('full', path, args.min_size), args.runs)
+        full_mb = peak_rss_mb('full', path, args.min_size)
+        reduced, xray_ms = bench(lambda: _decode('load_xray', path, args.min_size), args.runs)
+        xray_mb = peak_rss_mb('load_xray', path, args.min_size)
+        # Tensors in pixel units of the 8-bit display image (0-255)
+        diff = (image_transform(reference) - image_transform(reduced)).abs() * 0.229 * 255
+        row = {'file': name, 'size_mb': round(os.path.getsize(path) / 2 ** 20, 1),
+               'full_ms': full_ms, 'full_peak_mb': full_mb, 'load_xray_ms': xray_ms, 'load_xray_peak_mb': xray_mb,
+               'decoded_size': list(reduced.size), 'max_diff': round(float(diff.max()), 2),
+               'mean_diff': round(float(diff.mean()), 3)}
+        rows.append(row)
+        print(f"{name:<16}{row['size_mb']:>7}{full_ms:>10}{str(full_mb):>10}{xray_ms:>10}{str(xray_mb):>10}"
+              f"{row['max_diff']:>10}")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'size': args.size, 'min_size': args.min_size, 'threads': torch.get_num_threads(),
+                       'results': rows}, f, indent=2)
+        print(f'Report written to {args.report}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Compare memory, CPU latency and (optionally) accuracy of the lightweight models.
+
+    python benchmark_models.py
+    python benchmark_models.py --data_dir data/test --weights simple=simple.pth compact=compact.pth
+
+Latency is the median wall time of a forward pass at each batch size. Memory
+is reported as weight size plus the summed size of every layer output for one
+image, a proxy for activation memory.
+"""
+
+import time
+import json
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torchvision import datasets, transforms
+
+from model import SimpleConvNet, CompactConvNet, PneumoniaModel
+
+ARCHITECTURES = {
+    'simple': SimpleConvNet,
+    'compact': CompactConvNet,
+    'resnet50': lambda: PneumoniaModel(pretrained=False, freeze_backbone=False),
+}
+
+eval_transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+])
+
+
+def weight_bytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def activation_bytes(model, input_size=224):
+    total = 0
+
+    def hook(module, inputs, output):
+        nonlocal total
+        if torch.is_tensor(output):
+            total += output.numel() * output.element_size()
+
+    handles = [m.register_forward_hook(hook) for m in model.modules() if len(list(m.children())) == 0]
+    with torch.no_grad():
+        model(torch.randn(1, 3, input_size, input_size))
+    for h in handles:
+        h.remove()
+    return total
+
+
+def latency_ms(model, batch_size, runs=20, warmup=3):
+    x = torch.randn(batch_size, 3, 224, 224)
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            model(x)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def accuracy(model, data_dir, batch_size=32, num_workers=2):
+    dataset = datasets.ImageFolder(data_dir, eval_transform)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    correct = 0
+    with torch.no_grad():
+        for inputs, labels in loader:
+            correct += (model(inputs).argmax(dim=1) == labels).sum().item()
+    return correct / max(len(dataset), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SimpleConvNet against CompactConvNet (and optionally ResNet50)')
+    parser.add_argument('--models', type=str, nargs='+', default=['simple', 'compact'], choices=list(ARCHITECTURES))
+    parser.add_argument('--weights', type=str, nargs='*', default=[], help='name=path pairs of trained checkpoints')
+    parser.add_argument('--data_dir', type=str, default=None, help='Optional: ImageFolder test split for accuracy')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16], help='Batch sizes to time')
+    parser.add_argument('--runs', type=int, default=20, help='Timed forward passes per batch size')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--output', type=str, default=None, help='Optional: path to save results as JSON')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    weights = dict(pair.split('=', 1) for pair in args.weights)
+
+    results = {}
+    for name in args.models:
+        model = ARCHITECTURES[name]()
+        if name in weights:
+            model.load_state_dict(torch.load(weights[name], map_location='cpu'))
+        model.eval()
+        row = {
+            'parameters': sum(p.numel() for p in model.parameters()),
+            'weights_mb': weight_bytes(model) / 2 ** 20,
+            'activations_mb': activation_bytes(model) / 2 ** 20,
+        }
+        for bs in args.batch_sizes:
+            row[f'latency_ms_bs{bs}'] = latency_ms(model, bs, args.runs)
+        if args.data_dir and name in weights:
+            row['accuracy'] = accuracy(model, args.data_dir)
+        results[name] = row
+
+    columns = ['parameters', 'weights_mb', 'activations_mb'] + [f'latency_ms_bs{bs}' for bs in args.batch_sizes]
+    if any('accuracy' in r for r in results.values()):
+        columns.append('accuracy')
+    print(f"{'model':<10}" + ''.join(f'{c:>18}' for c in columns))
+    for name, row in results.items():
+        cells = []
+        for c in columns:
+            value = row.get(c)
+            cells.append(f'{"-":>18}' if value is None else (f'{value:>18,}' if isinstance(value, int) else f'{value:>18.2f}'))
+        print(f'{name:<10}' + ''.join(cells))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Class activation heatmaps computed from the ordinary forward pass.
+
+Forward hooks keep the last convolutional feature map F (C x h x w) and, for
+heads with hidden ReLU layers, which hidden units were active. Global average
+pooling and the head are (piecewise) linear in F, so a class logit splits into
+per-position contributions:
+
+    logit_c = mean_hw(w_c . F[:, h, w]) + bias
+
+w_c is the classifier row for a linear head (EfficientNet-B0, CompactConvNet:
+plain CAM). For PneumoniaModel's MLP head it is the head's effective row at
+this input, W3[c] diag(relu2) W2 diag(relu1) W1. The heatmap is
+sum_k w_c[k] F[k], the same map a backward pass would give for these heads,
+at the cost of a few small matrix products instead of a second pass.
+
+    maps = ActivationMaps(model)
+    logits = model(batch)
+    heatmaps = maps.heatmaps(logits.argmax(dim=1))   # (batch, h, w) in [0, 1]
+"""
+
+import os
+import io
+import json
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.models import EfficientNet
+
+from model import PneumoniaModel, CompactConvNet
+
+
+class ActivationMaps:
+    """Hooks a model so every forward also leaves what is needed for its class activation maps."""
+    def __init__(self, model):
+        if isinstance(model, PneumoniaModel):
+            fc = model.backbone.fc
+            feature_layer, linears, relus = model.backbone.layer4, [fc[0], fc[3], fc[6]], [fc[1], fc[4]]
+        elif isinstance(model, CompactConvNet):
+            feature_layer, linears, relus = model.features, [model.fc], []
+        elif isinstance(model, EfficientNet):
+            feature_layer, linears, relus = model.features, [model.classifier[-1]], []
+        else:
+            raise ValueError(f'{type(model).__name__} has no global-pooling head to derive heatmaps from')
+        self.linears = linears
+        self._local = threading.local()
+        self.handles = [feature_layer.register_forward_hook(self._capture_features)]
+        for i, relu in enumerate(relus):
+            self.handles.append(relu.register_forward_hook(self._capture_mask(i)))
+
+    def _capture_features(self, module, inputs, output):
+        self._local.features = output.detach()
+
+    def _capture_mask(self, i):
+        def hook(module, inputs, output):
+            masks = getattr(self._local, 'masks', {})
+            masks[i] = output.detach() > 0
+            self._local.masks = masks
+        return hook
+
+    @torch.no_grad()
+    def raw_maps(self, class_indices):
+        """Un-normalised maps (batch, h, w) for the given class of each image in this thread's last forward."""
+        features = self._local.features.float()
+        class_indices = torch.as_tensor(class_indices, device=features.device).reshape(-1)
+        weights = self.linears[-1].weight.float()[class_indices]
+        masks = getattr(self._local, 'masks', {})
+        for i in reversed(range(len(self.linears) - 1)):
+            weights = (weights * masks[i].float()) @ self.linears[i].weight.float()
+        return torch.einsum('bk,bkhw->bhw', weights, features)
+
+    def heatmaps(self, class_indices):
+        """Maps scaled to [0, 1] per image (negative evidence clipped), as a float32 numpy array."""
+        maps = self.raw_maps(class_indices).clamp_min(0)
+        peak = maps.flatten(1).max(dim=1).values.clamp_min(1e-8)
+        return (maps / peak[:, None, None]).cpu().numpy()
+
+    def remove(self):
+        for h in self.handles:
+            h.remove()
+
+
+def _jet(values):
+    """Jet-style colormap for values in [0, 1]; returns uint8 RGB."""
+    v = values[..., None]
+    rgb = np.clip(np.concatenate([1.5 - np.abs(4 * v - 3), 1.5 - np.abs(4 * v - 2), 1.5 - np.abs(4 * v - 1)], axis=-1), 0, 1)
+    return (rgb * 255).astype(np.uint8)
+
+
+def overlay_png(image, heatmap, alpha=0.4, max_size=512):
+    """PNG bytes of `image` (the region the model saw) with the heatmap blended on top."""
+    image = image.convert('RGB')
+    if max(image.size) > max_size:
+        scale = max_size / max(image.size)
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BILINEAR)
+    heat = Image.fromarray((np.clip(heatmap, 0, 1) * 255).astype(np.uint8)).resize(image.size, Image.BILINEAR)
+    colored = Image.fromarray(_jet(np.asarray(heat, dtype=np.float32) / 255))
+    buffer = io.BytesIO()
+    Image.blend(image, colored, alpha).save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+class HeatmapStore:
+    """Writes the heatmaps of a batched run to out_dir/heatmaps.npy (float16, one row per file) plus files.txt."""
+    def __init__(self, out_dir, num_rows, activation_maps):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.num_rows = num_rows
+        self.activation_maps = activation_maps
+        self.maps = None
+        self.row = 0
+        self.files = open(os.path.join(out_dir, 'files.txt'), 'w')
+
+    def add(self, class_indices, files):
+        """Store maps for the classes in class_indices, taken from the model's most recent forward."""
+        maps = self.activation_maps.heatmaps(class_indices)
+        if self.maps is None:
+            # The map size is only known after the first forward
+            self.maps = np.lib.format.open_memmap(os.path.join(self.out_dir, 'heatmaps.npy'), mode='w+',
+                                                  dtype=np.float16, shape=(self.num_rows,) + maps.shape[1:])
+        self.maps[self.row:self.row + len(maps)] = maps
+        self.row += len(maps)
+        for f in files:
+            self.files.write(f + '\n')
+
+    def close(self):
+        if self.maps is not None:
+            self.maps.flush()
+        self.files.close()
+        with open(os.path.join(self.out_dir, 'meta.json'), 'w') as f:
+            json.dump({'num_rows': self.row, 'shape': None if self.maps is None else list(self.maps.shape[1:])}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,279 @@
+"""
+Constant-memory drift monitor for the serving path.
+
+Each prediction updates fixed-bin histograms of:
+
+    intensity     grayscale values of the preprocessed (normalised) tensor
+    image_mean    per-image mean of that tensor
+    image_std     per-image standard deviation (contrast)
+    short_side    short side of the uploaded image in pixels (before reduction)
+    aspect        width / height of the upload
+    confidence    probability of the predicted class
+
+plus the predicted-class counts and the first four moments of the pixel
+intensities (taken on every other row and column of the tensor). The window
+is a ring of `buckets` sub-histograms of window // buckets predictions each,
+so memory never grows, and an update is a handful of vectorised tensor ops
+(well under a millisecond on one core).
+
+compare() scores the window against a reference profile built offline from
+the training set. It reports the population stability index (PSI: below 0.1
+stable, up to 0.25 moderate shift, above that significant) and the
+two-sample Kolmogorov-Smirnov statistic per histogram, with PSI on the class mix:
+
+    python drift_monitor.py --data_dir data/train --weights best_model.pth --output drift_reference.json
+"""
+
+import os
+import sys
+import json
+import math
+import argparse
+import threading
+from collections import deque
+
+import numpy as np
+import torch
+
+EDGES = {
+    'intensity': np.linspace(-2.2, 2.7, 50),
+    'image_mean': np.linspace(-2.2, 2.7, 50),
+    'image_std': np.linspace(0.0, 2.0, 41),
+    'short_side': np.array([0, 128, 256, 384, 512, 768, 1024, 1536, 2048, 2560, 3072, 4096, np.inf]),
+    'aspect': np.array([0, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.05, 1.1, 1.25, 1.5, 2.0, np.inf]),
+    'confidence': np.linspace(0.0, 1.0, 21),
+}
+PSI_MODERATE = 0.1
+PSI_SIGNIFICANT = 0.25
+MIN_SAMPLES = 30
+
+
+def _bin(values, edges):
+    """Bin indices with out-of-range values folded into the first/last bin."""
+    return np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+
+
+class DriftMonitor:
+    def __init__(self, class_names, window=2000, buckets=10):
+        self.class_names = list(class_names)
+        self.window = window
+        self.bucket_size = max(1, window // buckets)
+        self.buckets = deque(maxlen=buckets)
+        self.lock = threading.Lock()
+        self.total = 0
+        self._new_bucket()
+
+    def _new_bucket(self):
+        self.buckets.append({
+            'n': 0,
+            'hist': {name: np.zeros(len(edges) - 1, dtype=np.int64) for name, edges in EDGES.items()},
+            'classes': np.zeros(len(self.class_names), dtype=np.int64),
+            # Sums of x, x^2, x^3, x^4 over pixel intensities, and the pixel count
+            'moments': np.zeros(5, dtype=np.float64),
+        })
+
+    @torch.no_grad()
+    def update(self, tensors, sizes, probabilities):
+        """tensors: preprocessed batch (B, C, H, W); sizes: B (width, height) of the uploads;
+        probabilities: (B, num_classes)."""
+        # Pixel statistics on every other row and column: a quarter of the work, same distribution
+        gray = tensors[:, :, ::2, ::2].float().mean(dim=1).flatten(1)
+        lo, hi = float(EDGES['intensity'][0]), float(EDGES['intensity'][-1])
+        # The intensity bins are uniform, so histc applies; clamping folds outliers into the end bins
+        intensity = torch.histc(gray.clamp(lo, hi), bins=len(EDGES['intensity']) - 1, min=lo, max=hi).long().numpy()
+        gray64 = gray.double()
+        squared = gray64 * gray64
+        moments = np.array([gray.numel(), gray64.sum().item(), squared.sum().item(),
+                            (squared * gray64).sum().item(), (squared * squared).sum().item()])
+        means = gray.mean(dim=1).numpy()
+        stds = gray.std(dim=1).numpy()
+        sizes = np.asarray(sizes, dtype=np.float64).reshape(-1, 2)
+        probabilities = np.asarray(probabilities, dtype=np.float64).reshape(len(means), -1)
+        predicted = probabilities.argmax(axis=1)
+        values = {
+            'image_mean': means,
+            'image_std': stds,
+            'short_side': sizes.min(axis=1),
+            'aspect': sizes[:, 0] / np.maximum(sizes[:, 1], 1),
+            'confidence': probabilities.max(axis=1),
+        }
+        counts = {name: np.bincount(_bin(v, EDGES[name]), minlength=len(EDGES[name]) - 1) for name, v in values.items()}
+        classes = np.bincount(predicted, minlength=len(self.class_names))[:len(self.class_names)]
+
+        with self.lock:
+            bucket = self.buckets[-1]
+            bucket['n'] += len(means)
+            bucket['hist']['intensity'] += intensity
+            for name, c in counts.items():
+                bucket['hist'][name] += c
+            bucket['classes'] += classes
+            bucket['moments'] += moments
+            self.total += len(means)
+            if bucket['n'] >= self.bucket_size:
+                self._new_bucket()
+
+    def snapshot(self):
+        """Summed histograms of the current window."""
+        with self.lock:
+            n = sum(b['n'] for b in self.buckets)
+            hist = {name: sum(b['hist'][name] for b in self.buckets) for name in EDGES}
+            classes = sum(b['classes'] for b in self.buckets)
+            moments = sum(b['moments'] for b in self.buckets)
+        return {'n': int(n), 'hist': hist, 'classes': classes, 'moments': moments}
+
+    def profile(self):
+        """JSON-serialisable form of the current window, used as the offline reference profile."""
+        snap = self.snapshot()
+        return {
+            'class_names': self.class_names,
+            'count': snap['n'],
+            'edges': {name: [e if np.isfinite(e) else None for e in edges.tolist()] for name, edges in EDGES.items()},
+            'hist': {name: counts.tolist() for name, counts in snap['hist'].items()},
+            'classes': snap['classes'].tolist(),
+            'moments': snap['moments'].tolist(),
+        }
+
+    def compare(self, reference=None):
+        snap = self.snapshot()
+        report = {
+            'window': self.window,
+            'count': snap['n'],
+            'totalSeen': self.total,
+            'moments': _moments(snap['moments']),
+            'classMix': _mix(snap['classes'], self.class_names),
+        }
+        if reference is None:
+            report['status'] = 'no reference profile'
+            return report
+        report['reference'] = {'count': reference['count'], 'moments': _moments(np.asarray(reference['moments'])),
+                               'classMix': _mix(np.asarray(reference['classes']), reference['class_names'])}
+        if snap['n'] < MIN_SAMPLES:
+            report['status'] = f'insufficient data ({snap["n"]} < {MIN_SAMPLES} predictions)'
+            return report
+        features = {}
+        for name in EDGES:
+            ref = np.asarray(reference['hist'][name], dtype=np.float64)
+            cur = snap['hist'][name].astype(np.float64)
+            d = ks_statistic(cur, ref)
+            features[name] = {'psi': round(psi(cur, ref), 4), 'ks': round(d, 4),
+                              # Images, not pixels, are the independent samples
+                              'ksPValue': round(ks_pvalue(d, snap['n'], reference['count']), 6)}
+        if list(reference['class_names']) == self.class_names:
+            features['class_mix'] = {'psi': round(psi(snap['classes'].astype(np.float64),
+                                                      np.asarray(reference['classes'], dtype=np.float64)), 4)}
+        for scores in features.values():
+            scores['status'] = _status(scores['psi'])
+        report['features'] = features
+        worst = max(scores['psi'] for scores in features.values())
+        report['maxPsi'] = round(worst, 4)
+        report['status'] = _status(worst)
+        return report
+
+
+def _status(value):
+    if value >= PSI_SIGNIFICANT:
+        return 'significant drift'
+    if value >= PSI_MODERATE:
+        return 'moderate drift'
+    return 'stable'
+
+
+def _moments(sums):
+    count = sums[0]
+    if count == 0:
+        return None
+    mean = sums[1] / count
+    # Central moments from raw sums
+    m2 = sums[2] / count - mean ** 2
+    m3 = sums[3] / count - 3 * mean * sums[2] / count + 2 * mean ** 3
+    m4 = sums[4] / count - 4 * mean * sums[3] / count + 6 * mean ** 2 * sums[2] / count - 3 * mean ** 4
+    std = math.sqrt(max(m2, 0.0))
+    return {'mean': round(mean, 4), 'std': round(std, 4),
+            'skewness': round(m3 / std ** 3, 4) if std > 0 else None,
+            'kurtosis': round(m4 / std ** 4 - 3, 4) if std > 0 else None}
+
+
+def _mix(counts, names):
+    total = counts.sum()
+    return {name: round(float(c) / total, 4) if total else None for name, c in zip(names, counts)}
+
+
+def psi(current, reference, eps=1e-4):
+    p = np.maximum(current / max(current.sum(), 1), eps)
+    q = np.maximum(reference / max(reference.sum(), 1), eps)
+    return float(np.sum((p - q) * np.log(p / q)))
+
+
+def ks_statistic(current, reference):
+    """Largest CDF gap between two histograms over the same bins."""
+    p = np.cumsum(current) / max(current.sum(), 1)
+    q = np.cumsum(reference) / max(reference.sum(), 1)
+    return float(np.max(np.abs(p - q)))
+
+
+def ks_pvalue(d, n, m):
+    """Asymptotic two-sample Kolmogorov-Smirnov p-value."""
+    if n == 0 or m == 0:
+        return 1.0
+    en = math.sqrt(n * m / (n + m))
+    lam = (en + 0.12 + 0.11 / en) * d
+    if lam < 1e-3:
+        return 1.0
+    total = sum(2 * (-1) ** (j - 1) * math.exp(-2 * j * j * lam * lam) for j in range(1, 101))
+    return min(max(total, 0.0), 1.0)
+
+
+def load_reference(path):
+    with open(path) as f:
+        reference = json.load(f)
+    for name, edges in EDGES.items():
+        stored = [np.inf if e is None else e for e in reference['edges'].get(name, [])]
+        if len(stored) != len(edges) or not np.allclose(stored, edges):
+            raise ValueError(f'Reference profile {path} was built with different {name} bins')
+    return reference
+
+
+def main():
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from torchvision import transforms
+    from model_manager import build_model, default_classes
+    from xray_io import load_xray, XRAY_EXTENSIONS
+
+    parser = argparse.ArgumentParser(description='Build a drift reference profile from a training split')
+    parser.add_argument('--data_dir', type=str, required=True, help='Image directory (e.g. data/train), searched recursively')
+    parser.add_argument('--weights', type=str, required=True, help='Checkpoint of the served model')
+    parser.add_argument('--arch', type=str, default='auto')
+    parser.add_argument('--output', type=str, default='drift_reference.json')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--limit', type=int, default=None, help='Use at most this many images (random sample)')
+    args = parser.parse_args()
+
+    # Must match app.py's image_transform
+    transform = transforms.Compose([
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+    model = build_model(args.weights, args.arch)
+    paths = sorted(os.path.join(root, f) for root, _, files in os.walk(args.data_dir)
+                   for f in files if f.lower().endswith(XRAY_EXTENSIONS))
+    if args.limit is not None and len(paths) > args.limit:
+        paths = sorted(np.random.default_rng(0).choice(paths, args.limit, replace=False).tolist())
+    with torch.no_grad():
+        num_classes = model(torch.zeros(1, 3, 224, 224)).shape[1]
+    # A single bucket larger than the data set: nothing is ever rotated out
+    monitor = DriftMonitor(default_classes(num_classes), window=len(paths) + 1, buckets=1)
+    for start in range(0, len(paths), args.batch_size):
+        images = [load_xray(p) for p in paths[start:start + args.batch_size]]
+        batch = torch.stack([transform(image) for image in images])
+        with torch.no_grad():
+            probabilities = torch.softmax(model(batch), dim=1)
+        monitor.update(batch, [image.info.get('original_size', image.size) for image in images], probabilities)
+        print(f'{min(start + args.batch_size, len(paths))}/{len(paths)} images')
+    with open(args.output, 'w') as f:
+        json.dump(monitor.profile(), f)
+    print(f'Reference profile of {monitor.total} images written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+Ensemble of served models with one decode and concurrent member forwards.
+
+The ensemble is described by a JSON file (ENSEMBLE_CONFIG in app.py) whose
+members are model names known to the ModelManager:
+
+    {
+        "members": [
+            {"model": "default", "weight": 0.6, "threads": 2},
+            {"model": "efficientnet", "weight": 0.4, "threads": 2, "transform": "center_crop",
+             "mapping": {"BACTERIAL_PNEUMONIA": "PNEUMONIA", "VIRAL_PNEUMONIA": "PNEUMONIA",
+                         "COVID": "PNEUMONIA", "NORMAL": "NORMAL", "TB": null, "NON_XRAY": null}}
+        ]
+    }
+
+The upload is decoded once. Each member has its own single-thread executor
+whose torch intra-op thread count is set to `threads` (by default the
+process's threads split evenly), so the members' forwards run side by side on
+disjoint thread budgets instead of one after another. `transform` is resize
+(the server's 224x224 resize, default) or center_crop (resize to 256 and crop
+224, as the EfficientNet-B0 was trained).
+
+Member outputs are mapped onto NORMAL/PNEUMONIA: binary members as they are,
+6-class EfficientNet members with DEFAULT_MAPPING unless `mapping` is given.
+Classes mapped to null are dropped and the rest renormalised. The mapped
+probabilities are averaged with the (normalised) weights.
+"""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torchvision import transforms
+
+from precision import run_model, pin_intraop_threads
+from model_manager import BINARY_CLASSES, EFFICIENTNET_CLASSES
+
+DEFAULT_MAPPING = {
+    'BACTERIAL_PNEUMONIA': 'PNEUMONIA',
+    'VIRAL_PNEUMONIA': 'PNEUMONIA',
+    'COVID': 'PNEUMONIA',
+    'NORMAL': 'NORMAL',
+    'TB': None,
+    'NON_XRAY': None,
+}
+NORMALIZE = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+TRANSFORMS = {
+    'resize': transforms.Compose([transforms.Resize((224, 224)), transforms.ToTensor(), NORMALIZE]),
+    'center_crop': transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224), transforms.ToTensor(),
+                                       NORMALIZE]),
+}
+# Below this much mapped probability a member has nothing to say about normal vs pneumonia
+MIN_MAPPED_MASS = 1e-3
+
+
+def mapping_matrix(classes, mapping=None):
+    """(num_classes, 2) 0/1 matrix sending each member class to NORMAL/PNEUMONIA (or nowhere)."""
+    classes = list(classes)
+    if mapping is None:
+        if classes == BINARY_CLASSES:
+            mapping = {c: c for c in classes}
+        elif sorted(classes) == sorted(EFFICIENTNET_CLASSES):
+            mapping = DEFAULT_MAPPING
+        else:
+            raise ValueError(f'No default mapping for classes {classes}; give one in the ensemble config')
+    missing = [c for c in classes if c not in mapping]
+    if missing:
+        raise ValueError(f'Mapping does not cover {missing}')
+    matrix = np.zeros((len(classes), len(BINARY_CLASSES)))
+    for i, c in enumerate(classes):
+        target = mapping[c]
+        if target is None:
+            continue
+        if target not in BINARY_CLASSES:
+            raise ValueError(f'{c} is mapped to {target}, not one of {BINARY_CLASSES}')
+        matrix[i, BINARY_CLASSES.index(target)] = 1.0
+    return matrix
+
+
+class EnsembleMember:
+    def __init__(self, model, weight=1.0, threads=None, transform='resize', mapping=None):
+        if transform not in TRANSFORMS:
+            raise ValueError(f"transform must be one of {', '.join(TRANSFORMS)}")
+        if weight < 0:
+            raise ValueError('weight must not be negative')
+        self.model = model
+        self.weight = float(weight)
+        self.threads = threads
+        self.transform = transform
+        self.mapping = mapping
+        self.matrix = None
+        self.executor = None
+
+
+class Ensemble:
+    def __init__(self, manager, members, device='cpu'):
+        if not members:
+            raise ValueError('An ensemble needs at least one member')
+        self.manager = manager
+        self.device = device
+        self.members = members
+        for member in members:
+            if member.model not in manager:
+                raise ValueError(f'Unknown model {member.model}')
+            entry = manager.entries[member.model]
+            # Classes of registry models without explicit names are only known once loaded
+            if entry.classes is not None:
+                member.matrix = mapping_matrix(entry.classes, member.mapping)
+        if len({m.model for m in members}) != len(members):
+            raise ValueError('Ensemble members must be different models')
+        total_threads = torch.get_num_threads()
+        unassigned = [m for m in members if m.threads is None]
+        spare = total_threads - sum(m.threads for m in members if m.threads is not None)
+        for member in unassigned:
+            member.threads = max(1, spare // len(unassigned))
+        for member in members:
+            member.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'ensemble-{member.model}',
+                                                 initializer=pin_intraop_threads, initargs=(member.threads,))
+
+    @classmethod
+    def from_config(cls, manager, path, device='cpu'):
+        with open(path) as f:
+            config = json.load(f)
+        members = [EnsembleMember(m['model'], weight=m.get('weight', 1.0), threads=m.get('threads'),
+                                  transform=m.get('transform', 'resize'), mapping=m.get('mapping'))
+                   for m in config['members']]
+        return cls(manager, members, device)
+
+    def version(self):
+        return '+'.join(f'{m.model}@{self.manager.entries[m.model].version}' for m in self.members)
+
+    def _run_member(self, member, image, submitted):
+        started = time.perf_counter()
+        with self.manager.acquire(member.model) as entry:
+            loaded = time.perf_counter()
+            if member.matrix is None:
+                member.matrix = mapping_matrix(entry.classes, member.mapping)
+            inputs = TRANSFORMS[member.transform](image).unsqueeze(0).to(self.device)
+            transformed = time.perf_counter()
+            with torch.no_grad():
+                outputs = run_model(entry.model, inputs, entry.extras.get('precision', 'fp32'))
+                probs = torch.softmax(outputs, dim=1)[0].cpu().numpy().astype(np.float64)
+            finished = time.perf_counter()
+        return probs, {
+            'queueMs': round((started - submitted) * 1000, 2),
+            'loadMs': round((loaded - started) * 1000, 2),
+            'transformMs': round((transformed - loaded) * 1000, 2),
+            'inferenceMs': round((finished - transformed) * 1000, 2),
+            'threads': member.threads,
+            'precision': entry.extras.get('precision', 'fp32'),
+        }
+
+    def predict(self, image):
+        """Combined NORMAL/PNEUMONIA probabilities of a decoded PIL image, with per-member details."""
+        start = time.perf_counter()
+        futures = [m.executor.submit(self._run_member, m, image, start) for m in self.members]
+        outputs = [f.result() for f in futures]
+        wall_ms = (time.perf_counter() - start) * 1000
+
+        combined = np.zeros(len(BINARY_CLASSES))
+        total_weight = 0.0
+        details = {}
+        for member, (probs, timings) in zip(self.members, outputs):
+            mapped = probs @ member.matrix
+            mass = mapped.sum()
+            contributes = mass >= MIN_MAPPED_MASS and member.weight > 0
+            if contributes:
+                mapped = mapped / mass
+                combined += member.weight * mapped
+                total_weight += member.weight
+            details[member.model] = dict(
+                timings,
+                weight=member.weight,
+                contributed=bool(contributes),
+                excludedMass=round(float(1 - mass), 4),
+                probabilities={c.lower(): round(float(p) * 100, 2) for c, p in zip(BINARY_CLASSES, mapped)},
+            )
+        if total_weight == 0:
+            raise ValueError('No ensemble member gave a normal/pneumonia probability')
+        member_ms = sum(d['transformMs'] + d['inferenceMs'] for d in details.values())
+        return combined / total_weight, {
+            'members': details,
+            'wallMs': round(wall_ms, 2),
+            # Sum of the members' work over the time the ensemble took: 2.0 is a perfect overlap of two members
+            'overlap': round(member_ms / wall_ms, 2) if wall_ms > 0 else None,
+        }
+
+    def close(self):
+        for member in self.members:
+            member.executor.shutdown(wait=True)
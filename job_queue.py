@@ -0,0 +1,252 @@
+"""
+Priority job queue with weighted fair queueing for asynchronous predictions.
+
+Jobs carry a priority class and a tenant (a clinic or doctor). Scheduling has
+two levels:
+
+    class level   urgent is strict priority; routine and bulk share the
+                  remaining capacity in proportion to their weights
+    tenant level  within a class, start-time fair queueing across tenants,
+                  so one clinic's back-fill cannot crowd out another's scans
+
+Worker threads pull the next job and run the handler on its payload. Finished
+jobs are kept for `retention` seconds so clients can poll for them.
+metrics() reports queue depth, in-flight jobs and wait-time percentiles per
+class.
+"""
+
+import time
+import uuid
+import heapq
+import threading
+from collections import deque
+
+import numpy as np
+
+PRIORITIES = ('urgent', 'routine', 'bulk')
+DEFAULT_CLASS_WEIGHTS = {'routine': 4, 'bulk': 1}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, payload, priority, tenant):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.priority = priority
+        self.tenant = tenant
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self._callbacks = []
+        self._callback_lock = threading.Lock()
+
+    def add_done_callback(self, fn):
+        """Call fn(job) once the job has finished (right away if it already has), on the worker thread."""
+        with self._callback_lock:
+            if not self.done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self):
+        with self._callback_lock:
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                print(f'Job {self.id} callback failed: {e}')
+
+    def to_dict(self):
+        info = {
+            'jobId': self.id,
+            'status': self.status,
+            'priority': self.priority,
+            'tenant': self.tenant,
+            'submittedAt': self.submitted,
+        }
+        if self.started is not None:
+            info['waitTime'] = round(self.started - self.submitted, 3)
+        if self.finished is not None:
+            info['serviceTime'] = round(self.finished - self.started, 3)
+        if self.status == 'done':
+            info['result'] = self.result
+        elif self.status == 'failed':
+            info['error'] = self.error
+        return info
+
+
+class _FairQueue:
+    """Start-time fair queueing over tenants: each job is tagged max(vtime, tenant's last finish)."""
+    def __init__(self, tenant_weights):
+        self.tenant_weights = tenant_weights
+        self.heap = []
+        self.last_finish = {}
+        self.vtime = 0.0
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, job):
+        start = max(self.vtime, self.last_finish.get(job.tenant, 0.0))
+        self.last_finish[job.tenant] = start + 1.0 / self.tenant_weights.get(job.tenant, 1.0)
+        heapq.heappush(self.heap, (start, self.seq, job))
+        self.seq += 1
+
+    def pop(self):
+        start, _, job = heapq.heappop(self.heap)
+        self.vtime = start
+        if not self.heap:
+            # Idle queue: no tenant has earned credit, so the tags can start over
+            self.last_finish.clear()
+            self.vtime = 0.0
+        return job
+
+    def tenants(self):
+        return len({job.tenant for _, _, job in self.heap})
+
+
+class JobScheduler:
+    def __init__(self, handler, num_workers=1, max_queued=10000, retention=3600,
+                 class_weights=None, tenant_weights=None, window=1000):
+        self.handler = handler
+        self.max_queued = max_queued
+        self.retention = retention
+        self.class_weights = dict(DEFAULT_CLASS_WEIGHTS, **(class_weights or {}))
+        self.queues = {p: _FairQueue(tenant_weights or {}) for p in PRIORITIES}
+        # Normalised service received by each weighted class (served / weight)
+        self.class_vtime = {p: 0.0 for p in PRIORITIES}
+        self.jobs = {}
+        self.finished = deque()
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.running = {p: 0 for p in PRIORITIES}
+        self.completed = {p: 0 for p in PRIORITIES}
+        self.failed = {p: 0 for p in PRIORITIES}
+        self.waits = {p: deque(maxlen=window) for p in PRIORITIES}
+        self.services = {p: deque(maxlen=window) for p in PRIORITIES}
+        self.workers = [threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+                        for i in range(num_workers)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join(timeout=5)
+
+    def submit(self, payload, priority='routine', tenant='anonymous'):
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of {', '.join(PRIORITIES)}")
+        job = Job(payload, priority, tenant)
+        with self.cond:
+            self._purge()
+            if sum(len(q) for q in self.queues.values()) >= self.max_queued:
+                raise QueueFull(f'{self.max_queued} jobs already queued')
+            queue = self.queues[priority]
+            if not len(queue) and priority in self.class_weights:
+                # A class returning from idle starts level with the busiest active class instead of
+                # spending service it "saved" while it had nothing queued
+                active = [self.class_vtime[p] for p in self.class_weights if len(self.queues[p])]
+                if active:
+                    self.class_vtime[priority] = max(self.class_vtime[priority], min(active))
+                else:
+                    self.class_vtime = {p: 0.0 for p in PRIORITIES}
+            queue.push(job)
+            self.jobs[job.id] = job
+            self.cond.notify()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def position(self, job):
+        """Jobs of the same class ahead of this one (approximate under fair queueing)."""
+        with self.cond:
+            queue = self.queues[job.priority]
+            tag = next((entry[:2] for entry in queue.heap if entry[2] is job), None)
+            return None if tag is None else sum(1 for entry in queue.heap if entry[:2] < tag)
+
+    def queued(self):
+        with self.cond:
+            return sum(len(q) for q in self.queues.values())
+
+    def _next_job(self):
+        if len(self.queues['urgent']):
+            return self.queues['urgent'].pop()
+        ready = [p for p in self.class_weights if len(self.queues[p])]
+        if not ready:
+            return None
+        priority = min(ready, key=lambda p: (self.class_vtime[p], PRIORITIES.index(p)))
+        self.class_vtime[priority] += 1.0 / self.class_weights[priority]
+        return self.queues[priority].pop()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                job = self._next_job()
+                while job is None and not self.stopping:
+                    self.cond.wait()
+                    job = self._next_job()
+                if job is None:
+                    return
+                job.status = 'running'
+                job.started = time.time()
+                self.running[job.priority] += 1
+                self.waits[job.priority].append(job.started - job.submitted)
+            try:
+                job.result = self.handler(job.payload)
+                job.status = 'done'
+            except Exception as e:
+                job.error = str(getattr(e, 'detail', e))
+                job.status = 'failed'
+            job.finished = time.time()
+            job.payload = None
+            with self.cond:
+                self.running[job.priority] -= 1
+                (self.completed if job.status == 'done' else self.failed)[job.priority] += 1
+                self.services[job.priority].append(job.finished - job.started)
+                self.finished.append(job)
+            job._finish()
+
+    def _purge(self):
+        cutoff = time.time() - self.retention
+        while self.finished and self.finished[0].finished < cutoff:
+            self.jobs.pop(self.finished.popleft().id, None)
+
+    @staticmethod
+    def _percentiles(values):
+        if not values:
+            return None
+        p50, p95, p99 = np.percentile(np.asarray(values), [50, 95, 99])
+        return {'p50': round(float(p50), 4), 'p95': round(float(p95), 4), 'p99': round(float(p99), 4),
+                'max': round(float(max(values)), 4)}
+
+    def metrics(self):
+        with self.cond:
+            classes = {}
+            for p in PRIORITIES:
+                classes[p] = {
+                    'queued': len(self.queues[p]),
+                    'tenants': self.queues[p].tenants(),
+                    'running': self.running[p],
+                    'completed': self.completed[p],
+                    'failed': self.failed[p],
+                    'weight': self.class_weights.get(p, 'strict'),
+                    'waitSeconds': self._percentiles(list(self.waits[p])),
+                    'serviceSeconds': self._percentiles(list(self.services[p])),
+                }
+            return {'workers': len(self.workers), 'maxQueued': self.max_queued, 'classes': classes}
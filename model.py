@@ -29,6 +29,13 @@ class PneumoniaModel(nn.Module):
     def forward(self, x):
         return self.backbone(x)
     
+    def extract_features(self, x):
+        # Pooled 2048-d backbone output, i.e. the input of the classification head
+        b = self.backbone
+        x = b.maxpool(b.relu(b.bn1(b.conv1(x))))
+        x = b.layer4(b.layer3(b.layer2(b.layer1(x))))
+        return torch.flatten(b.avgpool(x), 1)
+    
     def save(self, path):
         torch.save(self.state_dict(), path)
     
@@ -38,14 +45,14 @@ class PneumoniaModel(nn.Module):
 
 class SimpleConvNet(nn.Module):
     """A simpler CNN model if you have limited computational resources"""
-    def __init__(self):
+    def __init__(self, num_classes=2):
         super(SimpleConvNet, self).__init__()
         self.conv1 = nn.Conv2d(3, 32, kernel_size=3, padding=1)
         self.pool = nn.MaxPool2d(2, 2)
         self.conv2 = nn.Conv2d(32, 64, kernel_size=3, padding=1)
         self.conv3 = nn.Conv2d(64, 128, kernel_size=3, padding=1)
         self.fc1 = nn.Linear(128 * 28 * 28, 512)
-        self.fc2 = nn.Linear(512, 2)
+        self.fc2 = nn.Linear(512, num_classes)
         self.dropout = nn.Dropout(0.3)
         
     def forward(self, x):
@@ -64,3 +71,57 @@ class SimpleConvNet(nn.Module):
     
     def load(self, path):
         self.load_state_dict(torch.load(path))
+
+
+class DepthwiseSeparableConv(nn.Module):
+    """3x3 depthwise conv followed by a 1x1 pointwise conv, each with BatchNorm and ReLU"""
+    def __init__(self, in_channels, out_channels, stride=1):
+        super(DepthwiseSeparableConv, self).__init__()
+        self.depthwise = nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=stride, padding=1,
+                                   groups=in_channels, bias=False)
+        self.bn1 = nn.BatchNorm2d(in_channels)
+        self.pointwise = nn.Conv2d(in_channels, out_channels, kernel_size=1, bias=False)
+        self.bn2 = nn.BatchNorm2d(out_channels)
+    
+    def forward(self, x):
+        x = F.relu(self.bn1(self.depthwise(x)))
+        return F.relu(self.bn2(self.pointwise(x)))
+
+
+class CompactConvNet(nn.Module):
+    """Low-resource alternative to SimpleConvNet.
+
+    Depthwise-separable blocks and global average pooling replace the
+    128*28*28 -> 512 fully connected layer, so the model has ~0.5M parameters
+    instead of ~51M and accepts any input size.
+    """
+    def __init__(self, num_classes=2):
+        super(CompactConvNet, self).__init__()
+        self.stem = nn.Sequential(
+            nn.Conv2d(3, 32, kernel_size=3, stride=2, padding=1, bias=False),  # 112x112
+            nn.BatchNorm2d(32),
+            nn.ReLU(inplace=True)
+        )
+        self.features = nn.Sequential(
+            DepthwiseSeparableConv(32, 64),
+            DepthwiseSeparableConv(64, 128, stride=2),   # 56x56
+            DepthwiseSeparableConv(128, 128),
+            DepthwiseSeparableConv(128, 256, stride=2),  # 28x28
+            DepthwiseSeparableConv(256, 256),
+            DepthwiseSeparableConv(256, 512, stride=2),  # 14x14
+            DepthwiseSeparableConv(512, 512, stride=2),  # 7x7
+        )
+        self.pool = nn.AdaptiveAvgPool2d(1)
+        self.dropout = nn.Dropout(0.3)
+        self.fc = nn.Linear(512, num_classes)
+    
+    def forward(self, x):
+        x = self.features(self.stem(x))
+        x = torch.flatten(self.pool(x), 1)
+        return self.fc(self.dropout(x))
+    
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+    
+    def load(self, path):
+        self.load_state_dict(torch.load(path))
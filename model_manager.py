@@ -0,0 +1,265 @@
+"""
+Memory-budgeted registry of models that are loaded on first use.
+
+Models are declared in a JSON registry (MODEL_REGISTRY in app.py):
+
+    {
+        "resnet50":     {"path": "best_model.pth"},
+        "efficientnet": {"path": "pneumonia-ml-validation/best_efficientnetb0-2.pth", "pinned": true},
+        "site-lagos":   {"path": "sites/lagos.pth", "arch": "compact"}
+    }
+
+arch is one of auto (default), pneumonia (ResNet50 PneumoniaModel), compact,
+simple or efficientnet_b0; `classes` overrides the class names. A model is
+loaded the first time it is requested. When loading it would exceed the
+memory budget, idle models (none in use) are evicted least-recently-used
+first. Pinned models are never evicted, and "hot" models (at least
+hot_requests uses within hot_window seconds) only go once no cold idle model
+is left.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+from torchvision.models import efficientnet_b0
+
+from model import PneumoniaModel, SimpleConvNet, CompactConvNet
+
+BINARY_CLASSES = ['NORMAL', 'PNEUMONIA']
+EFFICIENTNET_CLASSES = ['BACTERIAL_PNEUMONIA', 'COVID', 'NON_XRAY', 'NORMAL', 'TB', 'VIRAL_PNEUMONIA']
+
+
+def _efficientnet(num_classes):
+    net = efficientnet_b0(weights=None)
+    net.classifier[1] = nn.Linear(net.classifier[1].in_features, num_classes)
+    return net
+
+
+def _num_classes(state_dict, key, default=2):
+    return state_dict[key].shape[0] if key in state_dict else default
+
+
+BUILDERS = {
+    'pneumonia': lambda sd: PneumoniaModel(pretrained=False, freeze_backbone=False),
+    'compact': lambda sd: CompactConvNet(num_classes=_num_classes(sd, 'fc.weight')),
+    'simple': lambda sd: SimpleConvNet(num_classes=_num_classes(sd, 'fc2.weight')),
+    'efficientnet_b0': lambda sd: _efficientnet(_num_classes(sd, 'classifier.1.weight', len(EFFICIENTNET_CLASSES))),
+}
+
+
+def build_model(path, arch='auto'):
+    """Instantiate and load a checkpoint; 'auto' tries every known architecture."""
+    state_dict = torch.load(path, map_location='cpu')
+    errors = []
+    for name in (BUILDERS if arch == 'auto' else [arch]):
+        try:
+            net = BUILDERS[name](state_dict)
+            net.load_state_dict(state_dict)
+        except Exception as e:
+            errors.append(f'{name}: {e}')
+            continue
+        return net.eval()
+    raise RuntimeError(f'{path} does not match any known architecture ({"; ".join(errors)[:500]})')
+
+
+def checkpoint_version(path):
+    """Short content hash of a checkpoint, recorded as the model version."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def resident_bytes(net):
+    return sum(t.numel() * t.element_size() for t in list(net.parameters()) + list(net.buffers()))
+
+
+def default_classes(num_classes):
+    if num_classes == 2:
+        return list(BINARY_CLASSES)
+    if num_classes == len(EFFICIENTNET_CLASSES):
+        return list(EFFICIENTNET_CLASSES)
+    return [f'class_{i}' for i in range(num_classes)]
+
+
+class ModelEntry:
+    def __init__(self, name, path=None, arch='auto', classes=None, pinned=False):
+        self.name = name
+        self.path = path
+        self.arch = arch
+        self.classes = classes
+        self.pinned = pinned
+        self.model = None
+        self.extras = {}
+        self.load_lock = threading.Lock()
+        # Set once model and extras are fully prepared; acquire() only hands out ready entries
+        self.ready = threading.Event()
+        self.in_use = 0
+        self.resident = 0
+        self.reserved = 0
+        self.loads = 0
+        self.evictions = 0
+        self.requests = 0
+        self.last_used = 0.0
+        self.load_seconds = None
+        self.recent = None
+        self.version = None
+
+    def stats(self, hot):
+        return {
+            'loaded': self.ready.is_set(),
+            'residentMB': round(self.resident / 2 ** 20, 1),
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'requests': self.requests,
+            'inUse': self.in_use,
+            'pinned': self.pinned,
+            'hot': hot,
+            'lastUsed': self.last_used or None,
+            'loadSeconds': self.load_seconds,
+            'classes': self.classes,
+            'version': self.version,
+        }
+
+
+class ModelManager:
+    def __init__(self, budget_bytes, prepare=None, hot_requests=20, hot_window=300):
+        """prepare(entry) runs after each load (e.g. precision selection, hooks) and may fill entry.extras."""
+        self.budget = budget_bytes
+        self.prepare = prepare
+        self.hot_requests = hot_requests
+        self.hot_window = hot_window
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def load_registry(self, path):
+        with open(path) as f:
+            registry = json.load(f)
+        for name, spec in registry.items():
+            if not os.path.exists(spec['path']):
+                raise FileNotFoundError(f"{name}: {spec['path']} does not exist")
+            self.register(name, spec['path'], spec.get('arch', 'auto'), spec.get('classes'), spec.get('pinned', False))
+
+    def register(self, name, path, arch='auto', classes=None, pinned=False):
+        if name in self.entries:
+            raise ValueError(f'Model {name} is already registered')
+        if arch != 'auto' and arch not in BUILDERS:
+            raise ValueError(f"{name}: arch must be auto or one of {', '.join(BUILDERS)}")
+        entry = ModelEntry(name, path, arch, classes, pinned)
+        entry.recent = deque(maxlen=self.hot_requests)
+        self.entries[name] = entry
+        return entry
+
+    def register_loaded(self, name, net, classes, pinned=True, version=None, **extras):
+        """Account for a model loaded outside the manager (e.g. the server's default model)."""
+        entry = self.register(name, None, classes=classes, pinned=pinned)
+        entry.version = version
+        entry.model = net
+        entry.extras = extras
+        entry.resident = resident_bytes(net)
+        entry.loads = 1
+        entry.ready.set()
+        return entry
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def used_bytes(self):
+        return sum(e.resident + e.reserved for e in self.entries.values())
+
+    def _is_hot(self, entry, now):
+        return len(entry.recent) == self.hot_requests and now - entry.recent[0] <= self.hot_window
+
+    def _make_room(self, needed, keep, strict=True):
+        """Evict idle, unpinned models (cold before hot, least recently used first) until needed bytes fit."""
+        now = time.time()
+        while self.used_bytes() + needed > self.budget:
+            candidates = [e for e in self.entries.values()
+                          if e.ready.is_set() and e.in_use == 0 and not e.pinned and e is not keep]
+            if not candidates:
+                if strict:
+                    raise MemoryError(f'Loading {keep.name} needs {needed / 2 ** 20:.0f} MB but only '
+                                      f'{(self.budget - self.used_bytes()) / 2 ** 20:.0f} MB is free after evicting idle models')
+                return
+            victim = min(candidates, key=lambda e: (self._is_hot(e, now), e.last_used))
+            victim.ready.clear()
+            victim.model = None
+            victim.extras = {}
+            victim.resident = 0
+            victim.evictions += 1
+
+    def _load(self, entry):
+        estimate = os.path.getsize(entry.path)
+        with self.lock:
+            self._make_room(estimate, entry)
+            entry.reserved = estimate
+        try:
+            start = time.time()
+            net = build_model(entry.path, entry.arch)
+            entry.version = checkpoint_version(entry.path)
+            entry.model = net
+            if entry.classes is None:
+                entry.classes = default_classes(self._output_size(net))
+            entry.extras = {}
+            if self.prepare is not None:
+                self.prepare(entry)
+            entry.load_seconds = round(time.time() - start, 2)
+        except Exception:
+            entry.model = None
+            entry.extras = {}
+            with self.lock:
+                entry.reserved = 0
+            raise
+        with self.lock:
+            entry.reserved = 0
+            entry.resident = resident_bytes(entry.model)
+            entry.loads += 1
+            # Published only now: prepare() may still have been converting the model or adding hooks
+            entry.ready.set()
+            # The estimate came from the file size; settle any difference now that the real size is known
+            self._make_room(0, entry, strict=False)
+
+    @staticmethod
+    def _output_size(net):
+        for module in reversed(list(net.modules())):
+            if isinstance(module, nn.Linear):
+                return module.out_features
+        raise ValueError('Model has no linear output layer')
+
+    @contextmanager
+    def acquire(self, name):
+        """Yield the loaded ModelEntry for name, loading it first if needed; it cannot be evicted while held."""
+        entry = self.entries.get(name)
+        if entry is None:
+            raise KeyError(name)
+        with self.lock:
+            entry.in_use += 1
+            entry.requests += 1
+            entry.last_used = time.time()
+            entry.recent.append(entry.last_used)
+        try:
+            if not entry.ready.is_set():
+                with entry.load_lock:
+                    if not entry.ready.is_set():
+                        self._load(entry)
+            yield entry
+        finally:
+            with self.lock:
+                entry.in_use -= 1
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return {
+                'budgetMB': round(self.budget / 2 ** 20, 1),
+                'usedMB': round(self.used_bytes() / 2 ** 20, 1),
+                'models': {name: e.stats(self._is_hot(e, now)) for name, e in self.entries.items()},
+            }
@@ -0,0 +1,185 @@
+"""
+Perceptual-hash near-duplicate detection.
+
+phash() is a 64-bit DCT hash of the downscaled grayscale image, so the same
+film re-photographed, re-exported or re-compressed lands within a few bits of
+the original. PHashIndex answers Hamming-radius queries with multi-index
+hashing: the hash is split into `chunks` 16-bit pieces, and by the pigeonhole
+principle any hash within radius r agrees with the query on at least one piece
+up to floor(r / chunks) bits, so only a few exact table lookups are needed.
+
+app.py uses it to flag (and optionally reuse the result of) near-duplicate
+uploads. The CLI dedupes ImageFolder training data:
+
+    python phash_index.py --dedupe_dir data --radius 4 --output duplicates.txt
+    python pneumonia-ml-validation/train.py --data_dir data --exclude_list duplicates.txt
+"""
+
+import os
+import json
+import argparse
+import threading
+from itertools import combinations
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8
+IMAGE_SIZE = 32
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+
+_DCT = _dct_matrix(IMAGE_SIZE)
+
+
+def phash(image):
+    """64-bit perceptual hash of a PIL image, as an int."""
+    gray = image.convert('L').resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    # The DC term only encodes overall brightness, so it is left out of the median
+    bits = (low > np.median(low.flatten()[1:])).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class PHashIndex:
+    """Multi-index hash table over 64-bit hashes, optionally persisted to a .jsonl file."""
+    def __init__(self, path=None, chunks=4):
+        if 64 % chunks or 64 // chunks > 32:
+            raise ValueError('chunks must divide 64 into pieces of at most 32 bits')
+        self.path = path
+        self.chunks = chunks
+        self.chunk_bits = 64 // chunks
+        self.tables = [{} for _ in range(chunks)]
+        self.hashes = []
+        self.entries = []
+        self.lock = threading.Lock()
+        self._flip_masks = {}
+        self.file = None
+        if path:
+            if os.path.exists(path):
+                with open(path) as f:
+                    for line in f:
+                        if line.endswith('\n'):
+                            record = json.loads(line)
+                            self._insert(int(record.pop('hash'), 16), record)
+            self.file = open(path, 'a')
+
+    def _pieces(self, h):
+        mask = (1 << self.chunk_bits) - 1
+        return [(h >> (i * self.chunk_bits)) & mask for i in range(self.chunks)]
+
+    def _masks(self, radius):
+        """All chunk-width bit masks with at most `radius` bits set."""
+        if radius not in self._flip_masks:
+            masks = []
+            for r in range(radius + 1):
+                for bits in combinations(range(self.chunk_bits), r):
+                    masks.append(sum(1 << b for b in bits))
+            self._flip_masks[radius] = masks
+        return self._flip_masks[radius]
+
+    def _insert(self, h, entry):
+        idx = len(self.hashes)
+        self.hashes.append(h)
+        self.entries.append(entry)
+        for table, piece in zip(self.tables, self._pieces(h)):
+            table.setdefault(piece, []).append(idx)
+        return idx
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, h, **entry):
+        with self.lock:
+            idx = self._insert(h, entry)
+            if self.file is not None:
+                self.file.write(json.dumps(dict(entry, hash=f'{h:016x}')) + '\n')
+                self.file.flush()
+        return idx
+
+    def query(self, h, radius):
+        """[(distance, entry), ...] for every stored hash within `radius` bits, closest first."""
+        masks = self._masks(radius // self.chunks)
+        candidates = set()
+        with self.lock:
+            for table, piece in zip(self.tables, self._pieces(h)):
+                for mask in masks:
+                    candidates.update(table.get(piece ^ mask, ()))
+            hits = [(hamming(h, self.hashes[i]), i) for i in candidates]
+            return [(d, self.entries[i]) for d, i in sorted(hits) if d <= radius]
+
+    def nearest(self, h, radius):
+        hits = self.query(h, radius)
+        return hits[0] if hits else None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def _hash_file(path):
+    try:
+        with Image.open(path) as image:
+            return path, phash(image)
+    except Exception:
+        return path, None
+
+
+def find_duplicates(data_dir, radius=4, num_workers=None):
+    """Hash every image under data_dir and return (duplicate_path, kept_path, distance) triples.
+
+    Files are visited in sorted order and the first copy seen is kept, so
+    train/val/test splits are walked in that order and later-split copies of a
+    training image are the ones reported.
+    """
+    paths = []
+    for root, _, files in os.walk(data_dir):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    paths.sort(key=lambda p: (0 if '/train/' in p.replace(os.sep, '/') else 1, p))
+
+    index = PHashIndex()
+    duplicates = []
+    with Pool(num_workers) as pool:
+        for path, h in pool.imap(_hash_file, paths, chunksize=64):
+            if h is None:
+                print(f'Could not read {path}')
+                continue
+            hit = index.nearest(h, radius)
+            if hit is not None:
+                duplicates.append((path, hit[1]['file'], hit[0]))
+            else:
+                index.add(h, file=path)
+    return duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find near-duplicate images with perceptual hashes')
+    parser.add_argument('--dedupe_dir', type=str, required=True, help='Directory to scan (e.g. a dataset root with train/val/test)')
+    parser.add_argument('--radius', type=int, default=4, help='Maximum Hamming distance counted as a duplicate')
+    parser.add_argument('--output', type=str, default=None, help='Optional: write duplicate paths (one per line) for --exclude_list')
+    parser.add_argument('--num_workers', type=int, default=None, help='Hashing processes (default: all cores)')
+    args = parser.parse_args()
+
+    duplicates = find_duplicates(args.dedupe_dir, args.radius, args.num_workers)
+    for path, kept, distance in duplicates:
+        print(f'{path} duplicates {kept} (distance {distance})')
+    print(f'Found {len(duplicates)} near-duplicates')
+    if args.output:
+        with open(args.output, 'w') as f:
+            for path, _, _ in duplicates:
+                f.write(os.path.abspath(path) + '\n')
+
+
+if __name__ == '__main__':
+    main()
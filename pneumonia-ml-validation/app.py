@@ -2,11 +2,21 @@ import torch
 import torch.nn as nn
 from torchvision.models import efficientnet_b0, EfficientNet_B0_Weights
 from torchvision import transforms
-from fastapi import FastAPI, File, UploadFile
-from PIL import Image
-import io
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 import numpy as np
+import os
+import sys
+import logging
+import base64
+from typing import Optional
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from precision import select_precision, run_model, load_reference_batch
+from cam import ActivationMaps, overlay_png
+from xray_io import load_xray
+
+logging.basicConfig(level=logging.INFO)
 
 app = FastAPI()
 
@@ -42,11 +52,23 @@ data_transform = transforms.Compose([
     transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 ])
 
+# fp32, bf16_autocast or bf16, verified against fp32 on PRECISION_REFERENCE_DIR (falls back to fp32)
+reference_dir = os.getenv('PRECISION_REFERENCE_DIR')
+precision = select_precision(
+    model, os.getenv('INFERENCE_PRECISION', 'fp32'),
+    load_reference_batch(reference_dir, data_transform) if reference_dir else None,
+    allow_emulated=os.getenv('PRECISION_ALLOW_EMULATED') == '1')
+
+# Heatmaps come from the prediction forward itself (CAM over the last feature map)
+activation_maps = ActivationMaps(model)
+heatmap_crop = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224)])
+
 @app.get("/")
 async def root():
     return {
         "message": "EfficientNetB0 Validation Model API is running",
-        "classes": class_names
+        "classes": class_names,
+        "precision": precision
     }
 
 @app.get("/health")
@@ -54,17 +76,27 @@ async def health():
     return {"status": "ok"}
 
 @app.post("/predict")
-async def predict(file: UploadFile = File(...)):
+async def predict(file: UploadFile = File(...), heatmap: Optional[str] = Form(None)):
+    if heatmap not in (None, "grid", "overlay"):
+        raise HTTPException(status_code=400, detail="heatmap must be grid or overlay")
     image_bytes = await file.read()
-    image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+    image = load_xray(image_bytes)
     input_tensor = data_transform(image).unsqueeze(0)
     with torch.no_grad():
-        outputs = model(input_tensor)
+        outputs = run_model(model, input_tensor, precision)
         probabilities = torch.softmax(outputs, dim=1).cpu().numpy()[0]
         pred_idx = int(np.argmax(probabilities))
         predicted_class = class_names[pred_idx]
         confidence = float(probabilities[pred_idx]) * 100  # as percentage
-    return {
+    result = {
         "prediction": predicted_class,
         "confidence": round(confidence, 2)
-    }
\ No newline at end of file
+    }
+    if heatmap is not None:
+        heat = activation_maps.heatmaps([pred_idx])[0]
+        if heatmap == "grid":
+            result["heatmap"] = np.round(heat, 3).tolist()
+        else:
+            # The model only saw the centre crop, so overlay on that region
+            result["heatmapOverlay"] = base64.b64encode(overlay_png(heatmap_crop(image), heat)).decode("ascii")
+    return result
\ No newline at end of file
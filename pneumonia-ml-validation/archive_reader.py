@@ -0,0 +1,146 @@
+"""
+Sequential image reading from tar (.tar, .tar.gz/.tgz, .tar.bz2, .tar.xz) and
+zip archives, without extracting them.
+
+Members are read one at a time in archive order: tar files through tarfile's
+stream mode, zip files in local-header order. Only the member being read and
+a bounded window of batches waiting to be decoded are held in memory, so the
+archive can be far larger than RAM. The label of a member is the name of the
+directory holding it (chest_xray/test/NORMAL/img1.png -> NORMAL).
+
+    python batch_inference.py --data_dir bundle.tar.gz --output results.jsonl
+
+Images are decoded from the member bytes in a worker pool and come out in
+archive order as (inputs, [(file, class_name), ...]) batches, where file is
+<archive>/<member>.
+"""
+
+import os
+import sys
+import zipfile
+import tarfile
+import posixpath
+from collections import deque
+from multiprocessing import Pool
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from xray_io import load_xray, XRAY_EXTENSIONS
+
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.zip')
+
+
+def is_archive(path):
+    return os.path.isfile(path) and path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def member_label(name):
+    """Class of a member: its parent directory. None for files at the archive root or not images."""
+    name = posixpath.normpath(name.lstrip('/'))
+    parent, base = posixpath.split(name)
+    if not parent or base.startswith('.') or '__MACOSX' in parent.split('/'):
+        return None
+    if not base.lower().endswith(XRAY_EXTENSIONS):
+        return None
+    return posixpath.basename(parent)
+
+
+def iter_members(path, keep=None):
+    """Yield (member name, class name, bytes) for the images in archive order.
+
+    keep(name, class_name) -> bool decides which members are read; the others are skipped
+    without being decompressed into memory (for compressed tars they are still inflated and discarded).
+    """
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            # Local-header order reads the file front to back
+            for info in sorted(archive.infolist(), key=lambda i: i.header_offset):
+                label = None if info.is_dir() else member_label(info.filename)
+                if label is None or (keep is not None and not keep(info.filename, label)):
+                    continue
+                yield info.filename, label, archive.read(info)
+    else:
+        with tarfile.open(path, 'r|*', bufsize=1 << 20) as archive:
+            for info in archive:
+                label = member_label(info.name) if info.isfile() else None
+                if label is None or (keep is not None and not keep(info.name, label)):
+                    continue
+                yield info.name, label, archive.extractfile(info).read()
+
+
+def list_members(path, keep=None):
+    """(member name, class name) of every image, read from headers only (a full pass for compressed tars)."""
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            infos = sorted(archive.infolist(), key=lambda i: i.header_offset)
+            names = [i.filename for i in infos if not i.is_dir()]
+    else:
+        # Random-access mode seeks over member data in uncompressed tars
+        with tarfile.open(path, 'r:*') as archive:
+            names = [info.name for info in archive if info.isfile()]
+    members = [(name, member_label(name)) for name in names]
+    return [(name, label) for name, label in members
+            if label is not None and (keep is None or keep(name, label))]
+
+
+_transform = None
+
+
+def _set_transform(transform):
+    global _transform
+    _transform = transform
+
+
+def _init_worker(transform):
+    _set_transform(transform)
+    # One decode per process; torch's intra-op threads would only oversubscribe the CPUs
+    torch.set_num_threads(1)
+
+
+def _decode_batch(items):
+    tensors = []
+    for name, data in items:
+        try:
+            tensors.append(_transform(load_xray(data)))
+        except Exception as e:
+            raise ValueError(f'Cannot decode archive member {name}: {e}') from e
+    return torch.stack(tensors)
+
+
+def archive_batches(path, transform, batch_size=32, num_workers=4, prefetch_factor=4, keep=None):
+    """Yield (inputs, [(file, class_name), ...]) batches in archive order.
+
+    Decoding runs in num_workers processes (0 = this process) with at most
+    num_workers * prefetch_factor batches read but not yet returned.
+    """
+    def read_batches():
+        batch = []
+        for name, label, data in iter_members(path, keep):
+            batch.append((name, label, data))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def files(batch):
+        return [(f'{path}/{name}', label) for name, label, _ in batch]
+
+    if num_workers == 0:
+        _set_transform(transform)
+        for batch in read_batches():
+            yield _decode_batch([(name, data) for name, _, data in batch]), files(batch)
+        return
+
+    with Pool(num_workers, initializer=_init_worker, initargs=(transform,)) as pool:
+        pending = deque()
+        for batch in read_batches():
+            pending.append((pool.apply_async(_decode_batch, ([(name, data) for name, _, data in batch],)),
+                            files(batch)))
+            if len(pending) >= num_workers * prefetch_factor:
+                result, batch_files = pending.popleft()
+                yield result.get(), batch_files
+        while pending:
+            result, batch_files = pending.popleft()
+            yield result.get(), batch_files
@@ -1,12 +1,22 @@
 import torch
 import torch.nn as nn
-from torchvision.models import efficientnet_b0, EfficientNet_B0_Weights
+from torchvision.models import efficientnet_b0
 from torchvision import transforms
-from PIL import Image
+from torch.utils.data import Dataset, DataLoader
 import os
+import sys
+import time
+import hashlib
 import argparse
 import json
 import csv
+from evaluation import PredictionStore
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from precision import PRECISIONS, select_precision, run_model
+from cam import ActivationMaps, HeatmapStore
+from xray_io import load_xray, XRAY_EXTENSIONS
+from archive_reader import is_archive, iter_members, list_members, archive_batches
 
 # Define class names in the correct order
 class_names = [
@@ -18,12 +28,9 @@ class_names = [
     'VIRAL_PNEUMONIA'
 ]
 
-# Load model
-model = efficientnet_b0(weights=EfficientNet_B0_Weights.IMAGENET1K_V1)
-num_ftrs = model.classifier[1].in_features
-model.classifier[1] = nn.Linear(num_ftrs, len(class_names))
-model.load_state_dict(torch.load('best_efficientnetb0-2.pth', map_location='cpu'))
-model.eval()
+# DICOM and 16-bit TIFF are decoded (windowed and reduced) by xray_io
+IMAGE_EXTENSIONS = XRAY_EXTENSIONS
+RESULT_FIELDS = ['file', 'predicted', 'actual', 'correct']
 
 data_transform = transforms.Compose([
     transforms.Resize(256),
@@ -32,8 +39,23 @@ data_transform = transforms.Compose([
     transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 ])
 
+# Loaded lazily so that DataLoader workers never build a copy of the model
+model = None
+
+def load_model(weights_path='best_efficientnetb0-2.pth'):
+    # ImageNet weights would be overwritten by the checkpoint, so skip the download
+    net = efficientnet_b0(weights=None)
+    num_ftrs = net.classifier[1].in_features
+    net.classifier[1] = nn.Linear(num_ftrs, len(class_names))
+    net.load_state_dict(torch.load(weights_path, map_location='cpu'))
+    net.eval()
+    return net
+
 def predict_image(image_path):
-    image = Image.open(image_path).convert('RGB')
+    global model
+    if model is None:
+        model = load_model()
+    image = load_xray(image_path)
     input_tensor = data_transform(image).unsqueeze(0)
     with torch.no_grad():
         outputs = model(input_tensor)
@@ -41,46 +63,353 @@ def predict_image(image_path):
         predicted_class = class_names[pred.item()]
     return predicted_class
 
-def main():
-    parser = argparse.ArgumentParser(description='Batch inference for EfficientNetB0 multiclass model')
-    parser.add_argument('--data_dir', type=str, required=True, help='Directory with subfolders for each class')
-    parser.add_argument('--output', type=str, default=None, help='Optional: path to save predictions as JSON')
-    args = parser.parse_args()
-
-    total = 0
-    correct = 0
-    results = []
-
-    for class_name in os.listdir(args.data_dir):
-        class_dir = os.path.join(args.data_dir, class_name)
+def list_images(data_dir):
+    """Return (path, class_name) pairs for every image under data_dir/<class>/."""
+    samples = []
+    for class_name in os.listdir(data_dir):
+        class_dir = os.path.join(data_dir, class_name)
         if not os.path.isdir(class_dir):
             continue
         for fname in os.listdir(class_dir):
-            if not fname.lower().endswith(('.png', '.jpg', '.jpeg')):
+            if not fname.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            samples.append((os.path.join(class_dir, fname), class_name))
+    return samples
+
+def shard_of(path, data_dir, num_shards):
+    """Stable shard id for path: hashes the path relative to data_dir so every machine agrees."""
+    rel = os.path.relpath(path, data_dir).replace(os.sep, '/')
+    digest = hashlib.md5(rel.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards
+
+def select_shard(samples, data_dir, shard_index, num_shards):
+    if num_shards <= 1:
+        return samples
+    return [s for s in samples if shard_of(s[0], data_dir, num_shards) == shard_index]
+
+def read_completed(path):
+    """Scan an existing .jsonl result file for resume.
+
+    Returns (completed_files, total, correct). A torn last line left by a crash
+    is truncated away so the file can be appended to safely.
+    """
+    completed = set()
+    total = 0
+    correct = 0
+    good_offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b'\n'):
+                break
+            good_offset += len(line)
+            if row['file'] in completed:
                 continue
-            img_path = os.path.join(class_dir, fname)
-            pred = predict_image(img_path)
-            is_correct = (pred == class_name)
-            results.append({'file': img_path, 'predicted': pred, 'actual': class_name, 'correct': is_correct})
+            completed.add(row['file'])
             total += 1
-            correct += int(is_correct)
-            print(f'{img_path}: predicted={pred}, actual={class_name}, correct={is_correct}')
+            correct += int(row['correct'])
+    if good_offset != os.path.getsize(path):
+        with open(path, 'r+b') as f:
+            f.truncate(good_offset)
+    return completed, total, correct
+
+class ImageListDataset(Dataset):
+    """Decodes images from a list of (path, class_name) pairs inside DataLoader workers."""
+    def __init__(self, samples, transform=data_transform):
+        self.samples = samples
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        path, _ = self.samples[idx]
+        image = load_xray(path)
+        return self.transform(image), idx
+
+class ResultWriter:
+    """Streams result rows to .jsonl, .csv or .json as they are produced.
+
+    Output is flushed and fsync'd every flush_every rows so that a crashed
+    .jsonl run can be resumed from what reached the disk.
+    """
+    def __init__(self, path, append=False, flush_every=256):
+        self.path = path
+        self.count = 0
+        self.flush_every = flush_every
+        if append:
+            if not path.endswith('.jsonl'):
+                raise ValueError('Only .jsonl outputs can be appended to')
+            self.format = 'jsonl'
+            self.file = open(path, 'a')
+        elif path.endswith('.csv'):
+            self.format = 'csv'
+            self.file = open(path, 'w', newline='')
+            self.writer = csv.DictWriter(self.file, fieldnames=RESULT_FIELDS)
+            self.writer.writeheader()
+        elif path.endswith('.jsonl'):
+            self.format = 'jsonl'
+            self.file = open(path, 'w')
+        else:
+            # Plain JSON keeps the original list-of-objects layout, written incrementally
+            self.format = 'json'
+            self.file = open(path, 'w')
+            self.file.write('[')
+
+    def write(self, row):
+        if self.format == 'csv':
+            self.writer.writerow(row)
+        elif self.format == 'jsonl':
+            self.file.write(json.dumps(row) + '\n')
+        else:
+            self.file.write((',' if self.count else '') + '\n  ' + json.dumps(row))
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.format == 'json':
+            self.file.write('\n]' if self.count else ']')
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.close()
+
+class ProgressMeter:
+    """Single-line throughput / ETA display on stderr; total=None shows throughput only."""
+    def __init__(self, total, interval=0.5, stream=sys.stderr):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.start = time.time()
+        self.last = 0.0
+        self.done = 0
+
+    def update(self, n):
+        self.done += n
+        now = time.time()
+        if now - self.last < self.interval and (self.total is None or self.done < self.total):
+            return
+        self.last = now
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.done / elapsed
+        if self.total is None:
+            # Streaming an archive without listing it first: no total to count down from
+            self.stream.write(f'\r{self.done} images | {rate:.1f} img/s | elapsed {format_seconds(elapsed)}   ')
+            self.stream.flush()
+            return
+        eta = (self.total - self.done) / rate if rate > 0 else float('inf')
+        self.stream.write(f'\r{self.done}/{self.total} images | {rate:.1f} img/s | '
+                          f'elapsed {format_seconds(elapsed)} | ETA {format_seconds(eta)}   ')
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write('\n')
+        self.stream.flush()
+
+def format_seconds(seconds):
+    if seconds == float('inf'):
+        return '--:--:--'
+    seconds = int(seconds)
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+def sample_batches(samples, batch_size=32, num_workers=4, prefetch_factor=4):
+    """Yield (inputs, [(path, class_name), ...]) batches of samples, decoded by DataLoader workers."""
+    dataset = ImageListDataset(samples)
+    loader_kwargs = {}
+    if num_workers > 0:
+        loader_kwargs = {'prefetch_factor': prefetch_factor}
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, **loader_kwargs)
+    for inputs, indices in loader:
+        yield inputs, [samples[idx] for idx in indices.tolist()]
+
+def run_batched(model, samples, batch_size=32, num_workers=4, prefetch_factor=4, on_result=None, progress=None, store=None,
+                precision='fp32', heatmaps=None, batches=None):
+    """Batched forward over samples; calls on_result(row) in input order and returns (total, correct).
+
+    If store (an evaluation.PredictionStore) is given, the softmax matrix is written to it.
+    precision is a mode from precision.py, already validated with select_precision.
+    If heatmaps (a cam.HeatmapStore) is given, the predicted class's heatmap of every image is written to it.
+    batches (e.g. from archive_reader.archive_batches) replaces decoding samples from disk.
+    """
+    if batches is None:
+        batches = sample_batches(samples, batch_size, num_workers, prefetch_factor)
+    class_index = {name: i for i, name in enumerate(class_names)}
+
+    total = 0
+    correct = 0
+    with torch.no_grad():
+        for inputs, batch in batches:
+            probs = torch.softmax(run_model(model, inputs, precision), dim=1)
+            preds = probs.argmax(dim=1).tolist()
+            for (img_path, actual), pred_idx in zip(batch, preds):
+                pred = class_names[pred_idx]
+                is_correct = (pred == actual)
+                total += 1
+                correct += int(is_correct)
+                if on_result is not None:
+                    on_result({'file': img_path, 'predicted': pred, 'actual': actual, 'correct': is_correct})
+            if heatmaps is not None:
+                heatmaps.add(probs.argmax(dim=1), [p for p, _ in batch])
+            if store is not None:
+                store.add(probs.numpy(), [class_index.get(actual, -1) for _, actual in batch], [p for p, _ in batch])
+            if progress is not None:
+                progress.update(len(preds))
+    return total, correct
+
+def merge_results(inputs, output=None):
+    """Combine shard .jsonl files into one result file; returns (total, correct).
+
+    Rows for the same file (e.g. from a retried shard) are only counted once.
+    """
+    seen = set()
+    total = 0
+    correct = 0
+    writer = ResultWriter(output) if output else None
+    try:
+        for path in inputs:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        print(f'Skipping malformed line in {path}', file=sys.stderr)
+                        continue
+                    if row['file'] in seen:
+                        continue
+                    seen.add(row['file'])
+                    total += 1
+                    correct += int(row['correct'])
+                    if writer is not None:
+                        writer.write(row)
+    finally:
+        if writer is not None:
+            writer.close()
+    return total, correct
+
+def print_accuracy(total, correct):
     accuracy = correct / total if total > 0 else 0
     print(f'\nTotal: {total}, Correct: {correct}, Accuracy: {accuracy:.4f}')
     print(f'Test Accuracy: {accuracy * 100:.2f}%')
 
-    if args.output:
-        with open(args.output, 'w') as f:
-            json.dump(results, f, indent=2)
+def main():
+    parser = argparse.ArgumentParser(description='Batch inference for EfficientNetB0 multiclass model')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='Directory with subfolders for each class, or a .tar/.tar.gz/.zip archive of them (read without extracting)')
+    parser.add_argument('--output', type=str, default=None, help='Optional: path to save predictions (.json, .jsonl or .csv)')
+    parser.add_argument('--weights', type=str, default='best_efficientnetb0-2.pth', help='Path to model weights')
+    parser.add_argument('--batch_size', type=int, default=32, help='Images per forward pass')
+    parser.add_argument('--num_workers', type=int, default=min(8, os.cpu_count() or 1), help='Decoding worker processes (0 = main thread)')
+    parser.add_argument('--prefetch_factor', type=int, default=4, help='Batches prefetched per worker')
+    parser.add_argument('--verbose', action='store_true', help='Print one line per image')
+    parser.add_argument('--num_shards', type=int, default=1, help='Split the file list into this many shards')
+    parser.add_argument('--shard_index', type=int, default=0, help='Which shard (0-based) this process handles')
+    parser.add_argument('--resume', action='store_true', help='Skip files already present in the .jsonl --output and append to it')
+    parser.add_argument('--save_probs', type=str, default=None, help='Optional: directory for the softmax probability store (see evaluation.py)')
+    parser.add_argument('--merge', type=str, nargs='+', default=None, help='Merge shard .jsonl outputs into --output and report accuracy')
+    parser.add_argument('--heatmaps', type=str, default=None, help='Optional: directory for per-image class activation heatmaps')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help='Inference precision; bf16 modes are checked against fp32 first and fall back if they disagree')
+    parser.add_argument('--precision_check', type=int, default=32, help='Images from the input used for the bf16 agreement check')
+    parser.add_argument('--allow_emulated_bf16', action='store_true', help='Use bf16 even without native CPU support')
+    parser.add_argument('--count_first', action='store_true',
+                        help='Archive input: list the members before streaming, for progress ETA (always done with --save_probs/--heatmaps; a full extra pass over compressed tars)')
+    args = parser.parse_args()
+
+    if args.merge:
+        total, correct = merge_results(args.merge, args.output)
+        print_accuracy(total, correct)
+        return
+
+    if args.data_dir is None:
+        parser.error('--data_dir is required unless --merge is given')
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error('--shard_index must be in [0, --num_shards)')
+    if args.resume and not (args.output and args.output.endswith('.jsonl')):
+        parser.error('--resume requires a .jsonl --output')
+    if args.resume and args.save_probs:
+        parser.error('--save_probs cannot be combined with --resume; use one store per shard run')
+    if args.resume and args.heatmaps:
+        parser.error('--heatmaps cannot be combined with --resume; use one directory per shard run')
+
+    archive = is_archive(args.data_dir)
+    completed = set()
+    done_total = 0
+    done_correct = 0
+    append = False
+    if args.resume and os.path.exists(args.output):
+        completed, done_total, done_correct = read_completed(args.output)
+        append = True
+
+    batches = None
+    if archive:
+        # Members are filtered by name while streaming; no list is needed unless a total is
+        def keep(name, label):
+            file = f'{args.data_dir}/{name}'
+            return (file not in completed
+                    and (args.num_shards <= 1 or shard_of(file, args.data_dir, args.num_shards) == args.shard_index))
+        samples = None
+        if args.count_first or args.save_probs or args.heatmaps:
+            samples = [(f'{args.data_dir}/{name}', label) for name, label in list_members(args.data_dir, keep)]
+        batches = archive_batches(args.data_dir, data_transform, args.batch_size, args.num_workers,
+                                  args.prefetch_factor, keep)
+    else:
+        samples = select_shard(list_images(args.data_dir), args.data_dir, args.shard_index, args.num_shards)
+        samples = [s for s in samples if s[0] not in completed]
+    if append:
+        remaining = 'unknown' if samples is None else len(samples)
+        print(f'Resuming: {done_total} files already done, {remaining} remaining', file=sys.stderr)
+
+    net = load_model(args.weights)
+    precision = 'fp32'
+    if args.precision != 'fp32':
+        if archive:
+            members = iter_members(args.data_dir, keep)
+            check = [data_transform(load_xray(data)) for _, (_, _, data) in zip(range(args.precision_check), members)]
+            members.close()
+        else:
+            dataset = ImageListDataset(samples[:args.precision_check])
+            check = [dataset[i][0] for i in range(len(dataset))]
+        reference = torch.stack(check) if check else None
+        precision = select_precision(net, args.precision, reference, allow_emulated=args.allow_emulated_bf16)
+        print(f'Inference precision: {precision}', file=sys.stderr)
+    writer = ResultWriter(args.output, append=append) if args.output else None
+    progress = None if args.verbose else ProgressMeter(None if samples is None else len(samples))
+    store = PredictionStore(args.save_probs, len(samples), class_names) if args.save_probs else None
+    heatmaps = HeatmapStore(args.heatmaps, len(samples), ActivationMaps(net)) if args.heatmaps else None
+
+    def on_result(row):
+        if args.verbose:
+            print(f"{row['file']}: predicted={row['predicted']}, actual={row['actual']}, correct={row['correct']}")
+        if writer is not None:
+            writer.write(row)
+
+    try:
+        total, correct = run_batched(net, samples, args.batch_size, args.num_workers, args.prefetch_factor,
+                                     on_result=on_result, progress=progress, store=store, precision=precision,
+                                     heatmaps=heatmaps, batches=batches)
+    finally:
+        if progress is not None:
+            progress.close()
+        if writer is not None:
+            writer.close()
+        if store is not None:
+            store.close()
+        if heatmaps is not None:
+            heatmaps.close()
 
-    if args.output and args.output.endswith('.csv'):
-        with open(args.output, 'w', newline='') as csvfile:
-            fieldnames = ['file', 'predicted', 'actual', 'correct']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for row in results:
-                writer.writerow(row)
+    print_accuracy(done_total + total, done_correct + correct)
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
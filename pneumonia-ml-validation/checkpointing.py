@@ -0,0 +1,135 @@
+"""
+Background checkpointing for train.py.
+
+The training thread only pays for a CPU copy of the state; serialisation and
+disk I/O happen on a worker thread. Every checkpoint is also written to
+last.pth (what --resume picks up), and only the keep_top_k best epoch files by
+validation accuracy are retained.
+"""
+
+import os
+import glob
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def _to_cpu(obj):
+    """Recursively clone tensors onto the CPU so the snapshot is decoupled from training."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(model, optimizer, scheduler, epoch, best_acc, best_model_wts, val_acc):
+    """Everything needed to continue training after `epoch` (0-based, completed)."""
+    return {
+        'epoch': epoch,
+        'val_acc': val_acc,
+        'best_acc': best_acc,
+        'model': _to_cpu(model.state_dict()),
+        'best_model': _to_cpu(best_model_wts),
+        'optimizer': _to_cpu(optimizer.state_dict()),
+        'scheduler': scheduler.state_dict(),
+        'rng': rng_state(),
+    }
+
+
+def load_checkpoint(path, model, optimizer, scheduler, device):
+    """Restore a snapshot in place; returns (start_epoch, best_acc, best_model_wts)."""
+    state = torch.load(path, map_location=device, weights_only=False)
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    scheduler.load_state_dict(state['scheduler'])
+    restore_rng_state(state['rng'])
+    return state['epoch'] + 1, state['best_acc'], state['best_model']
+
+
+class AsyncCheckpointer:
+    def __init__(self, out_dir, keep_top_k=3, max_pending=2):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.keep_top_k = keep_top_k
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, state):
+        """Queue a snapshot for writing; blocks only if max_pending writes are already outstanding."""
+        if self.error is not None:
+            raise RuntimeError('Checkpoint writer failed') from self.error
+        self.queue.put(state)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError('Checkpoint writer failed') from self.error
+
+    def _run(self):
+        while True:
+            state = self.queue.get()
+            if state is None:
+                return
+            try:
+                self._write(state)
+            except Exception as e:
+                self.error = e
+
+    def _atomic_save(self, obj, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _write(self, state):
+        epoch_path = os.path.join(self.out_dir, f"epoch_{state['epoch'] + 1:03d}_acc_{state['val_acc']:.4f}.pth")
+        self._atomic_save(state, epoch_path)
+        # Hard-link instead of serialising the same state twice; pruning the epoch file keeps last.pth intact
+        last_path = os.path.join(self.out_dir, 'last.pth')
+        try:
+            if os.path.exists(last_path + '.tmp'):
+                os.remove(last_path + '.tmp')
+            os.link(epoch_path, last_path + '.tmp')
+            os.replace(last_path + '.tmp', last_path)
+        except OSError:
+            self._atomic_save(state, last_path)
+        self._prune()
+
+    def _prune(self):
+        if self.keep_top_k is None or self.keep_top_k <= 0:
+            return
+        paths = glob.glob(os.path.join(self.out_dir, 'epoch_*_acc_*.pth'))
+        # Highest accuracy first, later epoch wins ties
+        paths.sort(key=lambda p: (float(p.rsplit('_acc_', 1)[1][:-4]), p), reverse=True)
+        for path in paths[self.keep_top_k:]:
+            os.remove(path)
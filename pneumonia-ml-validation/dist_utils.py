@@ -0,0 +1,49 @@
+"""
+Helpers for multi-process data-parallel training with torch.distributed.
+
+Processes are started by torchrun, which sets RANK, WORLD_SIZE, LOCAL_RANK,
+MASTER_ADDR and MASTER_PORT. On one machine:
+
+    torchrun --nproc_per_node=4 train.py --distributed --data_dir data
+
+Across machines run the same command on every node with --nnodes, --node_rank
+and --master_addr/--master_port pointing at node 0.
+"""
+
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo'):
+    """Join the process group described by the torchrun environment; returns (rank, world_size, local_rank)."""
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        raise RuntimeError('--distributed expects to be launched with torchrun (RANK/WORLD_SIZE not set)')
+    dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size(), int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def all_reduce_sum(tensor):
+    """Sum a tensor across ranks in place (no-op when not distributed)."""
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def unwrap(model):
+    """The underlying module of a DistributedDataParallel wrapper."""
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
@@ -0,0 +1,264 @@
+"""
+Knowledge distillation from a frozen teacher into a small student CNN.
+
+The teacher (the binary ResNet50 PneumoniaModel or the 6-class EfficientNet-B0)
+runs once over the train split; its logits are cached to disk so
+later runs with other students, temperatures or loss weights skip it. The
+student (SimpleConvNet or CompactConvNet from model.py) is trained with
+
+    alpha * T^2 * KL(student_T || teacher_T) + (1 - alpha) * CE(student, label)
+
+When the teacher's classes differ from the dataset's, --class_map folds teacher
+probabilities into dataset classes, e.g. a binary student from the 6-class
+teacher:
+
+    python distill.py --data_dir data --teacher efficientnet_b0 --teacher_weights best_efficientnetb0-2.pth \\
+        --student compact --class_map NORMAL=NORMAL PNEUMONIA=BACTERIAL_PNEUMONIA,VIRAL_PNEUMONIA,COVID,TB
+
+Binary students are saved as plain state dicts that app.py loads directly.
+A latency/accuracy comparison against the teacher is written to --report.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from copy import deepcopy
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+from torchvision import datasets, transforms
+
+from batch_inference import load_model as load_efficientnet, class_names as efficientnet_classes
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import PneumoniaModel, SimpleConvNet, CompactConvNet
+from model_manager import checkpoint_version
+
+STUDENTS = {'simple': SimpleConvNet, 'compact': CompactConvNet}
+
+normalize = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+
+# Each teacher sees exactly what its server feeds it
+teacher_transforms = {
+    'resnet50': transforms.Compose([transforms.Resize((224, 224)), transforms.ToTensor(), normalize]),
+    'efficientnet_b0': transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224), transforms.ToTensor(), normalize]),
+}
+
+# Student eval transform matches app.py's preprocess_image
+student_transforms = {
+    'train': transforms.Compose([
+        transforms.Resize((224, 224)),
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomRotation(10),
+        transforms.ToTensor(),
+        normalize
+    ]),
+    'eval': transforms.Compose([transforms.Resize((224, 224)), transforms.ToTensor(), normalize]),
+}
+
+
+def build_teacher(name, weights):
+    """Returns (model, class_names) for a frozen teacher."""
+    if name == 'resnet50':
+        teacher = PneumoniaModel(pretrained=False, freeze_backbone=False)
+        teacher.load_state_dict(torch.load(weights, map_location='cpu'))
+        classes = ['NORMAL', 'PNEUMONIA']
+    else:
+        teacher = load_efficientnet(weights)
+        classes = list(efficientnet_classes)
+    teacher.eval()
+    for p in teacher.parameters():
+        p.requires_grad = False
+    return teacher, classes
+
+
+class IndexedDataset(Dataset):
+    """Wraps a dataset so each item also carries its index (to look up cached teacher logits)."""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, label = self.dataset[idx]
+        return image, label, idx
+
+
+def cache_teacher_logits(teacher, teacher_name, teacher_weights, split_dir, cache_path, batch_size=32, num_workers=4):
+    """Teacher logits for every image of a split, computed once and reused while the teacher
+    checkpoint and the file list are unchanged."""
+    dataset = datasets.ImageFolder(split_dir, teacher_transforms[teacher_name])
+    files = [path for path, _ in dataset.samples]
+    version = checkpoint_version(teacher_weights)
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path, allow_pickle=False)
+        if (str(cached['teacher']) == teacher_name and 'teacher_version' in cached.files
+                and str(cached['teacher_version']) == version and cached['files'].tolist() == files):
+            print(f'Using cached teacher logits from {cache_path}')
+            return cached['logits']
+
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    chunks = []
+    start = time.time()
+    with torch.no_grad():
+        for inputs, _ in loader:
+            chunks.append(teacher(inputs).float().numpy())
+    logits = np.concatenate(chunks) if chunks else np.zeros((0, 0), dtype=np.float32)
+    print(f'Teacher pass over {split_dir}: {len(files) / max(time.time() - start, 1e-9):.1f} img/s')
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    np.savez(cache_path, logits=logits, files=np.array(files), teacher=np.array(teacher_name),
+             teacher_version=np.array(version))
+    return logits
+
+
+def class_map_matrix(teacher_classes, dataset_classes, mapping_args):
+    """(teacher classes x dataset classes) 0/1 matrix that sums teacher probabilities into dataset classes."""
+    matrix = np.zeros((len(teacher_classes), len(dataset_classes)), dtype=np.float32)
+    if mapping_args:
+        for item in mapping_args:
+            target, sources = item.split('=', 1)
+            for source in sources.split(','):
+                matrix[teacher_classes.index(source), dataset_classes.index(target)] = 1.0
+    else:
+        if sorted(teacher_classes) != sorted(dataset_classes):
+            raise ValueError(f'Teacher classes {teacher_classes} differ from dataset classes {dataset_classes}; pass --class_map')
+        for i, name in enumerate(teacher_classes):
+            matrix[i, dataset_classes.index(name)] = 1.0
+    if (matrix.sum(axis=1) > 1).any():
+        raise ValueError('Each teacher class may map to at most one dataset class')
+    return torch.from_numpy(matrix)
+
+
+def teacher_probs(logits, mapping, temperature):
+    probs = torch.softmax(logits / temperature, dim=1) @ mapping
+    # Teacher classes left out of the map drop their mass; renormalise over what remains
+    return probs / probs.sum(dim=1, keepdim=True).clamp_min(1e-8)
+
+
+def distillation_loss(student_logits, soft_targets, labels, temperature, alpha):
+    log_student = F.log_softmax(student_logits / temperature, dim=1)
+    kd = F.kl_div(log_student, soft_targets.clamp_min(1e-8), reduction='batchmean') * temperature ** 2
+    return alpha * kd + (1 - alpha) * F.cross_entropy(student_logits, labels)
+
+
+def median_latency_ms(model, runs=20, warmup=3):
+    x = torch.randn(1, 3, 224, 224)
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            model(x)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def predict_split(model, split_dir, transform, batch_size=32, num_workers=4):
+    dataset = datasets.ImageFolder(split_dir, transform)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    logits, labels = [], []
+    with torch.no_grad():
+        for inputs, y in loader:
+            logits.append(model(inputs).float())
+            labels.append(y)
+    return torch.cat(logits), torch.cat(labels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distil a PneumoniaModel/EfficientNet teacher into a small CNN')
+    parser.add_argument('--data_dir', type=str, required=True, help='Dataset folder containing train, val, test')
+    parser.add_argument('--teacher', type=str, required=True, choices=list(teacher_transforms))
+    parser.add_argument('--teacher_weights', type=str, required=True, help='Teacher checkpoint')
+    parser.add_argument('--student', type=str, default='compact', choices=list(STUDENTS))
+    parser.add_argument('--class_map', type=str, nargs='*', default=None,
+                        help='dataset_class=teacher_class[,teacher_class...] entries when class sets differ')
+    parser.add_argument('--temperature', type=float, default=4.0, help='Softmax temperature for soft targets')
+    parser.add_argument('--alpha', type=float, default=0.7, help='Weight of the distillation term vs hard-label CE')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--cache_dir', type=str, default='teacher_cache', help='Where teacher logits are cached')
+    parser.add_argument('--output', type=str, default='student_model.pth', help='Student checkpoint path')
+    parser.add_argument('--report', type=str, default='distill_report.json', help='Latency/accuracy comparison report')
+    args = parser.parse_args()
+
+    teacher, teacher_classes = build_teacher(args.teacher, args.teacher_weights)
+    train_dir = os.path.join(args.data_dir, 'train')
+    val_dir = os.path.join(args.data_dir, 'val')
+    test_dir = os.path.join(args.data_dir, 'test')
+
+    train_set = datasets.ImageFolder(train_dir, student_transforms['train'])
+    val_set = datasets.ImageFolder(val_dir, student_transforms['eval'])
+    dataset_classes = train_set.classes
+    mapping = class_map_matrix(teacher_classes, dataset_classes, args.class_map)
+
+    train_logits = torch.from_numpy(cache_teacher_logits(
+        teacher, args.teacher, args.teacher_weights, train_dir, os.path.join(args.cache_dir, f'{args.teacher}_train.npz'),
+        args.batch_size, args.num_workers))
+
+    student = STUDENTS[args.student](num_classes=len(dataset_classes))
+    optimizer = torch.optim.Adam(student.parameters(), lr=args.lr)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.epochs)
+    train_loader = DataLoader(IndexedDataset(train_set), batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+    val_loader = DataLoader(val_set, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+
+    best_acc = 0.0
+    best_wts = deepcopy(student.state_dict())
+    for epoch in range(args.epochs):
+        student.train()
+        running_loss = torch.zeros(())
+        for inputs, labels, idx in train_loader:
+            soft = teacher_probs(train_logits[idx], mapping, args.temperature)
+            optimizer.zero_grad()
+            loss = distillation_loss(student(inputs), soft, labels, args.temperature, args.alpha)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.detach() * inputs.size(0)
+        scheduler.step()
+
+        student.eval()
+        correct = 0
+        with torch.no_grad():
+            for inputs, labels in val_loader:
+                correct += (student(inputs).argmax(dim=1) == labels).sum().item()
+        val_acc = correct / max(len(val_set), 1)
+        print(f'Epoch {epoch + 1}/{args.epochs} train Loss: {running_loss.item() / len(train_set):.4f} val Acc: {val_acc:.4f}')
+        if val_acc > best_acc:
+            best_acc = val_acc
+            best_wts = deepcopy(student.state_dict())
+
+    student.load_state_dict(best_wts)
+    student.eval()
+    torch.save(student.state_dict(), args.output)
+    print(f'Best val Acc: {best_acc:.4f}; saved student to {args.output}')
+
+    # Compare teacher and student on the test split
+    report = {'teacher': args.teacher, 'student': args.student, 'classes': dataset_classes,
+              'temperature': args.temperature, 'alpha': args.alpha}
+    if os.path.isdir(test_dir):
+        teacher_logits, labels = predict_split(teacher, test_dir, teacher_transforms[args.teacher], args.batch_size, args.num_workers)
+        student_logits, _ = predict_split(student, test_dir, student_transforms['eval'], args.batch_size, args.num_workers)
+        teacher_pred = teacher_probs(teacher_logits, mapping, 1.0).argmax(dim=1)
+        student_pred = student_logits.argmax(dim=1)
+        report['test_samples'] = len(labels)
+        report['teacher_accuracy'] = (teacher_pred == labels).float().mean().item()
+        report['student_accuracy'] = (student_pred == labels).float().mean().item()
+        report['agreement'] = (teacher_pred == student_pred).float().mean().item()
+    for name, net in [('teacher', teacher), ('student', student)]:
+        report[f'{name}_parameters'] = sum(p.numel() for p in net.parameters())
+        report[f'{name}_latency_ms'] = median_latency_ms(net)
+    report['speedup'] = report['teacher_latency_ms'] / report['student_latency_ms']
+
+    print(json.dumps(report, indent=2))
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
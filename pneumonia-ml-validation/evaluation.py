@@ -0,0 +1,284 @@
+"""
+Vectorized evaluation of stored softmax outputs.
+
+batch_inference.py (--save_probs) and train.py write a prediction store: a
+directory holding the full probability matrix as a compact .npy array next to
+integer labels and file ids. Everything here works on those arrays with NumPy
+only, so metrics and thresholds can be recomputed without re-running a model.
+
+    python evaluation.py --predictions preds_shard0 preds_shard1 --output report.json
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+
+
+class PredictionStore:
+    """Preallocated on-disk prediction store filled in batches.
+
+    probs.npy is memory-mapped, so writing stays constant-memory no matter how
+    many rows the store holds. Labels are class indices, -1 when unknown.
+    """
+    def __init__(self, out_dir, num_rows, class_names, dtype=np.float16):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.num_rows = num_rows
+        self.class_names = list(class_names)
+        self.probs = np.lib.format.open_memmap(os.path.join(out_dir, 'probs.npy'), mode='w+',
+                                               dtype=dtype, shape=(num_rows, len(self.class_names)))
+        self.labels = np.full(num_rows, -1, dtype=np.int16)
+        self.files = open(os.path.join(out_dir, 'files.txt'), 'w')
+        self.count = 0
+
+    def add(self, probs, labels, files):
+        n = len(files)
+        self.probs[self.count:self.count + n] = probs
+        self.labels[self.count:self.count + n] = labels
+        for f in files:
+            self.files.write(f + '\n')
+        self.count += n
+
+    def close(self):
+        self.probs.flush()
+        del self.probs
+        self.files.close()
+        np.save(os.path.join(self.out_dir, 'labels.npy'), self.labels[:self.count])
+        with open(os.path.join(self.out_dir, 'meta.json'), 'w') as f:
+            json.dump({'class_names': self.class_names, 'num_rows': self.count}, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_predictions(out_dir, probs, labels, files, class_names):
+    """Write an in-memory probability matrix as a prediction store."""
+    with PredictionStore(out_dir, len(files), class_names) as store:
+        store.add(probs, labels, files)
+
+
+def load_predictions(*dirs):
+    """Load (probs, labels, files, class_names) from one or more stores, concatenated in order."""
+    probs, labels, files = [], [], []
+    class_names = None
+    for d in dirs:
+        with open(os.path.join(d, 'meta.json')) as f:
+            meta = json.load(f)
+        if class_names is None:
+            class_names = meta['class_names']
+        elif meta['class_names'] != class_names:
+            raise ValueError(f'Class names in {d} do not match the other stores')
+        n = meta['num_rows']
+        probs.append(np.load(os.path.join(d, 'probs.npy'), mmap_mode='r')[:n])
+        labels.append(np.load(os.path.join(d, 'labels.npy')))
+        with open(os.path.join(d, 'files.txt')) as f:
+            files.extend(line.rstrip('\n') for _, line in zip(range(n), f))
+    if len(dirs) == 1:
+        return probs[0], labels[0], files, class_names
+    return np.concatenate(probs), np.concatenate(labels), files, class_names
+
+
+def confusion_matrix(labels, preds, num_classes):
+    """Rows are true classes, columns are predicted classes."""
+    idx = labels.astype(np.int64) * num_classes + preds.astype(np.int64)
+    return np.bincount(idx, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+
+def _safe_divide(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return np.divide(a, b, out=np.zeros_like(a), where=b != 0)
+
+
+def precision_recall_f1(cm):
+    tp = np.diag(cm)
+    precision = _safe_divide(tp, cm.sum(axis=0))
+    recall = _safe_divide(tp, cm.sum(axis=1))
+    f1 = _safe_divide(2 * precision * recall, precision + recall)
+    return precision, recall, f1
+
+
+def _trapezoid(x, y):
+    return float(np.sum(np.diff(x) * (y[1:] + y[:-1]) / 2.0))
+
+
+def binary_curves(scores, positives):
+    """ROC and PR curves for one score vector, one point per distinct threshold.
+
+    Returns a dict with thresholds, fpr, tpr, precision, recall, roc_auc and
+    average_precision.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    positives = np.asarray(positives, dtype=bool)
+    order = np.argsort(-scores, kind='mergesort')
+    scores = scores[order]
+    positives = positives[order]
+
+    # Last index of every run of equal scores
+    distinct = np.r_[np.flatnonzero(np.diff(scores)), scores.size - 1]
+    tps = np.cumsum(positives)[distinct]
+    fps = (distinct + 1) - tps
+    num_pos = tps[-1] if tps.size else 0
+    num_neg = fps[-1] if fps.size else 0
+
+    tpr = np.r_[0.0, _safe_divide(tps, num_pos)]
+    fpr = np.r_[0.0, _safe_divide(fps, num_neg)]
+    precision = np.r_[1.0, _safe_divide(tps, tps + fps)]
+    recall = tpr
+    return {
+        'thresholds': np.r_[np.inf, scores[distinct]],
+        'fpr': fpr,
+        'tpr': tpr,
+        'precision': precision,
+        'recall': recall,
+        'roc_auc': _trapezoid(fpr, tpr) if num_pos and num_neg else float('nan'),
+        'average_precision': float(np.sum(np.diff(recall) * precision[1:])) if num_pos else float('nan'),
+    }
+
+
+def one_vs_rest_curves(probs, labels):
+    """binary_curves for every class column against the rest."""
+    return [binary_curves(probs[:, c], labels == c) for c in range(probs.shape[1])]
+
+
+def calibration_bins(probs, labels, num_bins=10):
+    """Reliability diagram of top-1 confidence vs accuracy, plus expected calibration error."""
+    probs = np.asarray(probs, dtype=np.float64)
+    confidence = probs.max(axis=1)
+    correct = probs.argmax(axis=1) == labels
+    bins = np.minimum((confidence * num_bins).astype(np.int64), num_bins - 1)
+    counts = np.bincount(bins, minlength=num_bins)
+    conf_sum = np.bincount(bins, weights=confidence, minlength=num_bins)
+    acc_sum = np.bincount(bins, weights=correct, minlength=num_bins)
+    mean_conf = _safe_divide(conf_sum, counts)
+    accuracy = _safe_divide(acc_sum, counts)
+    ece = float(np.sum(counts * np.abs(accuracy - mean_conf)) / max(counts.sum(), 1))
+    return {
+        'edges': np.linspace(0.0, 1.0, num_bins + 1),
+        'counts': counts,
+        'mean_confidence': mean_conf,
+        'accuracy': accuracy,
+        'ece': ece,
+    }
+
+
+def threshold_metrics(scores, positives, threshold):
+    """Binary precision/recall/specificity/F1 when predicting positive for score >= threshold."""
+    predicted = np.asarray(scores) >= threshold
+    positives = np.asarray(positives, dtype=bool)
+    tp = int(np.count_nonzero(predicted & positives))
+    fp = int(np.count_nonzero(predicted & ~positives))
+    fn = int(np.count_nonzero(~predicted & positives))
+    tn = int(np.count_nonzero(~predicted & ~positives))
+    precision = float(_safe_divide(tp, tp + fp))
+    recall = float(_safe_divide(tp, tp + fn))
+    return {
+        'threshold': threshold,
+        'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+        'precision': precision,
+        'recall': recall,
+        'specificity': float(_safe_divide(tn, tn + fp)),
+        'f1': float(_safe_divide(2 * precision * recall, precision + recall)),
+    }
+
+
+def evaluation_report(probs, labels, class_names, num_bins=10, include_curves=False):
+    """All metrics for a probability matrix as a JSON-serialisable dict.
+
+    Rows with an unknown label (-1) are ignored.
+    """
+    known = labels >= 0
+    probs = np.asarray(probs[known], dtype=np.float32)
+    labels = np.asarray(labels[known], dtype=np.int64)
+    num_classes = len(class_names)
+    preds = probs.argmax(axis=1)
+
+    cm = confusion_matrix(labels, preds, num_classes)
+    precision, recall, f1 = precision_recall_f1(cm)
+    curves = one_vs_rest_curves(probs, labels)
+    calibration = calibration_bins(probs, labels, num_bins)
+
+    per_class = {}
+    for c, name in enumerate(class_names):
+        per_class[name] = {
+            'support': int(cm[c].sum()),
+            'precision': float(precision[c]),
+            'recall': float(recall[c]),
+            'f1': float(f1[c]),
+            'roc_auc': curves[c]['roc_auc'],
+            'average_precision': curves[c]['average_precision'],
+        }
+        if include_curves:
+            per_class[name]['curves'] = {k: v.tolist() for k, v in curves[c].items() if isinstance(v, np.ndarray)}
+
+    return {
+        'num_samples': int(labels.size),
+        'accuracy': float(np.trace(cm) / max(cm.sum(), 1)),
+        'macro_f1': float(f1.mean()),
+        'class_names': list(class_names),
+        'confusion_matrix': cm.tolist(),
+        'per_class': per_class,
+        'calibration': {k: (v.tolist() if isinstance(v, np.ndarray) else v) for k, v in calibration.items()},
+    }
+
+
+def print_report(report):
+    print(f"Samples: {report['num_samples']}, Accuracy: {report['accuracy']:.4f}, Macro F1: {report['macro_f1']:.4f}, "
+          f"ECE: {report['calibration']['ece']:.4f}")
+    width = max(len(n) for n in report['class_names'])
+    print(f"{'class':<{width}}  support  precision  recall     f1  roc_auc      ap")
+    for name, m in report['per_class'].items():
+        print(f"{name:<{width}}  {m['support']:>7}  {m['precision']:>9.4f}  {m['recall']:>6.4f}  {m['f1']:>5.4f}"
+              f"  {m['roc_auc']:>7.4f}  {m['average_precision']:>6.4f}")
+    print('Confusion matrix (rows = actual, columns = predicted):')
+    for name, row in zip(report['class_names'], report['confusion_matrix']):
+        print(f"{name:<{width}}  " + ' '.join(f'{v:>6}' for v in row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute evaluation metrics from stored prediction arrays')
+    parser.add_argument('--predictions', type=str, nargs='+', required=True, help='Prediction store directories')
+    parser.add_argument('--output', type=str, default=None, help='Optional: path to save the report as JSON')
+    parser.add_argument('--bins', type=int, default=10, help='Number of calibration bins')
+    parser.add_argument('--curves', action='store_true', help='Include full ROC/PR curves in the JSON report')
+    parser.add_argument('--positive_classes', type=str, nargs='+', default=None,
+                        help='Classes summed into a positive score for binary threshold metrics')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.5], help='Thresholds for binary metrics')
+    args = parser.parse_args()
+
+    probs, labels, _, class_names = load_predictions(*args.predictions)
+    report = evaluation_report(probs, labels, class_names, num_bins=args.bins, include_curves=args.curves)
+    print_report(report)
+
+    if args.positive_classes:
+        missing = set(args.positive_classes) - set(class_names)
+        if missing:
+            parser.error(f'Unknown classes: {sorted(missing)}')
+        cols = [class_names.index(c) for c in args.positive_classes]
+        known = labels >= 0
+        scores = np.asarray(probs[known][:, cols], dtype=np.float32).sum(axis=1)
+        positives = np.isin(labels[known], cols)
+        binary = binary_curves(scores, positives)
+        report['binary'] = {
+            'positive_classes': args.positive_classes,
+            'roc_auc': binary['roc_auc'],
+            'average_precision': binary['average_precision'],
+            'thresholds': [threshold_metrics(scores, positives, t) for t in args.thresholds],
+        }
+        print(f"\nBinary {'+'.join(args.positive_classes)} vs rest: ROC AUC {binary['roc_auc']:.4f}, "
+              f"AP {binary['average_precision']:.4f}")
+        for m in report['binary']['thresholds']:
+            print(f"  threshold {m['threshold']:.3f}: precision {m['precision']:.4f}, recall {m['recall']:.4f}, "
+                  f"specificity {m['specificity']:.4f}, f1 {m['f1']:.4f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
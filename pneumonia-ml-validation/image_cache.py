@@ -0,0 +1,155 @@
+"""
+Pre-decoded uint8 image cache for training and evaluation.
+
+Decoding full-size JPEG/PNG X-rays on every sample of every epoch makes the
+DataLoader workers the bottleneck. build_cache decodes each split once into a
+memory-mapped (N, size, size) grayscale uint8 array; CachedImageDataset reads
+from it and runs the remaining augmentations on tensors.
+
+    python image_cache.py --data_dir data --cache_dir data_cache --size 256
+
+Each split directory holds images.npy, labels.npy, files.txt and meta.json.
+"""
+
+import os
+import sys
+import json
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torchvision import datasets, transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from xray_io import load_xray
+
+XRAY_FILE_EXTENSIONS = datasets.folder.IMG_EXTENSIONS + ('.dcm', '.dicom')
+
+SPLITS = ['train', 'val', 'test']
+
+
+def _decode(args):
+    path, size = args
+    # DICOM/16-bit films are windowed and reduced to about 2 * size while decoding
+    with load_xray(path, 2 * size) as image:
+        image = image.convert('L')
+        # Same geometry as Resize(size) + CenterCrop(size): shorter side to size, then square crop
+        image = transforms.functional.resize(image, size)
+        image = transforms.functional.center_crop(image, size)
+        return np.asarray(image, dtype=np.uint8)
+
+
+def build_cache(split_dir, out_dir, size=256, num_workers=None, chunksize=16):
+    """Decode every image of an ImageFolder split into out_dir. Returns the number of images."""
+    folder = datasets.ImageFolder(split_dir, is_valid_file=lambda p: p.lower().endswith(XRAY_FILE_EXTENSIONS))
+    num_images = len(folder.samples)
+    os.makedirs(out_dir, exist_ok=True)
+
+    images = np.lib.format.open_memmap(os.path.join(out_dir, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(num_images, size, size))
+    labels = np.asarray([label for _, label in folder.samples], dtype=np.int64)
+
+    jobs = [(path, size) for path, _ in folder.samples]
+    with Pool(num_workers) as pool:
+        for i, array in enumerate(pool.imap(_decode, jobs, chunksize=chunksize)):
+            images[i] = array
+            if (i + 1) % 1000 == 0:
+                print(f'{split_dir}: {i + 1}/{num_images}')
+    images.flush()
+    del images
+
+    np.save(os.path.join(out_dir, 'labels.npy'), labels)
+    with open(os.path.join(out_dir, 'files.txt'), 'w') as f:
+        for path, _ in folder.samples:
+            f.write(path + '\n')
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'classes': folder.classes, 'size': size, 'num_images': num_images}, f, indent=2)
+    return num_images
+
+
+class GrayToRGB:
+    """Repeat a 1xHxW tensor to 3xHxW so ImageNet-pretrained backbones can consume it."""
+    def __call__(self, tensor):
+        return tensor.expand(3, -1, -1)
+
+
+# Tensor counterparts of the PIL pipelines in train.py. Saturation/hue jitter is
+# dropped because it is a no-op on grayscale X-rays.
+cached_transforms = {
+    'train': transforms.Compose([
+        transforms.RandomResizedCrop(224, antialias=True),
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomRotation(10),
+        transforms.ColorJitter(brightness=0.2, contrast=0.2),
+        transforms.ConvertImageDtype(torch.float32),
+        GrayToRGB(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ]),
+    'val': transforms.Compose([
+        transforms.CenterCrop(224),
+        transforms.ConvertImageDtype(torch.float32),
+        GrayToRGB(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ]),
+}
+cached_transforms['test'] = cached_transforms['val']
+
+
+class CachedImageDataset(Dataset):
+    """Dataset over a split written by build_cache; mirrors ImageFolder's classes/samples attributes."""
+    def __init__(self, cache_dir, transform=None):
+        self.cache_dir = cache_dir
+        self.transform = transform
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.classes = meta['classes']
+        self.class_to_idx = {name: i for i, name in enumerate(self.classes)}
+        self.targets = np.load(os.path.join(cache_dir, 'labels.npy')).tolist()
+        with open(os.path.join(cache_dir, 'files.txt')) as f:
+            files = [line.rstrip('\n') for line in f]
+        self.samples = list(zip(files, self.targets))
+        # Rows of images.npy backing each sample; narrowed by exclude()
+        self.rows = list(range(len(self.samples)))
+        # Opened lazily so each DataLoader worker maps the file itself instead of pickling it
+        self._images = None
+
+    def exclude(self, paths):
+        """Drop samples whose absolute path is in `paths` (e.g. a phash_index.py duplicate list)."""
+        keep = [i for i, (path, _) in enumerate(self.samples) if os.path.abspath(path) not in paths]
+        self.rows = [self.rows[i] for i in keep]
+        self.samples = [self.samples[i] for i in keep]
+        self.targets = [self.targets[i] for i in keep]
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, idx):
+        if self._images is None:
+            self._images = np.load(os.path.join(self.cache_dir, 'images.npy'), mmap_mode='r')
+        image = torch.from_numpy(np.array(self._images[self.rows[idx]])).unsqueeze(0)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[idx]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode ImageFolder splits once into uint8 memory-mapped arrays')
+    parser.add_argument('--data_dir', type=str, required=True, help='Path to dataset folder containing train, val, test')
+    parser.add_argument('--cache_dir', type=str, required=True, help='Where to write the cached splits')
+    parser.add_argument('--size', type=int, default=256, help='Side length of the stored square images')
+    parser.add_argument('--num_workers', type=int, default=None, help='Decoding processes (default: all cores)')
+    args = parser.parse_args()
+
+    for split in SPLITS:
+        split_dir = os.path.join(args.data_dir, split)
+        if not os.path.isdir(split_dir):
+            print(f'Skipping missing split: {split_dir}')
+            continue
+        count = build_cache(split_dir, os.path.join(args.cache_dir, split), args.size, args.num_workers)
+        print(f'{split}: cached {count} images')
+
+
+if __name__ == '__main__':
+    main()
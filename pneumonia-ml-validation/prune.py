@@ -0,0 +1,376 @@
+"""
+Structured channel pruning for EfficientNet-B0 and the PneumoniaModel ResNet50.
+
+Channels are ranked per layer by filter magnitude (L1 norm) or a first-order
+Taylor estimate of the loss change (|activation * gradient| over a few
+training batches). The lowest-ranked channels are physically removed, so the
+result is a smaller dense network with fewer FLOPs rather than zero masks.
+Only channel dimensions internal to a block are pruned, which leaves the
+residual paths untouched:
+
+    ResNet50 bottleneck    conv1 -> conv2 and conv2 -> conv3 widths
+    EfficientNet MBConv    expanded width (expand conv, depthwise conv, SE, project input)
+    EfficientNet head      the 1280-channel conv feeding the classifier
+
+Each sparsity level is pruned from the original model, fine-tuned briefly on
+the train split and measured for CPU latency and accuracy:
+
+    python prune.py --data_dir data --arch efficientnet_b0 --weights best_efficientnetb0-2.pth \\
+        --criterion taylor --sparsities 0.25 0.5 --finetune_epochs 2 --output_dir pruned
+
+Pruned checkpoints store their layer widths; load_pruned() rebuilds them.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from copy import deepcopy
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from torchvision import datasets, transforms
+from torchvision.models import efficientnet_b0
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import PneumoniaModel
+
+normalize = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+
+# Same pipelines as train.py (fine-tuning) and the servers (evaluation)
+data_transforms = {
+    'train': transforms.Compose([
+        transforms.RandomResizedCrop(224),
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomRotation(10),
+        transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1),
+        transforms.ToTensor(),
+        normalize
+    ]),
+    'efficientnet_b0': transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224), transforms.ToTensor(), normalize]),
+    'resnet50': transforms.Compose([transforms.Resize((224, 224)), transforms.ToTensor(), normalize]),
+}
+
+
+def build_model(arch, num_classes):
+    if arch == 'resnet50':
+        return PneumoniaModel(pretrained=False, freeze_backbone=False)
+    net = efficientnet_b0(weights=None)
+    net.classifier[1] = nn.Linear(net.classifier[1].in_features, num_classes)
+    return net
+
+
+def _slice_conv(conv, out_idx=None, in_idx=None):
+    """Copy of a Conv2d restricted to the given output/input channels. Depthwise convs follow out_idx."""
+    depthwise = conv.groups > 1 and conv.groups == conv.in_channels == conv.out_channels
+    weight = conv.weight.data
+    if out_idx is not None:
+        weight = weight[out_idx]
+    if in_idx is not None and not depthwise:
+        weight = weight[:, in_idx]
+    out_channels = weight.shape[0]
+    in_channels = out_channels if depthwise else weight.shape[1] * conv.groups
+    new = nn.Conv2d(in_channels, out_channels, conv.kernel_size, conv.stride, conv.padding,
+                    conv.dilation, groups=out_channels if depthwise else conv.groups, bias=conv.bias is not None)
+    new.weight.data = weight.clone()
+    if conv.bias is not None:
+        new.bias.data = (conv.bias.data[out_idx] if out_idx is not None else conv.bias.data).clone()
+    return new
+
+
+def _slice_bn(bn, idx):
+    new = nn.BatchNorm2d(len(idx), bn.eps, bn.momentum)
+    new.weight.data = bn.weight.data[idx].clone()
+    new.bias.data = bn.bias.data[idx].clone()
+    new.running_mean = bn.running_mean[idx].clone()
+    new.running_var = bn.running_var[idx].clone()
+    new.num_batches_tracked = bn.num_batches_tracked.clone()
+    return new
+
+
+def _slice_linear_in(linear, idx):
+    new = nn.Linear(len(idx), linear.out_features, bias=linear.bias is not None)
+    new.weight.data = linear.weight.data[:, idx].clone()
+    if linear.bias is not None:
+        new.bias.data = linear.bias.data.clone()
+    return new
+
+
+class ChannelGroup:
+    """Layers sharing one channel dimension, narrowed together.
+
+    `members` is a list of (parent, key, kind) where parent[key] (or
+    getattr(parent, key)) is replaced by a sliced copy. kind is one of
+    'out' (conv output channels), 'in' (conv input channels), 'bn' or
+    'linear_in'. `producer` is the conv whose filters create the channels and
+    `point` the BatchNorm whose output is scored by the Taylor criterion.
+    """
+    def __init__(self, name, members):
+        self.name = name
+        self.members = members
+
+    @staticmethod
+    def _get(parent, key):
+        return parent[key] if isinstance(key, int) else getattr(parent, key)
+
+    @staticmethod
+    def _set(parent, key, module):
+        if isinstance(key, int):
+            parent[key] = module
+        else:
+            setattr(parent, key, module)
+
+    def _first(self, kind):
+        return next(self._get(p, k) for p, k, t in self.members if t == kind)
+
+    @property
+    def producer(self):
+        return self._first('out')
+
+    @property
+    def point(self):
+        # Last BatchNorm of the group, i.e. the channels as the consumer sees them
+        return [self._get(p, k) for p, k, t in self.members if t == 'bn'][-1]
+
+    @property
+    def channels(self):
+        return self.producer.out_channels
+
+    def prune(self, keep):
+        keep = torch.as_tensor(sorted(int(i) for i in keep), dtype=torch.long)
+        for parent, key, kind in self.members:
+            module = self._get(parent, key)
+            if kind == 'out':
+                module = _slice_conv(module, out_idx=keep)
+            elif kind == 'in':
+                module = _slice_conv(module, in_idx=keep)
+            elif kind == 'bn':
+                module = _slice_bn(module, keep)
+            else:
+                module = _slice_linear_in(module, keep)
+            self._set(parent, key, module)
+
+
+def channel_groups(model, arch):
+    groups = []
+    if arch == 'resnet50':
+        backbone = model.backbone
+        for layer_name in ('layer1', 'layer2', 'layer3', 'layer4'):
+            for i, block in enumerate(getattr(backbone, layer_name)):
+                name = f'{layer_name}.{i}'
+                groups.append(ChannelGroup(f'{name}.conv1', [(block, 'conv1', 'out'), (block, 'bn1', 'bn'), (block, 'conv2', 'in')]))
+                groups.append(ChannelGroup(f'{name}.conv2', [(block, 'conv2', 'out'), (block, 'bn2', 'bn'), (block, 'conv3', 'in')]))
+    else:
+        for stage_idx, stage in enumerate(model.features):
+            if not isinstance(stage, nn.Sequential) or not hasattr(stage[0], 'block'):
+                continue
+            for i, mbconv in enumerate(stage):
+                block = mbconv.block
+                if len(block) < 4:
+                    # expand_ratio == 1: the depthwise conv runs on the block input, nothing internal to prune
+                    continue
+                expand, depthwise, se, project = block[0], block[1], block[2], block[3]
+                groups.append(ChannelGroup(f'features.{stage_idx}.{i}', [
+                    (expand, 0, 'out'), (expand, 1, 'bn'),
+                    (depthwise, 0, 'out'), (depthwise, 1, 'bn'),
+                    (se, 'fc1', 'in'), (se, 'fc2', 'out'),
+                    (project, 0, 'in'),
+                ]))
+        head = model.features[-1]
+        groups.append(ChannelGroup('head', [(head, 0, 'out'), (head, 1, 'bn'), (model.classifier, 1, 'linear_in')]))
+    return groups
+
+
+def magnitude_scores(groups):
+    return {g.name: g.producer.weight.detach().abs().flatten(1).sum(dim=1) for g in groups}
+
+
+def taylor_scores(model, groups, loader, num_batches=10):
+    """Mean |sum_hw(activation * gradient)| per channel at each group's BatchNorm output."""
+    scores = {g.name: torch.zeros(g.channels) for g in groups}
+    handles = []
+
+    def make_hook(name):
+        def hook(module, inputs, output):
+            def accumulate(grad):
+                scores[name] += (output.detach() * grad).sum(dim=(2, 3)).abs().sum(dim=0)
+            output.register_hook(accumulate)
+            # The activation that follows is in-place; hand it a copy so `output` stays intact
+            return output.clone()
+        return hook
+
+    for g in groups:
+        handles.append(g.point.register_forward_hook(make_hook(g.name)))
+    criterion = nn.CrossEntropyLoss()
+    model.eval()
+    seen = 0
+    try:
+        for batch, (inputs, labels) in enumerate(loader):
+            if batch == num_batches:
+                break
+            model.zero_grad()
+            criterion(model(inputs), labels).backward()
+            seen += inputs.size(0)
+    finally:
+        for h in handles:
+            h.remove()
+        model.zero_grad()
+    return {name: s / max(seen, 1) for name, s in scores.items()}
+
+
+def keep_count(channels, sparsity, round_to=8):
+    """Channels kept at `sparsity`, rounded to a multiple of round_to (SIMD-friendly) and never zero."""
+    keep = channels * (1 - sparsity)
+    if round_to > 1:
+        keep = round(keep / round_to) * round_to
+    return int(min(channels, max(round_to, round(keep), 1)))
+
+
+def prune_model(model, arch, scores, sparsity, round_to=8):
+    """Remove the lowest-scoring channels of every group in place. Returns {group: kept channels}."""
+    widths = {}
+    for g in channel_groups(model, arch):
+        keep = keep_count(g.channels, sparsity, round_to)
+        if keep < g.channels:
+            g.prune(torch.topk(scores[g.name], keep).indices)
+        widths[g.name] = keep
+    return widths
+
+
+def load_pruned(path):
+    """Rebuild a model saved by this script (architecture, widths and weights)."""
+    checkpoint = torch.load(path, map_location='cpu')
+    model = build_model(checkpoint['arch'], checkpoint['num_classes'])
+    for g in channel_groups(model, checkpoint['arch']):
+        width = checkpoint['widths'][g.name]
+        if width < g.channels:
+            g.prune(range(width))
+    model.load_state_dict(checkpoint['state_dict'])
+    model.eval()
+    return model
+
+
+def count_macs(model, input_size=224):
+    total = 0
+
+    def hook(module, inputs, output):
+        nonlocal total
+        if isinstance(module, nn.Conv2d):
+            total += output.numel() * (module.in_channels // module.groups) * module.kernel_size[0] * module.kernel_size[1]
+        else:
+            total += module.in_features * module.out_features
+
+    handles = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, (nn.Conv2d, nn.Linear))]
+    model.eval()
+    with torch.no_grad():
+        model(torch.randn(1, 3, input_size, input_size))
+    for h in handles:
+        h.remove()
+    return total
+
+
+def latency_ms(model, runs=20, warmup=3):
+    x = torch.randn(1, 3, 224, 224)
+    model.eval()
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            model(x)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def accuracy(model, loader):
+    model.eval()
+    correct = total = 0
+    with torch.no_grad():
+        for inputs, labels in loader:
+            correct += (model(inputs).argmax(dim=1) == labels).sum().item()
+            total += labels.size(0)
+    return correct / max(total, 1)
+
+
+def finetune(model, loader, epochs, lr):
+    optimizer = torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=lr, momentum=0.9)
+    criterion = nn.CrossEntropyLoss()
+    for epoch in range(epochs):
+        model.train()
+        running_loss, count = 0.0, 0
+        for inputs, labels in loader:
+            optimizer.zero_grad()
+            loss = criterion(model(inputs), labels)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item() * inputs.size(0)
+            count += inputs.size(0)
+        print(f'  fine-tune epoch {epoch + 1}/{epochs} Loss: {running_loss / max(count, 1):.4f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Structured channel pruning with fine-tuning')
+    parser.add_argument('--data_dir', type=str, required=True, help='Dataset folder containing train and val/test')
+    parser.add_argument('--arch', type=str, default='efficientnet_b0', choices=['efficientnet_b0', 'resnet50'],
+                        help='efficientnet_b0 (pneumonia-ml-validation model) or resnet50 (PneumoniaModel)')
+    parser.add_argument('--weights', type=str, required=True, help='Trained checkpoint of the unpruned model')
+    parser.add_argument('--criterion', type=str, default='magnitude', choices=['magnitude', 'taylor'])
+    parser.add_argument('--taylor_batches', type=int, default=10, help='Training batches used for Taylor scores')
+    parser.add_argument('--sparsities', type=float, nargs='+', default=[0.25, 0.5, 0.75], help='Fraction of channels removed per layer')
+    parser.add_argument('--round_to', type=int, default=8, help='Round kept channel counts to a multiple of this')
+    parser.add_argument('--finetune_epochs', type=int, default=1)
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--eval_split', type=str, default='test', help='Split used for the accuracy column')
+    parser.add_argument('--output_dir', type=str, default='pruned', help='Where pruned checkpoints and report.json go')
+    args = parser.parse_args()
+
+    train_set = datasets.ImageFolder(os.path.join(args.data_dir, 'train'), data_transforms['train'])
+    eval_set = datasets.ImageFolder(os.path.join(args.data_dir, args.eval_split), data_transforms[args.arch])
+    train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+    eval_loader = DataLoader(eval_set, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+    num_classes = len(train_set.classes)
+
+    base = build_model(args.arch, num_classes)
+    base.load_state_dict(torch.load(args.weights, map_location='cpu'))
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.criterion == 'taylor':
+        scores = taylor_scores(base, channel_groups(base, args.arch), train_loader, args.taylor_batches)
+    else:
+        scores = magnitude_scores(channel_groups(base, args.arch))
+
+    results = []
+    for sparsity in [0.0] + [s for s in args.sparsities if s > 0]:
+        print(f'Sparsity {sparsity:.2f}')
+        model = deepcopy(base)
+        widths = prune_model(model, args.arch, scores, sparsity, args.round_to) if sparsity else None
+        if widths is not None and args.finetune_epochs:
+            finetune(model, train_loader, args.finetune_epochs, args.lr)
+        row = {
+            'sparsity': sparsity,
+            'parameters': sum(p.numel() for p in model.parameters()),
+            'gmacs': count_macs(model) / 1e9,
+            'latency_ms': latency_ms(model),
+            'accuracy': accuracy(model, eval_loader),
+        }
+        if widths is not None:
+            path = os.path.join(args.output_dir, f'{args.arch}_{args.criterion}_s{int(sparsity * 100)}.pth')
+            torch.save({'arch': args.arch, 'num_classes': num_classes, 'widths': widths,
+                        'state_dict': model.state_dict()}, path)
+            row['checkpoint'] = path
+        results.append(row)
+
+    print(f"{'sparsity':>10}{'parameters':>14}{'GMACs':>10}{'latency ms':>12}{'accuracy':>10}")
+    for row in results:
+        print(f"{row['sparsity']:>10.2f}{row['parameters']:>14,}{row['gmacs']:>10.3f}{row['latency_ms']:>12.2f}{row['accuracy']:>10.4f}")
+    with open(os.path.join(args.output_dir, 'report.json'), 'w') as f:
+        json.dump({'arch': args.arch, 'criterion': args.criterion, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,72 @@
 import os
+import sys
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.optim import lr_scheduler
 from torchvision import datasets, models, transforms
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+from contextlib import nullcontext
 import numpy as np
 import time
 from copy import deepcopy
 from torchvision.models import efficientnet_b0, EfficientNet_B0_Weights
 import argparse
+from evaluation import save_predictions, evaluation_report, print_report
+from image_cache import CachedImageDataset, cached_transforms
+from checkpointing import AsyncCheckpointer, snapshot, load_checkpoint
+from dist_utils import init_distributed, all_reduce_sum, barrier, cleanup, unwrap
+
+# Make the project-root model.py importable for the lightweight architectures
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import SimpleConvNet, CompactConvNet
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--data_dir', type=str, required=True, help='Path to dataset folder containing train, val, test')
+parser.add_argument('--cache_dir', type=str, default=None, help='Optional: pre-decoded cache built with image_cache.py')
+parser.add_argument('--arch', type=str, default='efficientnet_b0', choices=['efficientnet_b0', 'simple', 'compact'],
+                    help='efficientnet_b0 (transfer learning), simple (SimpleConvNet) or compact (CompactConvNet)')
+parser.add_argument('--lr', type=float, default=1e-4, help='Adam learning rate')
+parser.add_argument('--epochs', type=int, default=25, help='Number of training epochs')
+parser.add_argument('--batch_size', type=int, default=2, help='Per-step batch size')
+parser.add_argument('--accum_steps', type=int, default=1, help='Gradient accumulation steps (effective batch = batch_size * accum_steps)')
+parser.add_argument('--num_workers', type=int, default=2, help='DataLoader worker processes')
+parser.add_argument('--prefetch_factor', type=int, default=4, help='Batches prefetched per worker')
+parser.add_argument('--bf16', action='store_true', help='Run forward passes under bfloat16 autocast')
+parser.add_argument('--channels_last', action='store_true', help='Use channels_last memory format for model and inputs')
+parser.add_argument('--checkpoint_dir', type=str, default='checkpoints', help='Directory for periodic checkpoints')
+parser.add_argument('--checkpoint_every', type=int, default=1, help='Checkpoint every N epochs (0 disables)')
+parser.add_argument('--keep_top_k', type=int, default=3, help='Number of best epoch checkpoints to keep')
+parser.add_argument('--resume', type=str, nargs='?', const='auto', default=None,
+                    help='Resume from a checkpoint path, or from <checkpoint_dir>/last.pth if no path is given')
+parser.add_argument('--exclude_list', type=str, default=None, help='Optional: file of image paths to leave out (see phash_index.py)')
+parser.add_argument('--distributed', action='store_true', help='Data-parallel training; launch with torchrun (see dist_utils.py)')
+parser.add_argument('--dist_backend', type=str, default='gloo', help='torch.distributed backend')
+parser.add_argument('--num_threads', type=int, default=None, help='Intra-op threads per process (set to cores / processes per host)')
 args = parser.parse_args()
 
+if args.num_threads:
+    torch.set_num_threads(args.num_threads)
+
+rank, world_size, local_rank = 0, 1, 0
+if args.distributed:
+    rank, world_size, local_rank = init_distributed(args.dist_backend)
+is_main = rank == 0
+
+def log(*values):
+    # Only rank 0 prints so distributed runs produce a single log
+    if is_main:
+        print(*values)
+
 data_dir = args.data_dir
 # Set device
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-print(f'Using device: {device}')
+if torch.cuda.is_available():
+    device = torch.device('cuda', local_rank) if args.distributed else torch.device('cuda')
+else:
+    device = torch.device('cpu')
+log(f'Using device: {device}' + (f' x {world_size} processes ({args.dist_backend})' if args.distributed else ''))
 
 # Data directories
 train_dir = os.path.join(data_dir, 'train')
@@ -52,86 +100,170 @@ data_transforms = {
 data_dirs = {'train': train_dir, 'val': val_dir, 'test': test_dir}
 
 # Datasets and loaders
-image_datasets = {x: datasets.ImageFolder(data_dirs[x], data_transforms[x]) for x in ['train', 'val', 'test']}
-dataloaders = {x: DataLoader(image_datasets[x], batch_size=2, shuffle=True if x == 'train' else False, num_workers=2, pin_memory=True) for x in ['train', 'val', 'test']}
+if args.cache_dir:
+    image_datasets = {x: CachedImageDataset(os.path.join(args.cache_dir, x), cached_transforms[x]) for x in ['train', 'val', 'test']}
+else:
+    image_datasets = {x: datasets.ImageFolder(data_dirs[x], data_transforms[x]) for x in ['train', 'val', 'test']}
+if args.exclude_list:
+    with open(args.exclude_list) as f:
+        excluded = {os.path.abspath(line.strip()) for line in f if line.strip()}
+    for x, dataset in image_datasets.items():
+        before = len(dataset)
+        if isinstance(dataset, CachedImageDataset):
+            dataset.exclude(excluded)
+        else:
+            dataset.samples = [s for s in dataset.samples if os.path.abspath(s[0]) not in excluded]
+            dataset.imgs = dataset.samples
+            dataset.targets = [label for _, label in dataset.samples]
+        log(f'{x}: excluded {before - len(dataset)} listed images')
+loader_kwargs = {'num_workers': args.num_workers, 'pin_memory': device.type == 'cuda'}
+if args.num_workers > 0:
+    loader_kwargs.update(persistent_workers=True, prefetch_factor=args.prefetch_factor)
+# In distributed mode each rank sees a disjoint slice of train/val (the sampler pads the last
+# slice with a few repeated samples); the test set is evaluated on rank 0 only.
+samplers = {x: None for x in ['train', 'val', 'test']}
+if args.distributed:
+    samplers['train'] = DistributedSampler(image_datasets['train'], shuffle=True)
+    samplers['val'] = DistributedSampler(image_datasets['val'], shuffle=False)
+dataloaders = {x: DataLoader(image_datasets[x], batch_size=args.batch_size, shuffle=(x == 'train' and samplers[x] is None),
+                             sampler=samplers[x], **loader_kwargs) for x in ['train', 'val', 'test']}
 dataset_sizes = {x: len(image_datasets[x]) for x in ['train', 'val', 'test']}
 class_names = image_datasets['train'].classes
 num_classes = len(class_names)
 
-# Model (transfer learning)
-model = efficientnet_b0(weights=EfficientNet_B0_Weights.IMAGENET1K_V1)
-num_ftrs = model.classifier[1].in_features
-model.classifier[1] = nn.Linear(num_ftrs, num_classes)
+# Model (transfer learning, or one of the small from-scratch CNNs in model.py)
+if args.arch == 'simple':
+    model = SimpleConvNet(num_classes=num_classes)
+elif args.arch == 'compact':
+    model = CompactConvNet(num_classes=num_classes)
+else:
+    model = efficientnet_b0(weights=EfficientNet_B0_Weights.IMAGENET1K_V1)
+    num_ftrs = model.classifier[1].in_features
+    model.classifier[1] = nn.Linear(num_ftrs, num_classes)
 model = model.to(device)
+memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+model = model.to(memory_format=memory_format)
+
+if args.distributed:
+    model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+
+def autocast():
+    # bf16 autocast on CPU (and CUDA); a no-op context when --bf16 is off
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16)
 
 # Loss and optimizer
 criterion = nn.CrossEntropyLoss()
-optimizer = optim.Adam(model.parameters(), lr=1e-4)
+optimizer = optim.Adam(model.parameters(), lr=args.lr)
 scheduler = lr_scheduler.StepLR(optimizer, step_size=7, gamma=0.1)
 
-def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
-    best_model_wts = deepcopy(model.state_dict())
-    best_acc = 0.0
-    for epoch in range(num_epochs):
-        print(f'Epoch {epoch+1}/{num_epochs}')
-        print('-' * 10)
+def train_model(model, criterion, optimizer, scheduler, num_epochs=25, accum_steps=1,
+                checkpointer=None, checkpoint_every=1, start_epoch=0, best_acc=0.0, best_model_wts=None):
+    if best_model_wts is None:
+        best_model_wts = deepcopy(unwrap(model).state_dict())
+    for epoch in range(start_epoch, num_epochs):
+        log(f'Epoch {epoch+1}/{num_epochs}')
+        log('-' * 10)
         for phase in ['train', 'val']:
             if phase == 'train':
                 model.train()
             else:
                 model.eval()
-            running_loss = 0.0
-            running_corrects = 0
-            for inputs, labels in dataloaders[phase]:
-                inputs = inputs.to(device, non_blocking=True)
+            if samplers[phase] is not None:
+                samplers[phase].set_epoch(epoch)
+            # Accumulated on-device so the loop never blocks on .item(): [loss sum, corrects, samples]
+            totals = torch.zeros(3, dtype=torch.float64, device=device)
+            data_time = 0.0
+            phase_start = time.time()
+            num_batches = len(dataloaders[phase])
+            optimizer.zero_grad(set_to_none=True)
+            wait_start = time.time()
+            for step, (inputs, labels) in enumerate(dataloaders[phase]):
+                data_time += time.time() - wait_start
+                inputs = inputs.to(device, non_blocking=True, memory_format=memory_format)
                 labels = labels.to(device, non_blocking=True)
-                optimizer.zero_grad()
-                with torch.set_grad_enabled(phase == 'train'):
-                    outputs = model(inputs)
-                    _, preds = torch.max(outputs, 1)
-                    loss = criterion(outputs, labels)
+                is_update_step = (step + 1) % accum_steps == 0 or step + 1 == num_batches
+                # Skip the gradient all-reduce on accumulation-only micro-batches
+                sync_context = model.no_sync() if args.distributed and phase == 'train' and not is_update_step else nullcontext()
+                with torch.set_grad_enabled(phase == 'train'), sync_context:
+                    with autocast():
+                        outputs = model(inputs)
+                        loss = criterion(outputs, labels)
+                    preds = outputs.argmax(dim=1)
                     if phase == 'train':
-                        loss.backward()
-                        optimizer.step()
-                running_loss += loss.item() * inputs.size(0)
-                running_corrects += torch.sum(preds == labels.data)
+                        (loss / accum_steps).backward()
+                        if is_update_step:
+                            optimizer.step()
+                            optimizer.zero_grad(set_to_none=True)
+                totals[0] += loss.detach().double() * inputs.size(0)
+                totals[1] += (preds == labels).sum()
+                totals[2] += inputs.size(0)
+                wait_start = time.time()
             if phase == 'train':
                 scheduler.step()
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects.double() / dataset_sizes[phase]
-            print(f'{phase} Loss: {epoch_loss:.4f} Acc: {epoch_acc:.4f}')
+            loss_sum, corrects, count = all_reduce_sum(totals).tolist()
+            epoch_loss = loss_sum / max(count, 1)
+            epoch_acc = corrects / max(count, 1)
+            phase_time = time.time() - phase_start
+            compute_time = phase_time - data_time
+            log(f'{phase} Loss: {epoch_loss:.4f} Acc: {epoch_acc:.4f}')
+            log(f'{phase} {count / phase_time:.1f} img/s | data wait {data_time:.1f}s | '
+                f'compute {compute_time:.1f}s ({100 * compute_time / phase_time:.0f}%)')
             if phase == 'val' and epoch_acc > best_acc:
                 best_acc = epoch_acc
-                best_model_wts = deepcopy(model.state_dict())
-    print(f'Best val Acc: {best_acc:.4f}')
-    model.load_state_dict(best_model_wts)
-    return model
+                best_model_wts = deepcopy(unwrap(model).state_dict())
+        if checkpointer is not None and checkpoint_every > 0 and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == num_epochs):
+            checkpointer.save(snapshot(unwrap(model), optimizer, scheduler, epoch, best_acc, best_model_wts, epoch_acc))
+    log(f'Best val Acc: {best_acc:.4f}')
+    unwrap(model).load_state_dict(best_model_wts)
+    return unwrap(model)
 
 def evaluate_model(model, dataloader, phase='test'):
+    """Returns (accuracy, preds, labels, probs) with preds/labels/probs as NumPy arrays in dataset order."""
     model.eval()
-    running_corrects = 0
-    all_preds = []
-    all_labels = []
+    num_samples = len(dataloader.dataset)
+    all_probs = np.empty((num_samples, num_classes), dtype=np.float32)
+    all_labels = np.empty(num_samples, dtype=np.int64)
+    offset = 0
     with torch.no_grad():
         for inputs, labels in dataloader:
-            inputs = inputs.to(device, non_blocking=True)
-            labels = labels.to(device, non_blocking=True)
-            outputs = model(inputs)
-            _, preds = torch.max(outputs, 1)
-            running_corrects += torch.sum(preds == labels.data)
-            all_preds.extend(preds.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-    acc = running_corrects.double() / len(dataloader.dataset)
+            inputs = inputs.to(device, non_blocking=True, memory_format=memory_format)
+            with autocast():
+                outputs = model(inputs)
+            n = labels.size(0)
+            all_probs[offset:offset + n] = torch.softmax(outputs.float(), dim=1).cpu().numpy()
+            all_labels[offset:offset + n] = labels.numpy()
+            offset += n
+    all_preds = all_probs.argmax(axis=1)
+    acc = float(np.mean(all_preds == all_labels)) if num_samples else 0.0
     print(f'{phase} Accuracy: {acc:.4f}')
-    return acc, all_preds, all_labels
+    return acc, all_preds, all_labels, all_probs
 
 if __name__ == '__main__':
     since = time.time()
-    model = train_model(model, criterion, optimizer, scheduler, num_epochs=25)
+    start_epoch, best_acc, best_model_wts = 0, 0.0, None
+    if args.resume:
+        # Every rank restores optimizer and RNG state, so the checkpoint must be readable on all nodes
+        resume_path = os.path.join(args.checkpoint_dir, 'last.pth') if args.resume == 'auto' else args.resume
+        start_epoch, best_acc, best_model_wts = load_checkpoint(resume_path, unwrap(model), optimizer, scheduler, device)
+        log(f'Resumed from {resume_path} at epoch {start_epoch + 1} (best val Acc so far: {best_acc:.4f})')
+    checkpointer = AsyncCheckpointer(args.checkpoint_dir, keep_top_k=args.keep_top_k) if args.checkpoint_every > 0 and is_main else None
+    try:
+        model = train_model(model, criterion, optimizer, scheduler, num_epochs=args.epochs, accum_steps=args.accum_steps,
+                            checkpointer=checkpointer, checkpoint_every=args.checkpoint_every,
+                            start_epoch=start_epoch, best_acc=best_acc, best_model_wts=best_model_wts)
+    finally:
+        if checkpointer is not None:
+            checkpointer.close()
     time_elapsed = time.time() - since
-    print(f'Training complete in {time_elapsed // 60:.0f}m {time_elapsed % 60:.0f}s')
-    # Save best model
-    torch.save(model.state_dict(), 'best_model.pth')
-    # Evaluate on test set
-    evaluate_model(model, dataloaders['test'], phase='test')
-    print('Class names:', class_names) 
\ No newline at end of file
+    if is_main:
+        print(f'Training complete in {time_elapsed // 60:.0f}m {time_elapsed % 60:.0f}s')
+        # Save best model
+        torch.save(model.state_dict(), 'best_model.pth')
+        # Evaluate on test set and keep the probabilities for offline analysis
+        _, _, test_labels, test_probs = evaluate_model(model, dataloaders['test'], phase='test')
+        test_files = [path for path, _ in image_datasets['test'].samples]
+        save_predictions('test_predictions', test_probs, test_labels, test_files, class_names)
+        print_report(evaluation_report(test_probs, test_labels, class_names))
+        print('Class names:', class_names)
+    barrier()
+    cleanup()
@@ -0,0 +1,161 @@
+"""
+Reduced-precision CPU inference shared by the servers and batch inference.
+
+Three modes:
+
+    fp32            plain float32 (default)
+    bf16_autocast   float32 weights, convolutions/matmuls autocast to bfloat16
+    bf16            weights and activations stored in bfloat16
+
+select_precision() checks the requested mode against float32 on a reference
+batch before it is used. It falls back to fp32 if the CPU has no native bf16
+instructions (emulated bf16 is slower than fp32) or if top-1 predictions or
+probabilities drift beyond the allowed tolerance.
+"""
+
+import os
+import glob
+import ctypes
+import logging
+from contextlib import nullcontext
+
+import torch
+from PIL import Image
+
+PRECISIONS = ('fp32', 'bf16_autocast', 'bf16')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+logger = logging.getLogger(__name__)
+
+
+def native_bf16_supported(device=torch.device('cpu')):
+    """True if bf16 convolutions run natively (AVX512-BF16/AMX on CPU, Ampere+ on CUDA)."""
+    if device.type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    # The ISA flags decide: oneDNN also reports bf16 support on plain AVX512 cores
+    # (Skylake/Cascade Lake), where it only emulates bf16 and runs slower than fp32
+    flags = cpu_flags()
+    if flags is None:
+        return False
+    return bool(flags & {'avx512_bf16', 'amx_bf16', 'bf16'})
+
+
+def cpu_flags():
+    """ISA feature flags from /proc/cpuinfo ('flags' on x86, 'Features' on ARM); None if unavailable."""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key.strip() in ('flags', 'Features'):
+                    return set(value.split())
+    except OSError:
+        pass
+    return None
+
+
+def _openmp_runtime():
+    """The OpenMP runtime torch is running on (libgomp/libiomp), or None."""
+    candidates = []
+    try:
+        # The copy actually loaded into this process, which need not be torch's bundled one
+        with open('/proc/self/maps') as f:
+            candidates = [line.split()[-1] for line in f if 'omp' in os.path.basename(line.split()[-1])]
+    except OSError:
+        pass
+    candidates += glob.glob(os.path.join(os.path.dirname(torch.__file__), 'lib', '*omp*'))
+    for path in candidates:
+        try:
+            lib = ctypes.CDLL(path)
+            lib.omp_set_num_threads
+            return lib
+        except (OSError, AttributeError):
+            continue
+    return None
+
+
+def pin_intraop_threads(num_threads):
+    """Limit the intra-op (OpenMP) team of the calling thread only.
+
+    torch.set_num_threads also changes the default that every thread started
+    later picks up on its first op, so pinning a background thread with it
+    would shrink the request threads too. Falls back to it only when the
+    OpenMP runtime cannot be found.
+    """
+    # torch sets a thread's team size on its first parallel op; do that now so it cannot undo the pin
+    torch.ones(1 << 16).add_(1)
+    lib = _openmp_runtime()
+    if lib is None:
+        torch.set_num_threads(num_threads)
+        return
+    lib.omp_set_num_threads(int(num_threads))
+
+
+def autocast_context(mode, device=torch.device('cpu')):
+    if mode == 'bf16_autocast':
+        return torch.autocast(device.type, dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def run_model(model, inputs, mode='fp32'):
+    """Forward pass in the given mode; always returns float32 outputs."""
+    if mode == 'bf16':
+        return model(inputs.to(torch.bfloat16)).float()
+    with autocast_context(mode, inputs.device):
+        return model(inputs).float()
+
+
+def load_reference_batch(directory, transform, limit=32):
+    """Up to `limit` images under directory (sorted, recursive) as one batch, or None if there are none."""
+    paths = []
+    for root, _, files in os.walk(directory):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    paths = sorted(paths)[:limit]
+    if not paths:
+        return None
+    return torch.stack([transform(Image.open(p).convert('RGB')) for p in paths])
+
+
+def select_precision(model, requested, reference_inputs=None, min_agreement=1.0, max_prob_delta=0.05,
+                     allow_emulated=False):
+    """Switch model to `requested` precision if it is safe to; returns the mode actually in use.
+
+    reference_inputs is a preprocessed batch. Without one, a fixed random batch
+    is used, which only catches numerical breakage, not accuracy drift on real
+    X-rays. In 'bf16' mode the model's parameters are converted in place (and
+    restored if the check fails).
+    """
+    if requested not in PRECISIONS:
+        raise ValueError(f'Unknown precision {requested!r}; expected one of {PRECISIONS}')
+    if requested == 'fp32':
+        return 'fp32'
+    device = next(model.parameters()).device
+    if not allow_emulated and not native_bf16_supported(device):
+        logger.warning(f'{requested} requested but this {device.type} has no native bf16 support; using fp32')
+        return 'fp32'
+
+    if reference_inputs is None:
+        logger.warning('No reference images for the precision check; using a synthetic batch')
+        generator = torch.Generator().manual_seed(0)
+        reference_inputs = torch.randn(8, 3, 224, 224, generator=generator)
+    reference_inputs = reference_inputs.to(device)
+
+    with torch.no_grad():
+        expected = torch.softmax(model(reference_inputs).float(), dim=1)
+        fp32_state = None
+        if requested == 'bf16':
+            fp32_state = {k: v.clone() for k, v in model.state_dict().items()}
+            model.to(torch.bfloat16)
+        actual = torch.softmax(run_model(model, reference_inputs, requested), dim=1)
+
+    agreement = (expected.argmax(dim=1) == actual.argmax(dim=1)).float().mean().item()
+    delta = (expected - actual).abs().max().item()
+    if agreement < min_agreement or delta > max_prob_delta or not torch.isfinite(actual).all():
+        logger.warning(f'{requested} disagrees with fp32 on {len(reference_inputs)} reference images '
+                       f'(top-1 agreement {agreement:.3f}, max probability delta {delta:.4f}); using fp32')
+        if fp32_state is not None:
+            model.float()
+            model.load_state_dict(fp32_state)
+        return 'fp32'
+    logger.info(f'Using {requested} inference: top-1 agreement {agreement:.3f}, '
+                f'max probability delta {delta:.4f} on {len(reference_inputs)} reference images')
+    return requested
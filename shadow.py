@@ -0,0 +1,234 @@
+"""
+Shadow evaluation of a candidate checkpoint on live traffic.
+
+The serving path offers the preprocessed tensor, the primary probabilities
+and the primary forward time of a sampled fraction of requests. offer() only
+enqueues (or drops) them. A single worker thread runs the shadow model, at
+the lowest scheduling priority where the OS allows it, with its intra-op
+thread team limited to `threads` (1 by default), and only while no primary
+work is outstanding. A primary request arriving mid-forward therefore
+competes with at most `threads` low-priority threads, not with a team spread
+over every core. Work is shed in this order:
+
+    shed_load   primary load above max_load when offered
+    shed_queue  the shadow queue (max_queue entries) is full
+    shed_stale  no idle moment within max_age seconds of the request
+
+The report counts agreement (top class by name) with a Wilson 95% interval,
+the primary -> shadow class confusion, per-class disagreement and paired
+primary/shadow forward latencies. It is rewritten atomically to report_path
+every report_interval seconds and on close. Counts accumulate across
+restarts while the primary and shadow checkpoints stay the same.
+"""
+
+import os
+import json
+import math
+import time
+import queue
+import random
+import threading
+from collections import deque
+
+import numpy as np
+import torch
+
+from precision import run_model, pin_intraop_threads
+from model_manager import checkpoint_version
+
+
+def wilson_interval(successes, n, z=1.96):
+    if n == 0:
+        return None
+    p = successes / n
+    centre = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return [round(centre - half, 4), round(centre + half, 4)]
+
+
+class ShadowEvaluator:
+    def __init__(self, manager, model_name, primary_classes, primary_version=None, load=None,
+                 sample_rate=0.1, max_queue=16, max_load=2, max_age=30.0,
+                 report_path='shadow_report.json', report_interval=30.0, window=1000, threads=1):
+        """load() returns the primary requests in flight or queued; the shadow only runs while it is 0."""
+        self.manager = manager
+        self.model_name = model_name
+        self.primary_classes = list(primary_classes)
+        self.load = load or (lambda: 0)
+        self.sample_rate = sample_rate
+        self.max_load = max_load
+        self.max_age = max_age
+        self.report_path = report_path
+        self.report_interval = report_interval
+        self.threads = threads
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.stopping = False
+        entry = manager.entries[model_name]
+        self.key = {'primary': primary_version, 'shadow': checkpoint_version(entry.path) if entry.path else entry.version}
+        self.counts = {'offered': 0, 'sampled': 0, 'evaluated': 0, 'agree': 0, 'shed_load': 0,
+                       'shed_queue': 0, 'shed_stale': 0, 'errors': 0}
+        # confusion[primary class][shadow class]
+        self.confusion = {}
+        # Only pairs with the same class list have comparable probabilities
+        self.prob_diff_sum = 0.0
+        self.prob_diff_count = 0
+        self.latencies = deque(maxlen=window)
+        self.last_saved = time.time()
+        self._restore()
+        self.thread = threading.Thread(target=self._work, name='shadow-worker', daemon=True)
+
+    def _restore(self):
+        if not self.report_path or not os.path.exists(self.report_path):
+            return
+        try:
+            with open(self.report_path) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            return
+        if previous.get('checkpoints') != self.key:
+            return
+        self.counts.update(previous['counts'])
+        self.confusion = previous['confusion']
+        if 'probDiffCount' in previous:
+            # Older reports have no count to go with their sum
+            self.prob_diff_sum = previous['probDiffSum']
+            self.prob_diff_count = previous['probDiffCount']
+
+    def start(self):
+        self.thread.start()
+
+    def offer(self, inputs, primary_probs, primary_ms, reference_number=None):
+        """Called on the request path; never blocks. Returns True if the request was queued."""
+        with self.lock:
+            self.counts['offered'] += 1
+            if random.random() >= self.sample_rate:
+                return False
+            self.counts['sampled'] += 1
+            if self.load() > self.max_load:
+                self.counts['shed_load'] += 1
+                return False
+        try:
+            self.queue.put_nowait((time.time(), inputs, np.asarray(primary_probs, dtype=np.float64).reshape(-1),
+                                   primary_ms, reference_number))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.counts['shed_queue'] += 1
+            return False
+
+    def _init_thread(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        # After the renice: OpenMP threads started by this thread inherit its priority
+        pin_intraop_threads(self.threads)
+
+    def _wait_for_idle(self, submitted):
+        while self.load() > 0:
+            if self.stopping or time.time() - submitted > self.max_age:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _work(self):
+        self._init_thread()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.report_interval)
+            except queue.Empty:
+                item = None
+            if item is None:
+                if self.stopping:
+                    break
+            else:
+                submitted, inputs, primary_probs, primary_ms, reference_number = item
+                if not self._wait_for_idle(submitted):
+                    with self.lock:
+                        self.counts['shed_stale'] += 1
+                else:
+                    self._evaluate(inputs, primary_probs, primary_ms)
+            if time.time() - self.last_saved >= self.report_interval:
+                self.save()
+        self.save()
+
+    def _evaluate(self, inputs, primary_probs, primary_ms):
+        try:
+            with self.manager.acquire(self.model_name) as entry:
+                start = time.perf_counter()
+                with torch.no_grad():
+                    outputs = run_model(entry.model, inputs, entry.extras.get('precision', 'fp32'))
+                shadow_ms = (time.perf_counter() - start) * 1000
+                shadow_classes = entry.classes
+            shadow_probs = torch.softmax(outputs, dim=1)[0].cpu().numpy()
+        except Exception as e:
+            with self.lock:
+                self.counts['errors'] += 1
+            print(f'Shadow evaluation failed: {e}')
+            return
+        primary_class = self.primary_classes[int(primary_probs.argmax())]
+        shadow_class = shadow_classes[int(shadow_probs.argmax())]
+        with self.lock:
+            self.counts['evaluated'] += 1
+            self.counts['agree'] += int(primary_class == shadow_class)
+            row = self.confusion.setdefault(primary_class, {})
+            row[shadow_class] = row.get(shadow_class, 0) + 1
+            if list(shadow_classes) == self.primary_classes:
+                self.prob_diff_sum += float(np.abs(shadow_probs - primary_probs).max())
+                self.prob_diff_count += 1
+            self.latencies.append((primary_ms, shadow_ms))
+
+    def report(self):
+        with self.lock:
+            counts = dict(self.counts)
+            confusion = {p: dict(row) for p, row in self.confusion.items()}
+            latencies = np.array(self.latencies) if self.latencies else None
+            prob_diff_sum, prob_diff_count = self.prob_diff_sum, self.prob_diff_count
+        evaluated = counts['evaluated']
+        per_class = {}
+        for primary_class, row in confusion.items():
+            total = sum(row.values())
+            per_class[primary_class] = {'count': total,
+                                        'disagreementRate': round(1 - row.get(primary_class, 0) / total, 4)}
+        report = {
+            'model': self.model_name,
+            'checkpoints': self.key,
+            'sampleRate': self.sample_rate,
+            'queued': self.queue.qsize(),
+            'counts': counts,
+            'agreementRate': round(counts['agree'] / evaluated, 4) if evaluated else None,
+            'agreementCI95': wilson_interval(counts['agree'], evaluated),
+            'confusion': confusion,
+            'perClass': per_class,
+            'meanMaxProbDiff': round(prob_diff_sum / prob_diff_count, 4) if prob_diff_count else None,
+            'probDiffSum': prob_diff_sum,
+            'probDiffCount': prob_diff_count,
+            'updatedAt': time.time(),
+        }
+        if latencies is not None:
+            p50, p95 = np.percentile(latencies, [50, 95], axis=0)
+            report['latencyMs'] = {
+                'window': len(latencies),
+                'primary': {'p50': round(float(p50[0]), 2), 'p95': round(float(p95[0]), 2)},
+                'shadow': {'p50': round(float(p50[1]), 2), 'p95': round(float(p95[1]), 2)},
+                'medianRatio': round(float(np.median(latencies[:, 1] / np.maximum(latencies[:, 0], 1e-6))), 3),
+            }
+        return report
+
+    def save(self):
+        self.last_saved = time.time()
+        if not self.report_path:
+            return
+        tmp = self.report_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmp, self.report_path)
+
+    def close(self):
+        self.stopping = True
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=10)
+        else:
+            self.save()
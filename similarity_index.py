@@ -0,0 +1,291 @@
+"""
+Persistent embedding index for similar-case retrieval.
+
+Embeddings are L2-normalised and stored as a compact float16 matrix, so cosine
+similarity is a dot product. The index lives in a directory of append-only
+files and is updated incrementally as predictions are made:
+
+    index.json        dimension and IVF settings
+    vectors.f16       raw float16 rows
+    meta.jsonl        one {"reference_number", "diagnosis", ...} object per row
+    ivf_centroids.npy optional inverted-file centroids
+    ivf_assign.i32    list assignment of every row once IVF is trained
+
+Small indexes are searched exhaustively. Once IVF is trained (explicitly or
+automatically past auto_ivf_rows) a query only scans the nprobe closest lists.
+
+    python similarity_index.py --index_dir similarity_index --train_ivf --nlist 1024
+"""
+
+import os
+import json
+import logging
+import argparse
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SimilarityIndex:
+    def __init__(self, directory, dim=None, nprobe=8, auto_ivf_rows=50000, search_chunk=65536):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.nprobe = nprobe
+        self.auto_ivf_rows = auto_ivf_rows
+        self.search_chunk = search_chunk
+        self.lock = threading.Lock()
+        self.training = False
+
+        config_path = os.path.join(directory, 'index.json')
+        if os.path.exists(config_path):
+            with open(config_path) as f:
+                config = json.load(f)
+            if dim is not None and config['dim'] != dim:
+                raise ValueError(f"Index at {directory} has dim {config['dim']}, expected {dim}")
+            dim = config['dim']
+        elif dim is None:
+            raise ValueError('dim is required to create a new index')
+        else:
+            with open(config_path, 'w') as f:
+                json.dump({'dim': dim}, f)
+        self.dim = dim
+
+        self._load()
+        self.vector_file = open(self._path('vectors.f16'), 'ab')
+        self.meta_file = open(self._path('meta.jsonl'), 'a')
+        self.assign_file = open(self._path('ivf_assign.i32'), 'ab') if self.centroids is not None else None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        vectors = np.zeros((0, self.dim), dtype=np.float16)
+        if os.path.exists(self._path('vectors.f16')):
+            vectors = np.fromfile(self._path('vectors.f16'), dtype=np.float16)
+            vectors = vectors[:len(vectors) // self.dim * self.dim].reshape(-1, self.dim)
+
+        metas = []
+        if os.path.exists(self._path('meta.jsonl')):
+            with open(self._path('meta.jsonl')) as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    metas.append(json.loads(line))
+
+        # A crash between the two appends can leave them out of step; keep the common prefix
+        rows = min(len(vectors), len(metas))
+        self._truncate('vectors.f16', rows * self.dim * 2)
+        self._truncate('meta.jsonl', sum(len(json.dumps(m)) + 1 for m in metas[:rows]))
+
+        self.capacity = max(1024, rows * 2)
+        self.vectors = np.zeros((self.capacity, self.dim), dtype=np.float16)
+        self.vectors[:rows] = vectors[:rows]
+        self.metas = metas[:rows]
+        self.size = rows
+        # Re-adding a reference number supersedes its earlier row
+        self.valid = np.zeros(self.capacity, dtype=bool)
+        self.row_of = {}
+        for row, meta in enumerate(self.metas):
+            previous = self.row_of.get(meta['reference_number'])
+            if previous is not None:
+                self.valid[previous] = False
+            self.row_of[meta['reference_number']] = row
+            self.valid[row] = True
+
+        self.centroids = None
+        self.assign = np.zeros(self.capacity, dtype=np.int32)
+        if os.path.exists(self._path('ivf_centroids.npy')):
+            self.centroids = np.load(self._path('ivf_centroids.npy'))
+            assigned = np.zeros(0, dtype=np.int32)
+            if os.path.exists(self._path('ivf_assign.i32')):
+                assigned = np.fromfile(self._path('ivf_assign.i32'), dtype=np.int32)[:rows]
+            self.assign[:len(assigned)] = assigned
+            if len(assigned) < rows:
+                self.assign[len(assigned):rows] = self._nearest_lists(self.vectors[len(assigned):rows])
+            with open(self._path('ivf_assign.i32'), 'wb') as f:
+                self.assign[:rows].tofile(f)
+
+    def _truncate(self, name, length):
+        path = self._path(name)
+        if os.path.exists(path) and os.path.getsize(path) != length:
+            with open(path, 'r+b') as f:
+                f.truncate(length)
+
+    def _grow(self):
+        self.capacity *= 2
+        for name in ('vectors', 'valid', 'assign'):
+            old = getattr(self, name)
+            new = np.zeros((self.capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    @staticmethod
+    def _normalise(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, vectors.shape[-1])
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _nearest_lists(self, vectors):
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), self.search_chunk):
+            chunk = np.asarray(vectors[start:start + self.search_chunk], dtype=np.float32)
+            out[start:start + len(chunk)] = (chunk @ self.centroids.T).argmax(axis=1)
+        return out
+
+    def __len__(self):
+        return len(self.row_of)
+
+    def add(self, reference_number, embedding, **meta):
+        """Append one embedding; meta (e.g. diagnosis, confidence) is returned with search hits."""
+        vector = self._normalise(np.asarray(embedding))
+        if vector.shape[1] != self.dim:
+            raise ValueError(f'Embedding has dim {vector.shape[1]}, index expects {self.dim}')
+        vector = vector.astype(np.float16)
+        record = dict(meta, reference_number=reference_number)
+        with self.lock:
+            if self.size == self.capacity:
+                self._grow()
+            row = self.size
+            self.vectors[row] = vector[0]
+            previous = self.row_of.get(reference_number)
+            if previous is not None:
+                self.valid[previous] = False
+            self.valid[row] = True
+            self.row_of[reference_number] = row
+            self.metas.append(record)
+            self.size += 1
+
+            vector.tofile(self.vector_file)
+            self.vector_file.flush()
+            self.meta_file.write(json.dumps(record) + '\n')
+            self.meta_file.flush()
+            if self.centroids is not None:
+                self.assign[row] = self._nearest_lists(vector)[0]
+                self.assign[row:row + 1].tofile(self.assign_file)
+                self.assign_file.flush()
+            needs_ivf = (self.centroids is None and not self.training and self.auto_ivf_rows
+                         and self.size >= self.auto_ivf_rows)
+            if needs_ivf:
+                self.training = True
+        if needs_ivf:
+            # Train off the request path; exhaustive search keeps working meanwhile
+            threading.Thread(target=self._train_ivf_background, name='ivf-train', daemon=True).start()
+
+    def vector_for(self, reference_number):
+        row = self.row_of.get(reference_number)
+        return None if row is None else self.vectors[row].astype(np.float32)
+
+    def search(self, embedding, k=5, exclude=None, nprobe=None):
+        """Top-k most similar indexed scans as [{'reference_number', 'score', ...meta}], best first."""
+        query = self._normalise(np.asarray(embedding))[0]
+        # Snapshot under the lock, score outside it: rows below size are never rewritten, and
+        # _grow/train_ivf swap in new arrays rather than changing these ones
+        with self.lock:
+            size = self.size
+            valid = self.valid[:size].copy()
+            if exclude is not None and exclude in self.row_of:
+                valid[self.row_of[exclude]] = False
+            vectors, assign, centroids, metas = self.vectors, self.assign[:size], self.centroids, self.metas
+        if centroids is not None:
+            probe = np.argsort(-(centroids @ query))[:nprobe or self.nprobe]
+            candidates = np.flatnonzero(valid & np.isin(assign, probe))
+            scores = vectors[candidates].astype(np.float32) @ query
+        else:
+            # Contiguous slices avoid a gathered copy of the whole matrix
+            scores = np.empty(size, dtype=np.float32)
+            for start in range(0, size, self.search_chunk):
+                end = min(start + self.search_chunk, size)
+                scores[start:end] = vectors[start:end].astype(np.float32) @ query
+            candidates = np.flatnonzero(valid)
+            scores = scores[candidates]
+        k = min(k, len(candidates))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [dict(metas[candidates[i]], score=round(float(scores[i]), 4)) for i in top]
+
+    def _train_ivf_background(self):
+        try:
+            self.train_ivf()
+        except Exception as e:
+            logger.error(f'IVF training failed: {e}')
+        finally:
+            # Without this a failed run would block automatic training for good
+            with self.lock:
+                self.training = False
+
+    def train_ivf(self, nlist=None, iterations=10, sample_size=100000, seed=0):
+        """Spherical k-means over (a sample of) the index, then assign every row to a list."""
+        with self.lock:
+            size = self.size
+            rows = np.flatnonzero(self.valid[:size])
+            if nlist is None:
+                nlist = max(1, int(np.sqrt(len(rows))))
+            rng = np.random.default_rng(seed)
+            sample = rows if len(rows) <= sample_size else rng.choice(rows, sample_size, replace=False)
+            data = self.vectors[sample].astype(np.float32)
+        if len(data) < nlist:
+            raise ValueError(f'Need at least {nlist} vectors to train {nlist} lists, have {len(data)}')
+
+        centroids = data[rng.choice(len(data), nlist, replace=False)]
+        for _ in range(iterations):
+            labels = (data @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, data)
+            counts = np.bincount(labels, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                # Re-seed empty lists with random points so every list stays in use
+                sums[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+            centroids = self._normalise(sums)
+
+        with self.lock:
+            self.centroids = centroids.astype(np.float32)
+            # A fresh array, so a search holding the old assignment keeps a consistent view
+            assign = np.zeros(self.capacity, dtype=np.int32)
+            assign[:self.size] = self._nearest_lists(self.vectors[:self.size])
+            self.assign = assign
+            np.save(self._path('ivf_centroids.npy'), self.centroids)
+            if self.assign_file is not None:
+                self.assign_file.close()
+            with open(self._path('ivf_assign.i32'), 'wb') as f:
+                self.assign[:self.size].tofile(f)
+            self.assign_file = open(self._path('ivf_assign.i32'), 'ab')
+            self.training = False
+        return nlist
+
+    def stats(self):
+        return {
+            'scans': len(self),
+            'rows': self.size,
+            'dim': self.dim,
+            'bytes': self.size * self.dim * 2,
+            'ivf_lists': None if self.centroids is None else len(self.centroids),
+            'nprobe': self.nprobe,
+        }
+
+    def close(self):
+        for f in (self.vector_file, self.meta_file, self.assign_file):
+            if f is not None:
+                f.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or (re)train the similar-case embedding index')
+    parser.add_argument('--index_dir', type=str, default='similarity_index', help='Index directory')
+    parser.add_argument('--train_ivf', action='store_true', help='Train inverted-file lists over the current contents')
+    parser.add_argument('--nlist', type=int, default=None, help='Number of IVF lists (default: sqrt of the index size)')
+    args = parser.parse_args()
+
+    index = SimilarityIndex(args.index_dir, auto_ivf_rows=0)
+    if args.train_ivf:
+        print(f'Trained {index.train_ivf(args.nlist)} IVF lists')
+    print(json.dumps(index.stats(), indent=2))
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+import threading
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import CompactConvNet
+from model_manager import ModelManager
+
+
+def test_acquire_waits_for_prepare(tmp_path):
+    weights = tmp_path / 'compact.pth'
+    torch.save(CompactConvNet().state_dict(), weights)
+
+    def prepare(entry):
+        # Stands in for precision selection and hook setup
+        time.sleep(0.3)
+        entry.extras['precision'] = 'bf16'
+
+    manager = ModelManager(2 ** 32, prepare=prepare)
+    manager.register('student', str(weights))
+    seen = []
+
+    def use():
+        with manager.acquire('student') as entry:
+            seen.append(entry.extras.get('precision'))
+
+    loader = threading.Thread(target=use)
+    loader.start()
+    # Arrive while the first request is inside prepare()
+    deadline = time.time() + 30
+    while manager.entries['student'].model is None and time.time() < deadline:
+        time.sleep(0.005)
+    use()
+    loader.join()
+    assert seen == ['bf16', 'bf16']
+    assert manager.entries['student'].loads == 1
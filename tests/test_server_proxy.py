@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import socket
+import struct
+import threading
+import http.client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend', 'ml_model'))
+from server import Replica, Supervisor, make_proxy_handler
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/stream':
+            # Server-sent events that outlast the client
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for i in range(40):
+                    data = f'data: {i}\n\n'.encode()
+                    self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                    self.wfile.flush()
+                    time.sleep(0.02)
+                self.wfile.write(b'0\r\n\r\n')
+            except OSError:
+                pass
+            return
+        body = b'{"status": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def proxy():
+    upstream = serve(ThreadingHTTPServer(('127.0.0.1', 0), UpstreamHandler))
+    replica = Replica(0, None, None, upstream.server_address[1])
+    replica.healthy = True
+    front = serve(ThreadingHTTPServer(('127.0.0.1', 0), make_proxy_handler(Supervisor([replica]))))
+    yield front.server_address[1], replica
+    front.shutdown()
+    upstream.shutdown()
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', path)
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response.status, body
+
+
+def wait_served(replica, count, timeout=10):
+    # The client can have the whole body before the proxy has put the upstream connection back
+    deadline = time.time() + timeout
+    while replica.served < count and time.time() < deadline:
+        time.sleep(0.02)
+    assert replica.served == count
+
+
+def test_completed_response_reuses_connection(proxy):
+    port, replica = proxy
+    for served in (1, 2):
+        assert get(port, '/health') == (200, b'{"status": "ok"}')
+        wait_served(replica, served)
+        assert len(replica.pool) == 1
+
+
+def test_client_disconnect_mid_stream_does_not_poison_pool(proxy):
+    port, replica = proxy
+    client = socket.create_connection(('127.0.0.1', port), timeout=10)
+    client.sendall(b'GET /stream HTTP/1.1\r\nHost: test\r\n\r\n')
+    received = b''
+    while b'data: 0' not in received:
+        received += client.recv(4096)
+    # Reset rather than a clean close, so the proxy's next write fails
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    client.close()
+
+    wait_served(replica, 1)
+    assert replica.pool == []
+    assert get(port, '/health') == (200, b'{"status": "ok"}')
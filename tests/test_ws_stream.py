@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import time
+import struct
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import CompactConvNet
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    weights = tmp_path / 'compact.pth'
+    torch.save(CompactConvNet().state_dict(), weights)
+    monkeypatch.setenv('MODEL_PATH', str(weights))
+    monkeypatch.setenv('AUDIT_LOG_PATH', '')
+    monkeypatch.setenv('PHASH_INDEX_PATH', str(tmp_path / 'phash.jsonl'))
+    monkeypatch.setenv('SIMILARITY_INDEX_DIR', str(tmp_path / 'similarity'))
+    monkeypatch.setenv('DRIFT_REFERENCE', str(tmp_path / 'missing.json'))
+    from fastapi.testclient import TestClient
+    import app
+
+    def slow_analyze(image_bytes, **kwargs):
+        # Slower than reading frames, so the window is what limits how many are in flight
+        time.sleep(0.05)
+        return {'diagnosis': 'Normal'}
+
+    monkeypatch.setattr(app, 'analyze_image', slow_analyze)
+    with TestClient(app.app) as test_client:
+        yield test_client
+
+
+def frame(header, data=b'image'):
+    encoded = json.dumps(header).encode()
+    return struct.pack('>H', len(encoded)) + encoded + data
+
+
+def test_bad_text_frames_keep_window_bounded(client):
+    window = 2
+    with client.websocket_connect(f'/ws/stream?window={window}') as ws:
+        assert ws.receive_json()['window'] == window
+        for _ in range(5):
+            ws.send_text('not a control message')
+        for i in range(12):
+            ws.send_bytes(frame({'id': i}))
+        ws.send_text(json.dumps({'type': 'end'}))
+
+        in_flight = peak = errors = 0
+        results = []
+        while True:
+            message = ws.receive_json()
+            if message['type'] == 'accepted':
+                in_flight += 1
+                peak = max(peak, in_flight)
+            elif message['type'] == 'result':
+                in_flight -= 1
+                results.append(message['id'])
+            elif message['type'] == 'error':
+                errors += 1
+            elif message['type'] == 'done':
+                break
+
+    assert errors == 5
+    assert sorted(results) == list(range(12))
+    assert peak <= window
@@ -0,0 +1,214 @@
+"""
+Train the PneumoniaModel classification head on cached backbone features.
+
+With freeze_backbone=True only backbone.fc learns, so the ResNet50 forward is
+the same every epoch. This script runs the frozen backbone once per image
+(plus optional fixed augmented copies of the training set), stores the pooled
+2048-d features as a float16 memory-mapped array, then trains the head on
+those features for as many epochs as needed.
+
+    python train_head.py --data_dir data --cache_dir feature_cache --augmentations 4 --epochs 100
+
+A split's cache is rebuilt when its file list, the backbone weights or the
+number of augmentations differ from what its meta.json records.
+
+The result is a full PneumoniaModel state dict that app.py can load.
+"""
+
+import os
+import json
+import time
+import hashlib
+import argparse
+from copy import deepcopy
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from torchvision import datasets, transforms
+
+from model import PneumoniaModel
+
+FEATURE_DIM = 2048
+
+# Same preprocessing as app.py's preprocess_image
+base_transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+])
+
+augment_transform = transforms.Compose([
+    transforms.RandomResizedCrop(224, scale=(0.8, 1.0)),
+    transforms.RandomHorizontalFlip(),
+    transforms.RandomRotation(10),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+])
+
+
+def file_list_digest(samples, root):
+    """Short hash of the sorted (relative path, class index) list an ImageFolder split is built from."""
+    digest = hashlib.sha256()
+    for path, target in sorted(samples):
+        digest.update(f'{os.path.relpath(path, root)}\t{target}\n'.encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+def backbone_version(model):
+    """Short hash of the backbone weights the features come from (the fc head excluded)."""
+    digest = hashlib.sha256()
+    for name, tensor in model.backbone.state_dict().items():
+        if name.startswith('fc.'):
+            continue
+        digest.update(name.encode('utf-8'))
+        digest.update(tensor.cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+
+def cache_key(split_dir, backbone, augmentations):
+    """What a split's meta.json must record for its cached features to be reused."""
+    samples = datasets.ImageFolder(split_dir).samples
+    return {'num_images': len(samples), 'files_sha256': file_list_digest(samples, split_dir),
+            'backbone': backbone, 'augmentations': augmentations}
+
+
+def build_feature_cache(model, split_dir, out_dir, augmentations=0, batch_size=64, num_workers=4, seed=0,
+                        backbone=None):
+    """Write features.npy (float16, rows x 2048) and labels.npy for a split.
+
+    Row block 0 holds the un-augmented images; blocks 1..augmentations hold
+    one augmented view each, drawn with a fixed seed so rebuilding is repeatable.
+    backbone is recorded in meta.json (backbone_version(model) if not given).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    passes = [base_transform] + [augment_transform] * augmentations
+    plain = datasets.ImageFolder(split_dir)
+    num_images = len(plain.samples)
+    features = np.lib.format.open_memmap(os.path.join(out_dir, 'features.npy'), mode='w+',
+                                         dtype=np.float16, shape=(num_images * len(passes), FEATURE_DIM))
+    labels = np.tile(np.asarray(plain.targets, dtype=np.int64), len(passes))
+
+    model.eval()
+    offset = 0
+    with torch.no_grad():
+        for pass_index, transform in enumerate(passes):
+            torch.manual_seed(seed + pass_index)
+            dataset = datasets.ImageFolder(split_dir, transform)
+            loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+            start = time.time()
+            for inputs, _ in loader:
+                n = inputs.size(0)
+                features[offset:offset + n] = model.extract_features(inputs).numpy().astype(np.float16)
+                offset += n
+            print(f'{split_dir} pass {pass_index + 1}/{len(passes)}: {num_images / (time.time() - start):.1f} img/s')
+    features.flush()
+    del features
+
+    np.save(os.path.join(out_dir, 'labels.npy'), labels)
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'classes': plain.classes, 'num_images': num_images,
+                   'files_sha256': file_list_digest(plain.samples, split_dir),
+                   'backbone': backbone or backbone_version(model), 'augmentations': augmentations,
+                   'feature_dim': FEATURE_DIM}, f, indent=2)
+
+
+def load_feature_cache(out_dir):
+    with open(os.path.join(out_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    features = np.load(os.path.join(out_dir, 'features.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(out_dir, 'labels.npy'))
+    return features, labels, meta
+
+
+def iterate_batches(features, labels, batch_size, shuffle):
+    order = np.random.permutation(len(labels)) if shuffle else np.arange(len(labels))
+    for start in range(0, len(order), batch_size):
+        # Sorted indices keep memmap reads mostly sequential
+        idx = np.sort(order[start:start + batch_size])
+        yield (torch.from_numpy(np.asarray(features[idx], dtype=np.float32)),
+               torch.from_numpy(labels[idx]))
+
+
+def train_head(head, train_cache, val_cache, epochs=100, batch_size=256, lr=1e-3):
+    train_features, train_labels, _ = train_cache
+    val_features, val_labels, _ = val_cache
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(head.parameters(), lr=lr)
+    best_head = deepcopy(head.state_dict())
+    best_acc = 0.0
+    for epoch in range(epochs):
+        head.train()
+        running_loss = 0.0
+        for inputs, labels in iterate_batches(train_features, train_labels, batch_size, shuffle=True):
+            optimizer.zero_grad()
+            loss = criterion(head(inputs), labels)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item() * inputs.size(0)
+
+        head.eval()
+        correct = 0
+        with torch.no_grad():
+            for inputs, labels in iterate_batches(val_features, val_labels, batch_size, shuffle=False):
+                correct += (head(inputs).argmax(dim=1) == labels).sum().item()
+        val_acc = correct / max(len(val_labels), 1)
+        print(f'Epoch {epoch + 1}/{epochs} train Loss: {running_loss / len(train_labels):.4f} val Acc: {val_acc:.4f}')
+        if val_acc > best_acc:
+            best_acc = val_acc
+            best_head = deepcopy(head.state_dict())
+    print(f'Best val Acc: {best_acc:.4f}')
+    head.load_state_dict(best_head)
+    return head
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the PneumoniaModel head on cached frozen-backbone features')
+    parser.add_argument('--data_dir', type=str, required=True, help='Dataset folder containing train and val (NORMAL/PNEUMONIA subfolders)')
+    parser.add_argument('--cache_dir', type=str, default='feature_cache', help='Where features are cached')
+    parser.add_argument('--augmentations', type=int, default=0, help='Extra augmented views of the train split to cache')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute features even if a cache exists')
+    parser.add_argument('--epochs', type=int, default=100, help='Head training epochs')
+    parser.add_argument('--batch_size', type=int, default=256, help='Head training batch size')
+    parser.add_argument('--lr', type=float, default=1e-3, help='Head learning rate')
+    parser.add_argument('--num_workers', type=int, default=4, help='Decoding workers while extracting features')
+    parser.add_argument('--output', type=str, default='best_model.pth', help='Where to save the full model state dict')
+    args = parser.parse_args()
+
+    model = PneumoniaModel(pretrained=True, freeze_backbone=True)
+    model.eval()
+    backbone = backbone_version(model)
+
+    caches = {}
+    for split, augmentations in [('train', args.augmentations), ('val', 0)]:
+        split_dir = os.path.join(args.data_dir, split)
+        out_dir = os.path.join(args.cache_dir, split)
+        meta_path = os.path.join(out_dir, 'meta.json')
+        stale = True
+        if os.path.exists(meta_path) and not args.rebuild:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            changed = [k for k, v in cache_key(split_dir, backbone, augmentations).items() if meta.get(k) != v]
+            if changed:
+                print(f'{split} feature cache is stale ({", ".join(changed)} changed); rebuilding')
+            stale = bool(changed)
+        if stale:
+            build_feature_cache(model, split_dir, out_dir, augmentations, num_workers=args.num_workers,
+                                backbone=backbone)
+        caches[split] = load_feature_cache(out_dir)
+
+    classes = caches['train'][2]['classes']
+    if len(classes) != 2:
+        raise ValueError(f'PneumoniaModel is binary but the dataset has classes {classes}')
+    print(f'Classes: {classes}, cached train rows: {len(caches["train"][1])}, val rows: {len(caches["val"][1])}')
+
+    since = time.time()
+    train_head(model.backbone.fc, caches['train'], caches['val'], args.epochs, args.batch_size, args.lr)
+    print(f'Head training complete in {time.time() - since:.1f}s')
+    model.save(args.output)
+    print(f'Saved model to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
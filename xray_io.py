@@ -0,0 +1,420 @@
+"""
+Decoding of DICOM and high-bit-depth X-rays into model-ready RGB images.
+
+PACS exports are DICOM or 16-bit PNG/TIFF of 3000x3000 pixels or more, while
+the models only see 224x224. load_xray() therefore never builds a
+full-resolution float or RGB copy of them:
+
+    native DICOM,     the pixel data is read in place (a view on the upload
+    uncompressed TIFF bytes, or np.memmap on a file) and area-averaged band
+                      by band down to roughly min_size on the short side
+    JPEG in DICOM     decoded at reduced scale by libjpeg (Image.draft)
+    16-bit PNG        has to be inflated whole, then area-averaged the same way
+
+Ordinary 8-bit JPEG/PNG decode exactly as Image.open(...).convert('RGB'), so
+existing uploads give the same model inputs as before. reduce_8bit=True
+decodes them at reduced scale too, which is faster on large files but moves
+the 224x224 input by up to a few tens of grey levels.
+
+The reduced image goes through the modality LUT (rescale slope/intercept),
+VOI windowing (window center/width, LINEAR/LINEAR_EXACT/SIGMOID, or a VOI LUT
+table) and MONOCHROME1 inversion. Without a window in the file, the 0.5-99.5th
+percentiles (of a strided sample of the raw pixels) are stretched to the
+display range. Windowing on the averaged
+pixels differs from windowing first only where a block straddles the window
+edges. Other compressed DICOM transfer syntaxes need pydicom (optional).
+
+    image = load_xray(upload_bytes)        # or a file path
+    tensor = image_transform(image)
+"""
+
+import io
+import os
+import zlib
+import struct
+
+import numpy as np
+from PIL import Image
+
+XRAY_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.dcm', '.dicom', '.tif', '.tiff')
+
+IMPLICIT_VR_LITTLE = '1.2.840.10008.1.2'
+EXPLICIT_VR_LITTLE = '1.2.840.10008.1.2.1'
+DEFLATED_EXPLICIT_VR_LITTLE = '1.2.840.10008.1.2.1.99'
+JPEG_BASELINE = ('1.2.840.10008.1.2.4.50', '1.2.840.10008.1.2.4.51')
+
+# VRs with a 2-byte reserved field and a 4-byte length in explicit VR encoding
+_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+# Implicit VR files carry no VR; these are the only sequences we need to look inside
+_SEQUENCES = {(0x0028, 0x3010)}
+_ITEM, _ITEM_END, _SEQUENCE_END = (0xFFFE, 0xE000), (0xFFFE, 0xE00D), (0xFFFE, 0xE0DD)
+PIXEL_DATA = (0x7FE0, 0x0010)
+
+ROWS, COLUMNS = (0x0028, 0x0010), (0x0028, 0x0011)
+SAMPLES_PER_PIXEL, PHOTOMETRIC, PLANAR_CONFIGURATION = (0x0028, 0x0002), (0x0028, 0x0004), (0x0028, 0x0006)
+BITS_ALLOCATED, BITS_STORED, PIXEL_REPRESENTATION = (0x0028, 0x0100), (0x0028, 0x0101), (0x0028, 0x0103)
+WINDOW_CENTER, WINDOW_WIDTH, VOI_LUT_FUNCTION = (0x0028, 0x1050), (0x0028, 0x1051), (0x0028, 0x1056)
+RESCALE_INTERCEPT, RESCALE_SLOPE = (0x0028, 0x1052), (0x0028, 0x1053)
+VOI_LUT_SEQUENCE, LUT_DESCRIPTOR, LUT_DATA = (0x0028, 0x3010), (0x0028, 0x3002), (0x0028, 0x3006)
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+def is_dicom(data):
+    return len(data) >= 132 and data[128:132] == b'DICM'
+
+
+def _read_source(source):
+    """(bytes-like, path or None); files are memory-mapped so pixel data is paged in on demand."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return memoryview(source), None
+    with open(source, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+    return memoryview(np.memmap(source, dtype=np.uint8, mode='r', shape=(size,))), source
+
+
+# --- DICOM parsing ----------------------------------------------------------------------------
+
+def _parse(buf, pos, end, explicit, stop_at_pixels=True, last_group=0xFFFF):
+    """Elements of buf[pos:end] as {tag: (vr, value)}; sequence values are lists of item dicts.
+    Pixel data is returned as (offset, length) without being read. Stops before any element of a
+    group after last_group."""
+    elements = {}
+    while pos + 8 <= end:
+        group, element = struct.unpack_from('<HH', buf, pos)
+        tag = (group, element)
+        if tag in (_ITEM_END, _SEQUENCE_END):
+            return elements, pos + 8
+        if group > last_group and group != 0xFFFE:
+            return elements, pos
+        vr = None
+        if explicit and group != 0xFFFE:
+            vr = bytes(buf[pos + 4:pos + 6])
+            if vr in _LONG_VRS:
+                length = struct.unpack_from('<I', buf, pos + 8)[0]
+                pos += 12
+            else:
+                length = struct.unpack_from('<H', buf, pos + 6)[0]
+                pos += 8
+        else:
+            length = struct.unpack_from('<I', buf, pos + 4)[0]
+            pos += 8
+            if tag in _SEQUENCES:
+                vr = b'SQ'
+        if tag == PIXEL_DATA:
+            elements[tag] = (vr, (pos, length))
+            if stop_at_pixels:
+                return elements, pos
+        elif vr == b'SQ' or length == 0xFFFFFFFF:
+            items, pos = _parse_sequence(buf, pos, length, explicit)
+            elements[tag] = (b'SQ', items)
+            continue
+        else:
+            elements[tag] = (vr, buf[pos:pos + length])
+        if length == 0xFFFFFFFF:
+            break
+        pos += length
+    return elements, pos
+
+
+def _parse_sequence(buf, pos, length, explicit):
+    end = len(buf) if length == 0xFFFFFFFF else pos + length
+    items = []
+    while pos + 8 <= end:
+        tag = struct.unpack_from('<HH', buf, pos)
+        item_length = struct.unpack_from('<I', buf, pos + 4)[0]
+        pos += 8
+        if tag == _SEQUENCE_END:
+            break
+        if tag != _ITEM:
+            raise UnsupportedImage(f'Malformed DICOM sequence at byte {pos - 8}')
+        item_end = end if item_length == 0xFFFFFFFF else pos + item_length
+        item, item_stop = _parse(buf, pos, item_end, explicit, stop_at_pixels=False)
+        items.append(item)
+        pos = item_stop if item_length == 0xFFFFFFFF else item_end
+    return items, pos
+
+
+def _number(elements, tag, default=None, fmt='<H'):
+    if tag not in elements:
+        return default
+    vr, value = elements[tag]
+    if vr in (b'DS', b'IS') or (vr is None and tag in (WINDOW_CENTER, WINDOW_WIDTH, RESCALE_SLOPE, RESCALE_INTERCEPT)):
+        text = bytes(value).decode('ascii', 'ignore').strip('\x00 ').split('\\')[0]
+        return float(text) if text else default
+    if len(value) < struct.calcsize(fmt):
+        return default
+    return struct.unpack_from(fmt, value)[0]
+
+
+def _text(elements, tag, default=''):
+    if tag not in elements:
+        return default
+    return bytes(elements[tag][1]).decode('ascii', 'ignore').strip('\x00 ')
+
+
+def read_dicom(buf):
+    """Parse the file meta and the dataset up to the pixel data; returns (elements, transfer_syntax, dataset_buf)."""
+    if not is_dicom(buf):
+        raise UnsupportedImage('Not a DICOM Part 10 file (missing DICM preamble)')
+    # The file meta group is always explicit VR little endian
+    meta, pos = _parse(buf, 132, len(buf), explicit=True, last_group=0x0002)
+    syntax = _text(meta, (0x0002, 0x0010)) or IMPLICIT_VR_LITTLE
+    if syntax == DEFLATED_EXPLICIT_VR_LITTLE:
+        buf, pos = memoryview(zlib.decompress(bytes(buf[pos:]), -15)), 0
+    elif syntax.startswith('1.2.840.10008.1.2.2'):
+        raise UnsupportedImage('Big endian DICOM is not supported')
+    elements, _ = _parse(buf, pos, len(buf), explicit=syntax != IMPLICIT_VR_LITTLE)
+    return elements, syntax, buf
+
+
+def _fragments(buf, pos):
+    """Fragments of encapsulated pixel data (after the basic offset table)."""
+    fragments = []
+    first = True
+    while pos + 8 <= len(buf):
+        tag = struct.unpack_from('<HH', buf, pos)
+        length = struct.unpack_from('<I', buf, pos + 4)[0]
+        pos += 8
+        if tag == _SEQUENCE_END:
+            break
+        if not first:
+            fragments.append(buf[pos:pos + length])
+        first = False
+        pos += length
+    return fragments
+
+
+def _pixel_view(buf, elements):
+    """2-D (or rows x cols x samples) view of the first frame of native pixel data; nothing is copied."""
+    rows, cols = _number(elements, ROWS), _number(elements, COLUMNS)
+    samples = _number(elements, SAMPLES_PER_PIXEL, 1)
+    bits = _number(elements, BITS_ALLOCATED, 16)
+    signed = _number(elements, PIXEL_REPRESENTATION, 0) == 1
+    if bits not in (8, 16, 32):
+        raise UnsupportedImage(f'{bits}-bit DICOM pixel data is not supported')
+    dtype = np.dtype(f"<{'i' if signed else 'u'}{bits // 8}")
+    offset, _ = elements[PIXEL_DATA][1]
+    count = rows * cols * samples
+    pixels = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+    if samples == 1:
+        return pixels.reshape(rows, cols)
+    if _number(elements, PLANAR_CONFIGURATION, 0) == 1:
+        return pixels.reshape(samples, rows, cols).transpose(1, 2, 0)
+    return pixels.reshape(rows, cols, samples)
+
+
+# --- reduction and windowing -----------------------------------------------------------------
+
+def reduction_factor(height, width, min_size):
+    return max(1, min(height, width) // min_size)
+
+
+def area_reduce(pixels, factor, band_rows=64, fix=None):
+    """Mean over factor x factor blocks, computed band_rows output rows at a time so only one
+    band of the input is ever copied. fix(band) can correct the raw integer values first."""
+    height, width = pixels.shape[0] // factor, pixels.shape[1] // factor
+    rest = pixels.shape[2:]
+    out = np.empty((height, width) + rest, dtype=np.float32)
+    for start in range(0, height, band_rows):
+        stop = min(height, start + band_rows)
+        band = pixels[start * factor:stop * factor, :width * factor]
+        if fix is not None:
+            band = fix(band)
+        # Rows first: summing whole rows is contiguous and converts to float32 on the fly
+        rows = band.reshape((stop - start, factor, width * factor) + rest).sum(axis=1, dtype=np.float32)
+        out[start:stop] = rows.reshape((stop - start, width, factor) + rest).sum(axis=2) / (factor * factor)
+    return out
+
+
+def _stored_value_fix(elements):
+    """Mask unused high bits (or sign-extend) when BitsStored < BitsAllocated."""
+    allocated = _number(elements, BITS_ALLOCATED, 16)
+    stored = _number(elements, BITS_STORED, allocated)
+    if stored >= allocated:
+        return None
+    if _number(elements, PIXEL_REPRESENTATION, 0) == 1:
+        shift = allocated - stored
+        return lambda band: (band << shift) >> shift
+    return lambda band: band & ((1 << stored) - 1)
+
+
+def _sample(pixels, factor, fix=None):
+    """Strided sample of the raw values, for window statistics that match the full-resolution image."""
+    sample = pixels[::factor, ::factor]
+    return np.asarray(fix(sample) if fix is not None else sample, dtype=np.float32)
+
+
+def window(values, center, width, function='LINEAR'):
+    """DICOM VOI window (PS3.3 C.11.2.1.2) mapping values to [0, 1]."""
+    function = (function or 'LINEAR').upper()
+    if function == 'SIGMOID':
+        return 1.0 / (1.0 + np.exp(-4.0 * (values - center) / width))
+    if function == 'LINEAR_EXACT':
+        return np.clip((values - center) / width + 0.5, 0.0, 1.0)
+    width = max(width, 1.0)
+    return np.clip((values - (center - 0.5)) / max(width - 1.0, 1.0) + 0.5, 0.0, 1.0)
+
+
+def auto_window(values, sample=None, low=0.5, high=99.5):
+    lo, hi = np.percentile(values if sample is None else sample, [low, high])
+    if hi <= lo:
+        hi = lo + 1.0
+    return np.clip((values - lo) / (hi - lo), 0.0, 1.0)
+
+
+def _apply_voi_lut(values, item):
+    descriptor = item[LUT_DESCRIPTOR][1]
+    entries, first, bits = struct.unpack_from('<HHH', descriptor)
+    entries = entries or 65536
+    data = item[LUT_DATA][1]
+    # 8-bit tables are usually stored in 16-bit words (OW), one entry per word
+    lut = np.frombuffer(data, dtype='<u2' if len(data) >= 2 * entries else '<u1')
+    index = np.clip(np.rint(values) - first, 0, min(entries, len(lut)) - 1).astype(np.int64)
+    return lut[index].astype(np.float32) / float(2 ** bits - 1)
+
+
+def _to_display(values, elements=None, full_scale=None, sample=None):
+    """Modality LUT, VOI and photometric interpretation of (reduced) grayscale values -> uint8.
+    Without a window, values are divided by full_scale if given, else auto-windowed on the
+    percentiles of sample (raw values, default: values themselves)."""
+    elements = elements or {}
+    slope = _number(elements, RESCALE_SLOPE, 1.0)
+    intercept = _number(elements, RESCALE_INTERCEPT, 0.0)
+    values = values * slope + intercept
+    if sample is not None:
+        sample = sample * slope + intercept
+    center, width = _number(elements, WINDOW_CENTER), _number(elements, WINDOW_WIDTH)
+    voi_lut = elements.get(VOI_LUT_SEQUENCE, (None, []))[1]
+    if center is not None and width:
+        display = window(values, center, width, _text(elements, VOI_LUT_FUNCTION, 'LINEAR'))
+    elif voi_lut and LUT_DESCRIPTOR in voi_lut[0] and LUT_DATA in voi_lut[0]:
+        display = _apply_voi_lut(values, voi_lut[0])
+    elif full_scale:
+        display = np.clip(values / full_scale, 0.0, 1.0)
+    else:
+        display = auto_window(values, sample)
+    if _text(elements, PHOTOMETRIC) == 'MONOCHROME1':
+        display = 1.0 - display
+    return (display * 255.0 + 0.5).astype(np.uint8)
+
+
+def _reduce_jpeg(data, min_size):
+    image = Image.open(io.BytesIO(bytes(data)))
+    # libjpeg scales by 1/2, 1/4 or 1/8 in the DCT, keeping at least the requested size
+    image.draft(image.mode, (min_size, min_size))
+    return image
+
+
+def _decode_dicom(source, min_size):
+    buf, _ = _read_source(source)
+    elements, syntax, buf = read_dicom(buf)
+    image = _dicom_pixels(source, buf, elements, syntax, min_size)
+    image.info['original_size'] = (_number(elements, COLUMNS), _number(elements, ROWS))
+    return image
+
+
+def _dicom_pixels(source, buf, elements, syntax, min_size):
+    if PIXEL_DATA not in elements:
+        raise UnsupportedImage('DICOM file has no pixel data')
+    offset, length = elements[PIXEL_DATA][1]
+    if length != 0xFFFFFFFF:
+        pixels = _pixel_view(buf, elements)
+        factor = reduction_factor(pixels.shape[0], pixels.shape[1], min_size)
+        if pixels.ndim == 3:
+            return Image.fromarray(area_reduce(pixels, factor).clip(0, 255).astype(np.uint8)).convert('RGB')
+        fix = _stored_value_fix(elements)
+        values = area_reduce(pixels, factor, fix=fix)
+        return Image.fromarray(_to_display(values, elements, _eight_bit_scale(elements),
+                                           _sample(pixels, factor, fix))).convert('RGB')
+    if syntax in JPEG_BASELINE:
+        # Single-frame files: all fragments belong to the one JPEG stream
+        image = _reduce_jpeg(b''.join(bytes(f) for f in _fragments(buf, offset)), min_size)
+        if image.mode != 'L':
+            return image.convert('RGB')
+        values = np.asarray(image, dtype=np.float32)
+        return Image.fromarray(_to_display(values, elements, full_scale=255.0)).convert('RGB')
+    return _decode_dicom_pydicom(source, elements, min_size)
+
+
+def _eight_bit_scale(elements):
+    # 8-bit data without a window is shown as stored, like an ordinary 8-bit image
+    return 255.0 if _number(elements, BITS_STORED, _number(elements, BITS_ALLOCATED, 16)) <= 8 else None
+
+
+def _decode_dicom_pydicom(source, elements, min_size):
+    # JPEG 2000, JPEG-LS, lossless JPEG and RLE need pydicom plus its pixel handlers
+    try:
+        import pydicom
+    except ImportError:
+        raise UnsupportedImage('Compressed DICOM transfer syntax needs pydicom (pip install pydicom)')
+    dataset = pydicom.dcmread(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+    pixels = dataset.pixel_array
+    if pixels.ndim == 3 and pixels.shape[-1] not in (3, 4):
+        pixels = pixels[0]
+    factor = reduction_factor(pixels.shape[0], pixels.shape[1], min_size)
+    values = area_reduce(pixels, factor)
+    if values.ndim == 3:
+        return Image.fromarray(values.clip(0, 255).astype(np.uint8)).convert('RGB')
+    return Image.fromarray(_to_display(values, elements, _eight_bit_scale(elements),
+                                       _sample(pixels, factor))).convert('RGB')
+
+
+def _raw_view(image, buf):
+    """In-place view of an uncompressed single-band image whose strips are contiguous, else None."""
+    dtypes = {'I;16': '<u2', 'I;16L': '<u2', 'I;16B': '>u2', 'I;16N': '=u2', 'L': 'u1',
+              'I;32': '<i4', 'I;32L': '<i4', 'I;32B': '>i4', 'F;32F': '<f4', 'F;32BF': '>f4'}
+    tiles = image.tile
+    if not tiles or any(t[0] != 'raw' for t in tiles):
+        return None
+    width, height = image.size
+    rawmode = tiles[0][3][0] if isinstance(tiles[0][3], tuple) else tiles[0][3]
+    if rawmode not in dtypes or any(t[1][0] != 0 or t[1][2] != width for t in tiles):
+        return None
+    dtype = np.dtype(dtypes[rawmode])
+    row_bytes = width * dtype.itemsize
+    tiles = sorted(tiles, key=lambda t: t[1][1])
+    offset = tiles[0][2]
+    expected = offset
+    for t in tiles:
+        stride = t[3][1] if isinstance(t[3], tuple) and len(t[3]) > 1 else 0
+        if t[2] != expected or stride not in (0, row_bytes):
+            return None
+        expected += (t[1][3] - t[1][1]) * row_bytes
+    if expected > len(buf):
+        return None
+    return np.frombuffer(buf, dtype=dtype, count=width * height, offset=offset).reshape(height, width)
+
+
+def load_xray(source, min_size=448, reduce_8bit=False):
+    """RGB PIL image of an X-ray (bytes or path); DICOM and 16-bit images have their short side
+    reduced to about min_size (8-bit ones too with reduce_8bit).
+    image.info['original_size'] is the (width, height) before reduction."""
+    buf, path = _read_source(source)
+    if is_dicom(buf):
+        return _decode_dicom(source, min_size)
+    image = Image.open(io.BytesIO(buf) if path is None else path)
+    original_size = image.size
+    if image.mode in ('1', 'L', 'P', 'RGB', 'RGBA', 'LA', 'CMYK', 'YCbCr'):
+        # 8-bit input keeps its own intensities
+        if reduce_8bit:
+            if image.format == 'JPEG':
+                image.draft(image.mode, (min_size, min_size))
+            # Shrinking before convert() avoids a full-size RGB copy
+            if image.mode in ('1', 'P'):
+                image = image.convert('L' if image.mode == '1' else 'RGB')
+            factor = reduction_factor(image.height, image.width, min_size)
+            if factor > 1:
+                image = image.reduce(factor)
+        image = image.convert('RGB')
+    else:
+        # 16-bit and float single-band images (I;16*, I, F)
+        factor = reduction_factor(image.height, image.width, min_size)
+        pixels = _raw_view(image, buf)
+        if pixels is None:
+            pixels = np.asarray(image)
+        image = Image.fromarray(_to_display(area_reduce(pixels, factor), sample=_sample(pixels, factor))).convert('RGB')
+    image.info['original_size'] = original_size
+    return image